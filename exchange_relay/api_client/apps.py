@@ -48,6 +48,8 @@ class ApiClientConfig(AppConfig):
                 # Create a new event loop for this thread
                 loop = asyncio.new_event_loop()
                 asyncio.set_event_loop(loop)
+                # Manual fetches (DebugApiView) are handed to this loop
+                self.fetcher_loop = loop
                 
                 # Create the API client
                 api_client = IranExchangeClient()
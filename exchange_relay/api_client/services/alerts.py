@@ -0,0 +1,255 @@
+# api_client/services/alerts.py
+import bisect
+import itertools
+import logging
+import threading
+from collections import Counter, defaultdict
+from datetime import datetime
+from typing import Dict, Any, Callable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Fires when the value moves from below the threshold to at/above it (or the reverse)
+THRESHOLD_OPS = ('crosses_above', 'crosses_below')
+# Fires when a boolean field such as buy_queue flips, e.g. a queue at tmax forms or collapses
+FLAG_OPS = ('becomes_true', 'becomes_false')
+# Fires when the value rises to or past value × the stock's running average of that field.
+# Meant for per-interval fields such as interval_value rather than cumulative ones.
+# The average takes in every stock's value on every cycle once any rule averages that field.
+AVERAGE_OPS = ('exceeds_avg',)
+RULE_OPS = THRESHOLD_OPS + FLAG_OPS + AVERAGE_OPS
+
+MAX_RULES_PER_OWNER = 1000
+
+
+class AlertRuleError(ValueError):
+    """Raised when an alert rule is invalid"""
+
+
+class AlertEngine:
+    """Evaluates every active rule once per ingestion cycle.
+
+    Rules are compiled into groups keyed by (stock, field, op). Threshold and
+    average groups keep their operands sorted, so finding the rules crossed
+    between the previous and current value is a bisect over the group rather
+    than a scan of every rule.
+    """
+
+    def __init__(self):
+        self.rules = {}
+        self._rule_ids = itertools.count(1)
+        # owner -> callable(list of notifications), invoked from the ingestion thread
+        self._owners = {}
+        self._owner_rules = defaultdict(set)
+        # (stock_id, field, op) -> sorted [(operand, rule_id)] or set of rule ids for flag ops
+        self._groups = {}
+        self._stock_groups = defaultdict(set)
+        # Previous latest-values row per stock, to detect edges
+        self._previous_rows = {}
+        # field -> number of average rules on it, their running averages cover every stock
+        self._average_fields = Counter()
+        # (stock_id, field) -> (count, mean, previous ratio, ratio) for average rules
+        self._averages = {}
+        # Rules are edited from consumer threads while evaluation runs in the ingestion thread
+        self._lock = threading.Lock()
+
+    def register_owner(self, owner: str, deliver: Callable[[List[Dict[str, Any]]], None]):
+        with self._lock:
+            self._owners[owner] = deliver
+
+    def remove_owner(self, owner: str):
+        with self._lock:
+            for rule_id in list(self._owner_rules.get(owner, ())):
+                self._remove_rule(rule_id)
+            self._owner_rules.pop(owner, None)
+            self._owners.pop(owner, None)
+
+    def add_rule(self, owner: str, spec: Dict[str, Any]) -> Dict[str, Any]:
+        """Validate and compile a rule given as {'stock_id', 'field', 'op', 'value'}"""
+        stock_id = spec.get('stock_id')
+        field = spec.get('field')
+        op = spec.get('op')
+        if not stock_id or not isinstance(stock_id, str):
+            raise AlertRuleError("Rule needs a stock_id")
+        if not field or not isinstance(field, str):
+            raise AlertRuleError("Rule needs a field")
+        if op not in RULE_OPS:
+            raise AlertRuleError(f"Unknown op {op}, expected one of {list(RULE_OPS)}")
+
+        value = spec.get('value')
+        if op not in FLAG_OPS:
+            try:
+                value = float(value)
+            except (TypeError, ValueError):
+                raise AlertRuleError(f"Rule op {op} needs a numeric value")
+        else:
+            value = None
+
+        with self._lock:
+            if len(self._owner_rules[owner]) >= MAX_RULES_PER_OWNER:
+                raise AlertRuleError(f"At most {MAX_RULES_PER_OWNER} rules per connection")
+
+            rule = {'id': next(self._rule_ids), 'stock_id': stock_id, 'field': field, 'op': op, 'value': value}
+            self.rules[rule['id']] = (owner, rule)
+            self._owner_rules[owner].add(rule['id'])
+
+            key = (stock_id, field, op)
+            if op in FLAG_OPS:
+                self._groups.setdefault(key, set()).add(rule['id'])
+            else:
+                bisect.insort(self._groups.setdefault(key, []), (value, rule['id']))
+            self._stock_groups[stock_id].add(key)
+            if op in AVERAGE_OPS:
+                self._average_fields[field] += 1
+        return rule
+
+    def remove_rule(self, owner: str, rule_id: int) -> bool:
+        with self._lock:
+            if rule_id not in self._owner_rules.get(owner, ()):
+                return False
+            self._remove_rule(rule_id)
+            return True
+
+    def _remove_rule(self, rule_id):
+        owner, rule = self.rules.pop(rule_id)
+        self._owner_rules[owner].discard(rule_id)
+        key = (rule['stock_id'], rule['field'], rule['op'])
+        group = self._groups[key]
+        if isinstance(group, set):
+            group.discard(rule_id)
+        else:
+            group.remove((rule['value'], rule_id))
+        if not group:
+            del self._groups[key]
+            self._stock_groups[rule['stock_id']].discard(key)
+        if rule['op'] in AVERAGE_OPS:
+            field = rule['field']
+            self._average_fields[field] -= 1
+            if not self._average_fields[field]:
+                del self._average_fields[field]
+                for average_key in [k for k in self._averages if k[1] == field]:
+                    del self._averages[average_key]
+
+    def list_rules(self, owner: str) -> List[Dict[str, Any]]:
+        with self._lock:
+            return [self.rules[rule_id][1] for rule_id in sorted(self._owner_rules.get(owner, ()))]
+
+    def evaluate(self, changed_rows: Dict[str, Dict[str, Any]], generation: int,
+                 rows: Optional[Dict[str, Dict[str, Any]]] = None) -> int:
+        """Evaluate all rules against this cycle and deliver fired alerts.
+
+        Edge rules only look at the rows that changed. Average rules look at
+        every row in ``rows`` (all stocks, defaulting to the changed ones),
+        since an unchanged value still moves the average.
+        """
+        fired = defaultdict(list)
+        timestamp = datetime.now().isoformat()
+        if rows is None:
+            rows = changed_rows
+
+        with self._lock:
+            self._update_averages(rows)
+            for stock_id, row in rows.items():
+                changed = stock_id in changed_rows
+                if changed:
+                    previous_row = self._previous_rows.get(stock_id)
+                    self._previous_rows[stock_id] = row
+
+                for key in self._stock_groups.get(stock_id, ()):
+                    _, field, op = key
+                    current = row.get(field)
+                    if op in AVERAGE_OPS:
+                        matches = self._average_matches(stock_id, field, self._groups[key])
+                        previous = None
+                    elif not changed:
+                        continue
+                    else:
+                        previous = previous_row.get(field) if previous_row else None
+                        if previous is None or current is None:
+                            continue
+                        matches = self._edge_matches(op, previous, current, self._groups[key])
+
+                    for rule_id in matches:
+                        owner, rule = self.rules[rule_id]
+                        fired[owner].append({
+                            'rule_id': rule_id,
+                            'stock_id': stock_id,
+                            'field': field,
+                            'op': op,
+                            'value': rule['value'],
+                            'previous': previous,
+                            'current': current,
+                            'generation': generation,
+                            'time': timestamp,
+                        })
+
+            deliveries = [(self._owners.get(owner), notes) for owner, notes in fired.items()]
+
+        for deliver, notes in deliveries:
+            if deliver is None:
+                continue
+            try:
+                deliver(notes)
+            except Exception as e:
+                logger.error(f"Error delivering alerts: {e}")
+
+        count = sum(len(notes) for _, notes in deliveries)
+        if count:
+            logger.info(f"Alert engine fired {count} alerts for {len(deliveries)} connections")
+        return count
+
+    @staticmethod
+    def _edge_matches(op, previous, current, group):
+        if op == 'becomes_true':
+            return group if current and not previous else ()
+        if op == 'becomes_false':
+            return group if previous and not current else ()
+        # A value equal to the threshold counts as at/above it, in both directions
+        if op == 'crosses_above' and current > previous:
+            # thresholds in (previous, current]
+            low, high = previous, current
+        elif op == 'crosses_below' and current < previous:
+            # thresholds in (current, previous]
+            low, high = current, previous
+        else:
+            return ()
+        return _thresholds_in(group, low, high)
+
+    def _update_averages(self, rows):
+        """Fold this cycle's value of every averaged field into each stock's running average"""
+        for field in self._average_fields:
+            for stock_id, row in rows.items():
+                key = (stock_id, field)
+                count, mean, _, ratio = self._averages.get(key, (0, 0.0, 0.0, 0.0))
+                current = row.get(field)
+                if isinstance(current, bool) or not isinstance(current, (int, float)):
+                    # Nothing to add this cycle, so nothing is crossed either
+                    self._averages[key] = (count, mean, ratio, ratio)
+                    continue
+                new_ratio = current / mean if mean > 0 else 0.0
+                self._averages[key] = (count + 1, mean + (current - mean) / (count + 1), ratio, new_ratio)
+
+    def _average_matches(self, stock_id, field, group):
+        _, _, last_ratio, ratio = self._averages.get((stock_id, field), (0, 0.0, 0.0, 0.0))
+        if ratio <= last_ratio:
+            return ()
+        # multipliers in (last_ratio, ratio] were crossed this cycle, like crosses_above
+        return _thresholds_in(group, last_ratio, ratio)
+
+
+def _thresholds_in(group, low, high) -> List[int]:
+    """Rule ids of a sorted [(operand, rule_id)] group whose operand is in (low, high]"""
+    start = bisect.bisect_right(group, (low, float('inf')))
+    end = bisect.bisect_right(group, (high, float('inf')))
+    return [rule_id for _, rule_id in group[start:end]]
+
+
+# Global singleton instance
+_alert_engine = None
+
+def get_alert_engine():
+    """Get the singleton alert engine instance"""
+    global _alert_engine
+    if _alert_engine is None:
+        _alert_engine = AlertEngine()
+    return _alert_engine
@@ -0,0 +1,72 @@
+# api_client/services/batch.py
+from datetime import datetime
+from typing import Dict, Any, List, Optional
+
+from .history import HISTORY_FIELDS, HistoryQueryError, parse_time, build_history
+
+DEFAULT_MAX_SYMBOLS = 500
+
+
+class BatchQueryError(ValueError):
+    """Raised when a batch query can't be parsed"""
+
+
+def _as_list(value, label) -> Optional[List[str]]:
+    """Accept a list of names or a comma-separated string, None meaning all"""
+    if value is None or value == '':
+        return None
+    if isinstance(value, str):
+        value = [name for name in value.split(',') if name]
+    if not isinstance(value, list) or not all(isinstance(name, str) and name for name in value):
+        raise BatchQueryError(f"{label} must be a list of names")
+    return list(dict.fromkeys(value))
+
+
+def parse_batch_query(params: Dict[str, Any], max_symbols: int = DEFAULT_MAX_SYMBOLS,
+                      reference: Optional[datetime] = None) -> Dict[str, Any]:
+    """Validate a batch query given as query parameters or a JSON body.
+
+    ``symbols`` (required) and ``fields`` are lists or comma-separated strings;
+    ``since`` takes the same formats as the history 'from' parameter.
+    """
+    symbols = _as_list(params.get('symbols'), 'symbols')
+    if not symbols:
+        raise BatchQueryError("symbols is required")
+    if len(symbols) > max_symbols:
+        raise BatchQueryError(f"At most {max_symbols} symbols per request")
+    fields = _as_list(params.get('fields'), 'fields')
+    try:
+        since = parse_time(params.get('since'), reference)
+    except HistoryQueryError as e:
+        raise BatchQueryError(str(e))
+    return {'symbols': symbols, 'fields': fields, 'since': since}
+
+
+def history_fields(fields: Optional[List[str]]) -> List[str]:
+    """The requested fields that are kept as per-cycle series, price and volume when none were named"""
+    if fields is None:
+        return ['pl', 'tvol']
+    return [field for field in fields if field in HISTORY_FIELDS]
+
+
+def build_batch(symbols: List[str], fields: Optional[List[str]], generation: int, committed_at: Optional[datetime],
+                rows: Dict[str, Dict[str, Any]], history: Dict[str, Any]) -> Dict[str, Any]:
+    """Build the batch response: each symbol's projected latest values, plus its samples when asked since a time"""
+    data = {}
+    for code in symbols:
+        row = rows.get(code)
+        if row is None:
+            continue
+        entry = {field: row.get(field) for field in fields} if fields is not None else dict(row)
+        if code in history:
+            times, columns = history[code]
+            entry['history'] = build_history(code, times, columns)
+        data[code] = entry
+    return {
+        'generation': generation,
+        'timestamp': committed_at.isoformat() if committed_at else None,
+        'count': len(data),
+        'fields': fields,
+        'data': data,
+        'missing': [code for code in symbols if code not in rows]
+    }
@@ -1,11 +1,73 @@
 import asyncio
 import logging
+import threading
 from typing import Dict, Any
 from datetime import datetime
 from collections import defaultdict
+from .screener import get_screener
+from .order_book import compute_book_metrics, BOOK_METRIC_FIELDS
+from .leaderboards import get_leaderboards
+from .trade_tape import get_trade_tape
+from .alerts import get_alert_engine
+from .history import slice_series
+from .metadata_search import get_metadata_index
+from .metadata_records import EMPTY_METADATA
 
 logger = logging.getLogger(__name__)
 
+# Series whose most recent value is kept in the latest-values table
+LATEST_FIELDS = (
+    'pl', 'pc', 'pf', 'py', 'pmax', 'pmin', 'tno', 'tvol', 'tval',
+    'qd1', 'pd1', 'qo1', 'po1',
+    'Buy_I_Volume', 'Buy_N_Volume', 'Sell_I_Volume', 'Sell_N_Volume',
+    'sa_kharid', 'sa_forosh', 'ghodratpol', 'vorodpol', 'Buy_N_Ratio',
+    *BOOK_METRIC_FIELDS,
+)
+
+# Series filled from the client type data, None in cycles without it
+CLIENT_TYPE_FIELDS = (
+    'Buy_I_Volume', 'Buy_N_Volume', 'Sell_I_Volume', 'Sell_N_Volume',
+    'Buy_CountI', 'Buy_CountN', 'Sell_CountI', 'Sell_CountN',
+    'vorodpol', 'sa_kharid', 'sa_forosh', 'ghodratpol', 'Buy_N_Ratio',
+)
+
+# Series filled from the best limits data, None in cycles without it
+ORDER_BOOK_FIELDS = (
+    *(f'{side}{num}' for num in range(1, 6) for side in ('zd', 'qd', 'pd', 'po', 'qo', 'zo')),
+    *BOOK_METRIC_FIELDS,
+)
+
+def _to_float(value):
+    """Convert a metadata value to float, returning None for missing or invalid values"""
+    try:
+        return float(value) if value is not None and value != '' else None
+    except (TypeError, ValueError):
+        return None
+
+def _wake_waiter(waiter):
+    if not waiter.done():
+        waiter.set_result(None)
+
+class _CacheLock:
+    """A thread lock taken with ``async with``.
+
+    The cache is written from the fetcher thread's event loop and read from the
+    ASGI loop, and an asyncio.Lock only works within one loop. Critical sections
+    never await, so a thread lock is safe; waiters poll instead of blocking their
+    loop while the other thread holds it.
+    """
+
+    def __init__(self, poll_interval=0.001):
+        self._lock = threading.Lock()
+        self.poll_interval = poll_interval
+
+    async def __aenter__(self):
+        while not self._lock.acquire(blocking=False):
+            await asyncio.sleep(self.poll_interval)
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self._lock.release()
+
 # Global singleton instance
 _cache_instance = None
 
@@ -15,8 +77,27 @@ class ExchangeDataCache:
         self.data = {}
         # Create timestamps for tracking data age
         self.last_update = None
-        # Set up locks for thread safety
-        self._lock = asyncio.Lock()
+        # Monotonic counter bumped once per committed ingestion cycle
+        self.generation = 0
+        # Latest scalar values per stock, rebuilt as each stock is processed
+        self.latest = {}
+        # Generation in which each stock's latest values or metadata last changed
+        self.versions = {}
+        # (generation, commit time, latest-values table) as of the last commit, swapped as a whole
+        self.committed = (0, None, {})
+        self._changed_stocks = set()
+        # Stocks whose metadata changed since the last commit (their latest-values row may not have)
+        self._changed_metadata = set()
+        self.metadata = {}
+        # Bumped whenever the metadata content changes, so rendered copies of it know when they're stale
+        self.metadata_version = 0
+        # Set up locks for thread safety (shared by the fetcher thread's loop and the ASGI loop)
+        self._lock = _CacheLock()
+        # Held by an ingestion cycle from its first stock to its commit
+        self._update_lock = _CacheLock()
+        # (loop, future) pairs waiting for the next committed cycle, possibly on other threads
+        self._commit_waiters = []
+        self._waiters_lock = threading.Lock()
         logger.info("Exchange data cache initialized")
     
    
@@ -25,6 +106,8 @@ class ExchangeDataCache:
         async with self._lock:
             if stock_id not in self.data:
                 self.data[stock_id] = self._create_empty_stock_structure()
+                # Metadata arrives before the stocks on the first cycle
+                self._apply_metadata(stock_id)
     def _create_empty_stock_structure(self):
         """Create an empty data structure for a stock"""
         # This matches the structure from the provided code
@@ -49,6 +132,9 @@ class ExchangeDataCache:
             # Demand and supply fields for 5 price levels
             **{f'{side}{num}': [] for side in ['zd', 'qd', 'pd', 'po', 'qo', 'zo'] for num in range(1, 6)},
             
+            # Order book metrics derived from the 5 levels above
+            **{field: [] for field in BOOK_METRIC_FIELDS},
+            
             # Client type fields
             'Buy_I_Volume': [],
             'Buy_N_Volume': [],
@@ -72,54 +158,49 @@ class ExchangeDataCache:
                for field in ['time', 'vol', 'number', 'value', 'volume-comulative', 'value-comulative', 'count']}
         }
         
-        # Add metadata fields (these will be filled later)
-        stock_data['metadata'] = {
-            'name': '',
-            'Full_name': '',
-            'CGrValCot': '',
-            'industry_num': '',
-            'Exchange': '',
-            'valid': '',
-            'exchange_name': '',
-            'industry_name': ''
-        }
+        # Metadata is filled in from the metadata table, shared empty record until then
+        stock_data['metadata'] = EMPTY_METADATA
         
         return stock_data
     async def update_metadata(self, metadata):
-        """Update the metadata for all stocks"""
+        """Update the metadata for all stocks
+
+        The metadata client hands over the same dict until one of its sources
+        changes, so an unchanged cycle costs a single identity check. Each
+        stock's metadata is the record of that dict itself, not a copy.
+        """
+        if metadata is self.metadata:
+            return
         async with self._lock:
+            if metadata != self.metadata:
+                self.metadata_version += 1
+                # Search indexes only need rebuilding when the content changed
+                get_metadata_index().rebuild(metadata, self.metadata_version)
             self.metadata = metadata
             
-            # Also update metadata for existing stocks in the cache
-            for stock_id, stock_meta in metadata.items():
-                if stock_id in self.data:
-                    # Make sure all metadata fields including pe, tmax, tmin, nav are included
-                    self.data[stock_id]['metadata'] = {
-                        'name': stock_meta.get('name', ''),
-                        'Full_name': stock_meta.get('Full_name', ''),
-                        'CGrValCot': stock_meta.get('CGrValCot', ''),
-                        'industry_num': stock_meta.get('industry_num', ''),
-                        'Exchange': stock_meta.get('Exchange', ''),
-                        'valid': stock_meta.get('valid', ''),
-                        'exchange_name': stock_meta.get('exchange_name', ''),
-                        'industry_name': stock_meta.get('industry_name', ''),
-                        # Add the new fields
-                        'pe': stock_meta.get('pe', None),  # Change to None
-                        'tmax': stock_meta.get('tmax', None),  # Change to None
-                        'tmin': stock_meta.get('tmin', None),  # Change to None
-                        'nav': stock_meta.get('nav', None),  # Change to None
-                        # Add the new fields
-                        'is_san': stock_meta.get('is_san', None),
-                        'gpe': stock_meta.get('gpe', None),
-                         # Add min_lot and max_lot
-                        'min_lot': stock_meta.get('min_lot', None),
-                        'max_lot': stock_meta.get('max_lot', None)
-                    }
+            # Also update metadata for existing stocks in the cache, new ones get theirs in initialize_stock
+            for stock_id in self.data:
+                self._apply_metadata(stock_id)
+
+    def _apply_metadata(self, stock_id):
+        """Point a stock's metadata at its record, noting the stock as changed when the content differs"""
+        stock_meta = self.metadata.get(stock_id)
+        if stock_meta is None or self.data[stock_id]['metadata'] is stock_meta:
+            return
+        # The stock's version only moves on real changes
+        if self.data[stock_id]['metadata'] != stock_meta:
+            self._changed_metadata.add(stock_id)
+        self.data[stock_id]['metadata'] = stock_meta
                     
     async def get_all_metadata(self):
         """Get metadata for all stocks"""
         async with self._lock:
             return self.metadata
+
+    async def get_metadata_table(self):
+        """The metadata of all stocks together with its version, read consistently"""
+        async with self._lock:
+            return self.metadata_version, self.metadata
             
     async def get_stock_metadata(self, stock_id):
         """Get metadata for a specific stock"""
@@ -130,11 +211,19 @@ class ExchangeDataCache:
                 return self.metadata[stock_id]
             return {}
     async def update_data(self, api_data):
-        """Update the cache with new data from the API"""
+        """Update the cache with new data from the API
+
+        Ingestions are serialized from processing through commit, whichever
+        thread's loop they run on, so two cycles never interleave.
+        """
         if not api_data:
             logger.warning("Received empty API data, skipping update")
             return
-            
+        async with self._update_lock:
+            await self._ingest(api_data)
+    
+    async def _ingest(self, api_data):
+        """Process one cycle of API data and commit it (caller must hold the update lock)"""
         self.last_update = datetime.now()
         logger.info(f"Updating cache with new data at {self.last_update}")
         # Update metadata if available
@@ -156,7 +245,60 @@ class ExchangeDataCache:
                 limits_data.get(stock_code)
             )
         
-        logger.info("Cache update completed")
+        # Readers take the generation first and then the versions, boards or
+        # screener, so the new generation is only published once all of them are written
+        generation = self.generation + 1
+        changed_rows = {stock_id: self.latest[stock_id] for stock_id in self._changed_stocks}
+        for stock_id in self._changed_stocks | self._changed_metadata:
+            self.versions[stock_id] = generation
+        self._changed_stocks = set()
+        self._changed_metadata = set()
+        self.committed = (generation, datetime.now(), dict(self.latest))
+        
+        # Only the instruments that changed can move on the leaderboards
+        get_leaderboards().update(changed_rows, generation)
+        get_alert_engine().evaluate(changed_rows, generation, self.latest)
+        # Re-sort the screener indexes once per cycle instead of once per query
+        get_screener().rebuild(self.latest, generation)
+        
+        self.generation = generation
+        logger.info(f"Cache update completed (generation {self.generation})")
+        self._notify_commit()
+    
+    def _notify_commit(self):
+        """Wake every task waiting in wait_for_update, whichever thread's event loop it runs on"""
+        with self._waiters_lock:
+            waiters, self._commit_waiters = self._commit_waiters, []
+        for loop, waiter in waiters:
+            try:
+                loop.call_soon_threadsafe(_wake_waiter, waiter)
+            except RuntimeError:
+                # The waiter's loop has been closed
+                pass
+    
+    async def wait_for_update(self, last_generation, timeout=None):
+        """Wait until a cycle newer than ``last_generation`` is committed, returns the current generation.
+        
+        Returns early with the unchanged generation when ``timeout`` seconds pass first.
+        """
+        if self.generation > last_generation:
+            return self.generation
+        
+        loop = asyncio.get_running_loop()
+        waiter = loop.create_future()
+        with self._waiters_lock:
+            self._commit_waiters.append((loop, waiter))
+        try:
+            # Re-check after registering so a commit in between isn't missed
+            if self.generation <= last_generation:
+                await asyncio.wait_for(waiter, timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            with self._waiters_lock:
+                if (loop, waiter) in self._commit_waiters:
+                    self._commit_waiters.remove((loop, waiter))
+        return self.generation
     
     async def process_stock_data(self, stock_code, trade_item, client_type_item, limits_item):
         """Process and update data for a single stock"""
@@ -212,11 +354,19 @@ class ExchangeDataCache:
                     else:
                         buy_n_ratio = 0
                     
+                    # Money inflow of individuals (حقیقی) valued at the last price
+                    vorodpol = (buy_i - sell_i) * float(trade_item.get('PDrCotVal', 0))
+                    
                     # Store calculated metrics
+                    self.data[stock_code]['vorodpol'].append(vorodpol)
                     self.data[stock_code]['sa_kharid'].append(sa_kharid)
                     self.data[stock_code]['sa_forosh'].append(sa_forosh)
                     self.data[stock_code]['ghodratpol'].append(ghodratpol)
                     self.data[stock_code]['Buy_N_Ratio'].append(buy_n_ratio)
+                else:
+                    # Keep every series aligned with 'time', a gap is a None sample
+                    for field in CLIENT_TYPE_FIELDS:
+                        self.data[stock_code][field].append(None)
                 
                 # Update limits data if available
                 if limits_item:
@@ -238,6 +388,66 @@ class ExchangeDataCache:
                             self.data[stock_code][f'po{i}'].append(0)
                             self.data[stock_code][f'qo{i}'].append(0)
                             self.data[stock_code][f'zo{i}'].append(0)
+                    
+                    self._update_book_metrics(stock_code)
+                else:
+                    for field in ORDER_BOOK_FIELDS:
+                        self.data[stock_code][field].append(None)
+                
+                # Infer what traded since the previous snapshot
+                trade_event = get_trade_tape().record(
+                    stock_code,
+                    current_time,
+                    self.data[stock_code]['tno'][-1],
+                    self.data[stock_code]['tvol'][-1],
+                    self.data[stock_code]['tval'][-1],
+                    self.data[stock_code]['pl'][-1],
+                    best_bid=self.data[stock_code]['pd1'][-1] if self.data[stock_code]['pd1'] else None,
+                    best_ask=self.data[stock_code]['po1'][-1] if self.data[stock_code]['po1'] else None
+                )
+                
+                self._update_latest(stock_code, trade_event)
+    
+    def _update_book_metrics(self, stock_code):
+        """Derive spread, imbalance, depth and queues from the levels just appended (caller must hold the lock)"""
+        stock_data = self.data[stock_code]
+        metadata = self.metadata.get(stock_code) or stock_data.get('metadata', {})
+        metrics = compute_book_metrics(
+            [stock_data[f'pd{i}'][-1] for i in range(1, 6)],
+            [stock_data[f'qd{i}'][-1] for i in range(1, 6)],
+            [stock_data[f'po{i}'][-1] for i in range(1, 6)],
+            [stock_data[f'qo{i}'][-1] for i in range(1, 6)],
+            tmax=_to_float(metadata.get('tmax')),
+            tmin=_to_float(metadata.get('tmin'))
+        )
+        for field, value in metrics.items():
+            stock_data[field].append(value)
+    
+    def _update_latest(self, stock_code, trade_event=None):
+        """Refresh the latest-values row for a stock (caller must hold the lock)"""
+        stock_data = self.data[stock_code]
+        row = {field: stock_data[field][-1] for field in LATEST_FIELDS if stock_data.get(field)}
+        
+        # What traded since the previous snapshot
+        row['interval_count'] = trade_event['count'] if trade_event else 0
+        row['interval_volume'] = trade_event['volume'] if trade_event else 0
+        row['interval_value'] = trade_event['value'] if trade_event else 0
+        
+        last_price = row.get('pl', 0)
+        yesterday_price = row.get('py', 0)
+        row['pchange'] = last_price - yesterday_price if yesterday_price > 0 else 0
+        row['pchange_pct'] = row['pchange'] / yesterday_price * 100 if yesterday_price > 0 else 0
+        
+        # Daily price limits come from metadata and are needed for queue/limit filters
+        metadata = self.metadata.get(stock_code) or stock_data.get('metadata', {})
+        for field in ('tmax', 'tmin', 'pe'):
+            row[field] = _to_float(metadata.get(field))
+        row['name'] = metadata.get('name', '')
+        
+        if self.latest.get(stock_code) != row:
+            self._changed_stocks.add(stock_code)
+        # Replace rather than mutate so readers holding the previous row see a consistent view
+        self.latest[stock_code] = row
     
     async def get_stock_data(self, stock_code):
         """Get data for a specific stock"""
@@ -248,10 +458,42 @@ class ExchangeDataCache:
                 logger.warning(f"Stock code {stock_code} not found in cache")
                 return {}
     
+    async def get_stock_history(self, stock_code, fields, start=None, end=None, offset=0, limit=None):
+        """Copy the samples of some fields between start and end, or None for an unknown stock"""
+        async with self._lock:
+            if stock_code not in self.data:
+                return None
+            return slice_series(self.data[stock_code], fields, start, end, offset, limit)
+    
+    async def get_committed_batch(self, stock_codes, history_fields=(), since=None):
+        """Latest values of several stocks and their samples since a time, all as of the last commit.
+        
+        Returns (generation, commit time, {code: latest row}, {code: (times, columns)}); samples of
+        a cycle still being ingested are left out so every stock reflects the same cycle.
+        """
+        async with self._lock:
+            generation, committed_at, latest = self.committed
+            rows = {code: latest[code] for code in stock_codes if code in latest}
+            history = {}
+            if since is not None and committed_at is not None:
+                for code in rows:
+                    history[code] = slice_series(self.data[code], history_fields, since, committed_at)
+            return generation, committed_at, rows, history
+    
+    async def get_stocks_data(self, stock_codes):
+        """Get data for several stocks under a single lock acquisition, skipping unknown codes"""
+        async with self._lock:
+            return {code: self.data[code] for code in stock_codes if code in self.data}
+    
     async def get_all_data(self):
         """Get all cached data"""
         async with self._lock:
             return self.data
+    async def get_latest_values(self):
+        """Get the latest-values table (one row of scalar values per stock)"""
+        async with self._lock:
+            return dict(self.latest)
+    
     async def get_all_stocks_summary(self):
         """Get a summary of all stocks with the most recent values"""
         async with self._lock:
@@ -259,39 +501,75 @@ class ExchangeDataCache:
             
             for stock_id, stock_data in self.data.items():
                 # Only include stocks that have actual data
-                if stock_data and stock_data.get('time') and stock_data['time']:
-                    # Calculate price change
-                    last_price = stock_data['pl'][-1] if stock_data.get('pl') and stock_data['pl'] else 0
-                    yesterday_price = stock_data['py'][-1] if stock_data.get('py') and stock_data['py'] else 0
-                    price_change = last_price - yesterday_price if yesterday_price > 0 else 0
-                    
-                    # Get metadata including the new fields (pe, tmax, tmin, nav)
-                    metadata = stock_data.get('metadata', self.metadata.get(stock_id, {}))
-                    
-                    # Create a summary with just the most recent values
-                    summary[stock_id] = {
-                        'pf': stock_data['pf'][-1] if stock_data.get('pf') and stock_data['pf'] else None,
-                        'pl': last_price,
-                        'pc': stock_data['pc'][-1] if stock_data.get('pc') and stock_data['pc'] else None,
-                        'tval': stock_data['tval'][-1] if stock_data.get('tval') and stock_data['tval'] else None,
-                        'py': yesterday_price,
-                        'pchange': price_change,
-                        'pmin': stock_data['pmin'][-1] if stock_data.get('pmin') and stock_data['pmin'] else None,
-                        'pmax': stock_data['pmax'][-1] if stock_data.get('pmax') and stock_data['pmax'] else None,
-                        
-                        # Add volume data
-                        'tvol': stock_data['tvol'][-1] if stock_data.get('tvol') and stock_data['tvol'] else None,
-                        
-                        # Add the order book data
-                        'qd1': stock_data['qd1'][-1] if stock_data.get('qd1') and stock_data['qd1'] else None,
-                        'pd1': stock_data['pd1'][-1] if stock_data.get('pd1') and stock_data['pd1'] else None,
-                        'qo1': stock_data['qo1'][-1] if stock_data.get('qo1') and stock_data['qo1'] else None,
-                        'po1': stock_data['po1'][-1] if stock_data.get('po1') and stock_data['po1'] else None,
-                        
-                        'metadata': metadata
-                    }
+                stock_summary = self._summarize(stock_id, stock_data)
+                if stock_summary is not None:
+                    summary[stock_id] = stock_summary
                     
             return summary
+    
+    async def get_committed_summary(self):
+        """The summary of every stock as of the last commit, never a cycle still being ingested"""
+        async with self._lock:
+            _, _, latest = self.committed
+            return {stock_id: self._summarize_row(stock_id, row) for stock_id, row in latest.items()}
+    
+    def _summarize_row(self, stock_id, row):
+        """The summary of one stock built from its latest-values row (caller must hold the lock)"""
+        stock_data = self.data.get(stock_id, {})
+        return {
+            **{field: row.get(field) for field in ('pf', 'pl', 'pc', 'tval', 'py', 'pchange', 'pmin', 'pmax', 'tvol',
+                                                   'qd1', 'pd1', 'qo1', 'po1')},
+            **{field: row.get(field) for field in BOOK_METRIC_FIELDS},
+            'metadata': stock_data.get('metadata', self.metadata.get(stock_id, {}))
+        }
+    
+    async def get_stocks_summary(self, stock_codes):
+        """Get the summary of several stocks under a single lock acquisition, skipping codes without data"""
+        async with self._lock:
+            summary = {}
+            for stock_id in stock_codes:
+                stock_summary = self._summarize(stock_id, self.data[stock_id]) if stock_id in self.data else None
+                if stock_summary is not None:
+                    summary[stock_id] = stock_summary
+            return summary
+    
+    def _summarize(self, stock_id, stock_data):
+        """The most recent values of one stock, or None if it has no data yet (caller must hold the lock)"""
+        if stock_data and stock_data.get('time') and stock_data['time']:
+            # Calculate price change
+            last_price = stock_data['pl'][-1] if stock_data.get('pl') and stock_data['pl'] else 0
+            yesterday_price = stock_data['py'][-1] if stock_data.get('py') and stock_data['py'] else 0
+            price_change = last_price - yesterday_price if yesterday_price > 0 else 0
+            
+            # Get metadata including the new fields (pe, tmax, tmin, nav)
+            metadata = stock_data.get('metadata', self.metadata.get(stock_id, {}))
+            
+            # Create a summary with just the most recent values
+            return {
+                'pf': stock_data['pf'][-1] if stock_data.get('pf') and stock_data['pf'] else None,
+                'pl': last_price,
+                'pc': stock_data['pc'][-1] if stock_data.get('pc') and stock_data['pc'] else None,
+                'tval': stock_data['tval'][-1] if stock_data.get('tval') and stock_data['tval'] else None,
+                'py': yesterday_price,
+                'pchange': price_change,
+                'pmin': stock_data['pmin'][-1] if stock_data.get('pmin') and stock_data['pmin'] else None,
+                'pmax': stock_data['pmax'][-1] if stock_data.get('pmax') and stock_data['pmax'] else None,
+                
+                # Add volume data
+                'tvol': stock_data['tvol'][-1] if stock_data.get('tvol') and stock_data['tvol'] else None,
+                
+                # Add the order book data
+                'qd1': stock_data['qd1'][-1] if stock_data.get('qd1') and stock_data['qd1'] else None,
+                'pd1': stock_data['pd1'][-1] if stock_data.get('pd1') and stock_data['pd1'] else None,
+                'qo1': stock_data['qo1'][-1] if stock_data.get('qo1') and stock_data['qo1'] else None,
+                'po1': stock_data['po1'][-1] if stock_data.get('po1') and stock_data['po1'] else None,
+                
+                # Add the order book metrics (spread, imbalance, queues)
+                **{field: stock_data[field][-1] if stock_data.get(field) else None for field in BOOK_METRIC_FIELDS},
+                
+                'metadata': metadata
+            }
+        return None
 def get_cache():
     """Get the singleton cache instance"""
     global _cache_instance
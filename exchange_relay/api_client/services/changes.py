@@ -0,0 +1,109 @@
+# api_client/services/changes.py
+import json
+import logging
+import math
+from datetime import datetime
+from typing import Optional, Tuple
+
+from rest_framework.utils.encoders import JSONEncoder
+
+from .cache_manager import get_cache
+
+logger = logging.getLogger(__name__)
+
+
+class ChangesQueryError(ValueError):
+    """Raised when a changes request can't be parsed"""
+
+
+def parse_since(value) -> Optional[int]:
+    """Parse a last-seen generation, None meaning the client has nothing yet"""
+    if value is None or value == '':
+        return None
+    try:
+        since = int(value)
+    except (TypeError, ValueError):
+        raise ChangesQueryError(f"Invalid generation: {value}")
+    if since < 0:
+        raise ChangesQueryError("Generation must not be negative")
+    return since
+
+
+def parse_timeout(value, max_timeout: float) -> float:
+    """Parse a long-poll timeout in seconds, clamped to [0, max_timeout]"""
+    if value is None or value == '':
+        return max_timeout
+    try:
+        timeout = float(value)
+    except (TypeError, ValueError):
+        raise ChangesQueryError(f"Invalid timeout: {value}")
+    if not math.isfinite(timeout):
+        raise ChangesQueryError(f"Invalid timeout: {value}")
+    return min(max(timeout, 0.0), max_timeout)
+
+
+class ChangeFeed:
+    """The instruments that changed since a given generation, for the HTTP change endpoints.
+
+    A change message is rendered once per (since, generation) and shared by
+    every long-poll and SSE client asking the same, which after the first
+    cycle is nearly all of them. A client with no generation, or with one
+    from before a restart (newer than the cache), gets the full snapshot.
+    """
+
+    def __init__(self, max_rendered: int = 8):
+        self.cache_instance = get_cache()
+        self.max_rendered = max_rendered
+        # (since, generation) -> encoded message
+        self._rendered = {}
+        self.renders = 0
+
+    async def changes_since(self, since: Optional[int]) -> Tuple[int, str]:
+        """Return the current generation and the encoded changes message"""
+        # Read the generation before the versions, so nothing committed in between is missed next time
+        generation = self.cache_instance.generation
+        full = since is None or since > generation
+        key = (None if full else since, generation)
+        payload = self._rendered.get(key)
+        if payload is not None:
+            return generation, payload
+
+        if full:
+            data = await self.cache_instance.get_all_stocks_summary()
+        else:
+            versions = dict(self.cache_instance.versions)
+            changed = [stock_id for stock_id, version in versions.items() if version > since]
+            data = await self.cache_instance.get_stocks_summary(changed) if changed else {}
+
+        payload = json.dumps({
+            'type': 'changes',
+            'generation': generation,
+            'since': None if full else since,
+            'full': full,
+            'timestamp': datetime.now().isoformat(),
+            'count': len(data),
+            'data': data
+        }, cls=JSONEncoder, ensure_ascii=False, separators=(',', ':'))
+        # Only the latest generations are asked for again
+        if len(self._rendered) >= self.max_rendered:
+            for old_key in sorted(self._rendered, key=lambda k: k[1])[:len(self._rendered) - self.max_rendered + 1]:
+                del self._rendered[old_key]
+        self._rendered[key] = payload
+        self.renders += 1
+        return generation, payload
+
+
+def sse_event(generation: int, payload: str) -> str:
+    """Frame a changes message as a Server-Sent Event whose id is its generation"""
+    return f'id: {generation}\nevent: changes\ndata: {payload}\n\n'
+
+
+# Global singleton instance
+_change_feed = None
+
+def get_change_feed():
+    """Get the singleton change feed"""
+    global _change_feed
+    if _change_feed is None:
+        _change_feed = ChangeFeed()
+    return _change_feed
@@ -0,0 +1,164 @@
+# api_client/services/export.py
+import csv
+import io
+import logging
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+from rest_framework.utils.encoders import JSONEncoder
+
+from .history import HISTORY_FIELDS, parse_time
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+except ImportError:  # pyarrow is optional, the Arrow IPC export is unavailable without it
+    pyarrow = None
+
+logger = logging.getLogger(__name__)
+
+# Format -> (content type, file extension)
+EXPORT_FORMATS = {
+    'ndjson': ('application/x-ndjson', 'ndjson'),
+    'csv': ('text/csv; charset=utf-8', 'csv'),
+    'arrow': ('application/vnd.apache.arrow.stream', 'arrows'),
+}
+
+# Series holding booleans rather than numbers
+BOOLEAN_FIELDS = ('buy_queue', 'sell_queue')
+
+DEFAULT_CHUNK_ROWS = 5000
+
+
+class ExportQueryError(ValueError):
+    """Raised when an export request can't be parsed"""
+
+
+def parse_export_query(params, reference=None) -> Dict[str, Any]:
+    """Validate ?format=ndjson|csv|arrow&symbols=&fields=&from=&to= (every symbol and field by default)"""
+    export_format = params.get('format', 'ndjson')
+    if export_format not in EXPORT_FORMATS:
+        raise ExportQueryError(f"Unknown format {export_format}, expected one of {list(EXPORT_FORMATS)}")
+    if export_format == 'arrow' and pyarrow is None:
+        raise ExportQueryError("The arrow format needs pyarrow, which isn't installed")
+
+    symbols = params.get('symbols')
+    symbols = list(dict.fromkeys(symbol for symbol in symbols.split(',') if symbol)) if symbols else None
+    fields = params.get('fields')
+    fields = list(dict.fromkeys(field for field in fields.split(',') if field)) if fields else list(HISTORY_FIELDS)
+    unknown = [field for field in fields if field not in HISTORY_FIELDS]
+    if unknown:
+        raise ExportQueryError(f"Unknown fields {unknown}")
+    try:
+        start = parse_time(params.get('from'), reference)
+        end = parse_time(params.get('to'), reference)
+    except ValueError as e:
+        raise ExportQueryError(str(e))
+    if start is not None and end is not None and start > end:
+        raise ExportQueryError("'from' must not be after 'to'")
+    return {'format': export_format, 'symbols': symbols, 'fields': fields, 'start': start, 'end': end}
+
+
+async def iter_chunks(cache_instance, symbols: Optional[List[str]], fields: List[str], start=None, end=None,
+                      chunk_rows: int = DEFAULT_CHUNK_ROWS) -> AsyncIterator[Dict[str, List[Any]]]:
+    """Yield the samples of every symbol as columns of at most chunk_rows rows.
+
+    Each symbol is copied out of the cache a page at a time, so memory stays
+    bounded by the chunk size whatever the number of symbols or the length of
+    the session. Samples of a cycle still being ingested are left out.
+    """
+    _, committed_at, _ = cache_instance.committed
+    end = committed_at if end is None or (committed_at is not None and committed_at < end) else end
+    if symbols is None:
+        symbols = sorted(cache_instance.data)
+    chunk = _empty_chunk(fields)
+    for code in symbols:
+        offset = 0
+        while True:
+            wanted = chunk_rows - len(chunk['time'])
+            history = await cache_instance.get_stock_history(code, fields, start, end, offset, wanted)
+            if history is None:
+                break
+            times, columns = history
+            chunk['code'].extend([code] * len(times))
+            chunk['time'].extend(times)
+            for field in fields:
+                chunk[field].extend(columns[field])
+            offset += len(times)
+            if len(chunk['time']) >= chunk_rows:
+                yield chunk
+                chunk = _empty_chunk(fields)
+            if len(times) < wanted:
+                break
+    if chunk['time']:
+        yield chunk
+
+
+def _empty_chunk(fields):
+    return {'code': [], 'time': [], **{field: [] for field in fields}}
+
+
+async def iter_ndjson(chunks, fields) -> AsyncIterator[bytes]:
+    encoder = JSONEncoder(ensure_ascii=False, separators=(',', ':'))
+    async for chunk in chunks:
+        lines = []
+        for i, timestamp in enumerate(chunk['time']):
+            row = {'code': chunk['code'][i], 'time': timestamp.isoformat()}
+            for field in fields:
+                row[field] = chunk[field][i]
+            lines.append(encoder.encode(row))
+        yield ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+async def iter_csv(chunks, fields) -> AsyncIterator[bytes]:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(['code', 'time', *fields])
+    async for chunk in chunks:
+        columns = [chunk[field] for field in fields]
+        for i, timestamp in enumerate(chunk['time']):
+            writer.writerow([chunk['code'][i], timestamp.isoformat(), *(column[i] for column in columns)])
+        yield _drain(buffer).encode('utf-8')
+    # Header only, when there was nothing to export
+    tail = _drain(buffer)
+    if tail:
+        yield tail.encode('utf-8')
+
+
+async def iter_arrow(chunks, fields) -> AsyncIterator[bytes]:
+    """Arrow IPC stream: the schema, then one record batch per chunk"""
+    schema = pyarrow.schema([
+        ('code', pyarrow.string()),
+        ('time', pyarrow.timestamp('us')),
+        *((field, pyarrow.bool_() if field in BOOLEAN_FIELDS else pyarrow.float64()) for field in fields),
+    ])
+    sink = io.BytesIO()
+    writer = pyarrow.ipc.new_stream(sink, schema)
+    async for chunk in chunks:
+        batch = pyarrow.record_batch([chunk['code'], chunk['time'], *(chunk[field] for field in fields)], schema=schema)
+        writer.write_batch(batch)
+        yield _drain(sink)
+    writer.close()
+    yield _drain(sink)
+
+
+def _drain(buffer):
+    """Take what was written to an in-memory buffer so far and empty it"""
+    data = buffer.getvalue()
+    buffer.seek(0)
+    buffer.truncate()
+    return data
+
+
+ENCODERS = {
+    'ndjson': iter_ndjson,
+    'csv': iter_csv,
+    'arrow': iter_arrow,
+}
+
+
+def stream_export(cache_instance, query: Dict[str, Any], chunk_rows: int = DEFAULT_CHUNK_ROWS) -> AsyncIterator[bytes]:
+    """The encoded export as an async iterator of byte chunks, for a streaming response"""
+    logger.info(f"Exporting {len(query['symbols']) if query['symbols'] else 'all'} symbols "
+                f"x {len(query['fields'])} fields as {query['format']}")
+    chunks = iter_chunks(cache_instance, query['symbols'], query['fields'], query['start'], query['end'], chunk_rows)
+    return ENCODERS[query['format']](chunks, query['fields'])
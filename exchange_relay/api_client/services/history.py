@@ -0,0 +1,179 @@
+# api_client/services/history.py
+import math
+from bisect import bisect_left, bisect_right
+from datetime import datetime, time as dt_time
+from typing import Dict, Any, List, Optional
+
+from .order_book import BOOK_METRIC_FIELDS
+
+# Per-cycle series a history query may ask for
+HISTORY_FIELDS = (
+    'pl', 'pc', 'pf', 'py', 'pmax', 'pmin', 'tno', 'tvol', 'tval',
+    *(f'{side}{num}' for side in ('zd', 'qd', 'pd', 'po', 'qo', 'zo') for num in range(1, 6)),
+    *BOOK_METRIC_FIELDS,
+    'Buy_I_Volume', 'Buy_N_Volume', 'Sell_I_Volume', 'Sell_N_Volume',
+    'Buy_CountI', 'Buy_CountN', 'Sell_CountI', 'Sell_CountN',
+    'sa_kharid', 'sa_forosh', 'ghodratpol', 'vorodpol', 'Buy_N_Ratio',
+)
+
+# Fields returned when a query doesn't name any
+DEFAULT_HISTORY_FIELDS = ('pl', 'tno', 'tvol', 'tval')
+
+# Query parameters that switch the stock detail endpoint from the raw dump to a history query
+HISTORY_PARAMS = ('from', 'to', 'fields', 'step', 'agg', 'limit')
+
+
+class HistoryQueryError(ValueError):
+    """Raised when a history query can't be parsed"""
+
+
+def _mean(values):
+    return sum(values) / len(values)
+
+
+AGGREGATES = {
+    'last': lambda values: values[-1],
+    'mean': _mean,
+    'max': max,
+}
+
+
+def slice_series(stock_data: Dict[str, Any], fields: List[str],
+                 start: Optional[datetime] = None, end: Optional[datetime] = None,
+                 offset: int = 0, limit: Optional[int] = None):
+    """Copy the samples between start and end (inclusive) of the given fields.
+
+    Samples are found by bisecting the ascending 'time' series; offset and
+    limit then page through them. Every series has one sample per 'time',
+    None in cycles its source was missing. Returns (times, {field: values}).
+    """
+    times = stock_data.get('time') or []
+    count = len(times)
+    lo = bisect_left(times, start) if start is not None else 0
+    hi = bisect_right(times, end) if end is not None else count
+    lo = min(lo + offset, hi)
+    if limit is not None:
+        hi = min(hi, lo + limit)
+    columns = {field: (stock_data.get(field) or [])[lo:hi] for field in fields}
+    return times[lo:hi], columns
+
+
+def downsample(times: List[datetime], columns: Dict[str, List[Any]], step: float, agg: str):
+    """Aggregate samples into step-second buckets, each stamped with its start time"""
+    aggregate = AGGREGATES[agg]
+    bucket_times = []
+    bucket_columns = {field: [] for field in columns}
+    start = 0
+    for i in range(1, len(times) + 1):
+        if i < len(times) and times[i].timestamp() // step == times[start].timestamp() // step:
+            continue
+        bucket_times.append(datetime.fromtimestamp(times[start].timestamp() // step * step))
+        for field, values in columns.items():
+            present = [value for value in values[start:i] if value is not None]
+            bucket_columns[field].append(aggregate(present) if present else None)
+        start = i
+    return bucket_times, bucket_columns
+
+
+def parse_time(value: Optional[str], reference: Optional[datetime]) -> Optional[datetime]:
+    """Parse an ISO datetime, epoch seconds, or a time of day (HH:MM[:SS]) on the day of the latest sample.
+
+    Always returns a naive local datetime, like the sample times it's compared with;
+    ISO datetimes with an offset are converted to local time.
+    """
+    if value is None or value == '':
+        return None
+    value = str(value)
+    try:
+        seconds = float(value)
+    except ValueError:
+        pass
+    else:
+        if not math.isfinite(seconds):
+            raise HistoryQueryError(f"Invalid time: {value}")
+        try:
+            return datetime.fromtimestamp(seconds)
+        except (OverflowError, OSError, ValueError):
+            raise HistoryQueryError(f"Time out of range: {value}")
+    try:
+        parsed = datetime.fromisoformat(value)
+    except ValueError:
+        pass
+    else:
+        if parsed.tzinfo is not None:
+            try:
+                parsed = parsed.astimezone().replace(tzinfo=None)
+            except (OverflowError, OSError, ValueError):
+                raise HistoryQueryError(f"Time out of range: {value}")
+        return parsed
+    try:
+        time_of_day = dt_time.fromisoformat(value)
+    except ValueError:
+        raise HistoryQueryError(f"Invalid time: {value}, expected an ISO datetime, epoch seconds or HH:MM[:SS]")
+    return datetime.combine((reference or datetime.now()).date(), time_of_day)
+
+
+def parse_history_query(params, reference: Optional[datetime] = None) -> Dict[str, Any]:
+    """Validate the query parameters of a history request.
+
+    ``reference`` is the latest sample time, the day that time-of-day bounds refer to.
+    """
+    fields = params.get('fields')
+    fields = [field for field in fields.split(',') if field] if fields else list(DEFAULT_HISTORY_FIELDS)
+    unknown = [field for field in fields if field not in HISTORY_FIELDS]
+    if unknown:
+        raise HistoryQueryError(f"Unknown fields {unknown}")
+
+    start = parse_time(params.get('from'), reference)
+    end = parse_time(params.get('to'), reference)
+    if start is not None and end is not None and start > end:
+        raise HistoryQueryError("'from' must not be after 'to'")
+
+    step = params.get('step')
+    if step is not None:
+        try:
+            step = float(step)
+        except ValueError:
+            raise HistoryQueryError(f"Invalid step: {step}")
+        if not math.isfinite(step) or step <= 0:
+            raise HistoryQueryError("step must be a positive number of seconds")
+
+    agg = params.get('agg', 'last')
+    if agg not in AGGREGATES:
+        raise HistoryQueryError(f"Unknown aggregate {agg}, expected one of {list(AGGREGATES)}")
+
+    limit = params.get('limit')
+    if limit is not None:
+        try:
+            limit = int(limit)
+        except ValueError:
+            raise HistoryQueryError(f"Invalid limit: {limit}")
+        if limit <= 0:
+            raise HistoryQueryError("limit must be positive")
+
+    return {'fields': fields, 'start': start, 'end': end, 'step': step, 'agg': agg, 'limit': limit}
+
+
+def build_history(stock_code: str, times: List[datetime], columns: Dict[str, List[Any]],
+                  step: Optional[float] = None, agg: str = 'last', limit: Optional[int] = None) -> Dict[str, Any]:
+    """Downsample and trim sliced samples into the columnar history response.
+
+    ``columns`` holds one list per entry of ``fields``, aligned with ``time``.
+    The limit keeps the most recent rows.
+    """
+    if step:
+        times, columns = downsample(times, columns, step, agg)
+    truncated = limit is not None and len(times) > limit
+    if truncated:
+        times = times[-limit:]
+        columns = {field: values[-limit:] for field, values in columns.items()}
+    return {
+        'code': stock_code,
+        'step': step,
+        'agg': agg if step else None,
+        'count': len(times),
+        'truncated': truncated,
+        'fields': list(columns),
+        'time': [timestamp.isoformat() for timestamp in times],
+        'columns': list(columns.values())
+    }
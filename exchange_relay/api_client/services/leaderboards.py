@@ -0,0 +1,126 @@
+# api_client/services/leaderboards.py
+import heapq
+import logging
+from typing import Dict, Any, Optional, Iterable
+
+logger = logging.getLogger(__name__)
+
+LEADERBOARD_SIZE = 20
+
+# name -> (latest-values field, descending)
+BOARDS = {
+    'gainers': ('pchange_pct', True),
+    'losers': ('pchange_pct', False),
+    'most_active': ('tval', True),
+    'money_inflow': ('vorodpol', True),
+}
+
+
+class Leaderboard:
+    """Bounded top-N ranking that is updated only with the instruments that changed"""
+
+    def __init__(self, name: str, field: str, descending: bool = True, size: int = LEADERBOARD_SIZE):
+        self.name = name
+        self.field = field
+        self.descending = descending
+        self.size = size
+        # stock_id -> (sort key, stock_id), the key is negated for ascending boards
+        self.keys = {}
+        self.top = []
+        # Rendered entries, replaced as a whole so readers on other threads never see a half-updated board
+        self.entries = []
+
+    def _key(self, stock_id, value):
+        return (value if self.descending else -value, stock_id)
+
+    def update(self, rows: Dict[str, Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+        """Apply changed rows and return the rank changes, or None if the board didn't change"""
+        top_ids = set(self.top)
+        needs_full_rank = False
+
+        for stock_id, row in rows.items():
+            value = row.get(self.field) if row else None
+            old_key = self.keys.get(stock_id)
+            if value is None:
+                self.keys.pop(stock_id, None)
+                needs_full_rank = needs_full_rank or stock_id in top_ids
+                continue
+            new_key = self._key(stock_id, value)
+            self.keys[stock_id] = new_key
+            # A member that got worse may be overtaken by an instrument outside the board
+            if stock_id in top_ids and old_key is not None and new_key < old_key:
+                needs_full_rank = True
+
+        if needs_full_rank:
+            candidates = self.keys
+        else:
+            # Unchanged instruments outside the board can't have overtaken the current members
+            candidates = top_ids.union(stock_id for stock_id in rows if stock_id in self.keys)
+        new_top = heapq.nlargest(self.size, candidates, key=self.keys.__getitem__)
+
+        previous_ranks = {stock_id: rank for rank, stock_id in enumerate(self.top, 1)}
+        changes = [
+            {'id': stock_id, 'rank': rank, 'prev_rank': previous_ranks.get(stock_id)}
+            for rank, stock_id in enumerate(new_top, 1)
+            if previous_ranks.get(stock_id) != rank
+        ]
+        new_ids = set(new_top)
+        exited = [stock_id for stock_id in self.top if stock_id not in new_ids]
+        values_changed = any(stock_id in rows for stock_id in new_top)
+        self.top = new_top
+        self.entries = [
+            {'rank': rank, 'id': stock_id, 'value': self._value(stock_id)}
+            for rank, stock_id in enumerate(new_top, 1)
+        ]
+
+        if not changes and not exited and not values_changed:
+            return None
+        return {**self.snapshot(), 'changes': changes, 'exited': exited}
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Current board entries in rank order"""
+        return {
+            'board': self.name,
+            'field': self.field,
+            'entries': self.entries
+        }
+
+    def _value(self, stock_id):
+        value = self.keys[stock_id][0]
+        return value if self.descending else -value
+
+
+class LeaderboardSet:
+    def __init__(self, boards=BOARDS, size: int = LEADERBOARD_SIZE):
+        self.boards = {
+            name: Leaderboard(name, field, descending, size)
+            for name, (field, descending) in boards.items()
+        }
+        # (generation, board diffs) produced by the most recent cycle
+        self.last_changes = (0, {})
+
+    def update(self, rows: Dict[str, Dict[str, Any]], generation: int) -> Dict[str, Any]:
+        """Feed the rows of instruments that changed this cycle to every board"""
+        changes = {}
+        for name, board in self.boards.items():
+            diff = board.update(rows)
+            if diff:
+                changes[name] = diff
+        self.last_changes = (generation, changes)
+        logger.info(f"Leaderboards updated from {len(rows)} changed stocks, {len(changes)} boards changed")
+        return changes
+
+    def snapshot(self, names: Optional[Iterable[str]] = None) -> Dict[str, Any]:
+        names = self.boards if names is None else [name for name in names if name in self.boards]
+        return {name: self.boards[name].snapshot() for name in names}
+
+
+# Global singleton instance
+_leaderboards_instance = None
+
+def get_leaderboards():
+    """Get the singleton leaderboards instance"""
+    global _leaderboards_instance
+    if _leaderboards_instance is None:
+        _leaderboards_instance = LeaderboardSet()
+    return _leaderboards_instance
@@ -0,0 +1,93 @@
+# api_client/services/metadata_records.py
+import hashlib
+import json
+import sys
+from collections.abc import Mapping
+from typing import Any, Dict, Iterable
+
+# Fields of a stock's metadata record, in the order they're serialized
+METADATA_FIELDS = (
+    'name', 'Full_name', 'CGrValCot', 'industry_num', 'Exchange', 'valid', 'exchange_name', 'industry_name',
+    'pe', 'tmax', 'tmin', 'nav', 'is_san', 'gpe', 'min_lot', 'max_lot',
+)
+# Text fields default to '', the figures from the detail sources to None
+_DEFAULTS = {field: '' if i < 8 else None for i, field in enumerate(METADATA_FIELDS)}
+
+
+def intern_value(value):
+    """Share one copy of each distinct string, e.g. the industry and exchange names repeated across stocks"""
+    return sys.intern(value) if type(value) is str else value
+
+
+def compact_rows(rows: Dict[str, Dict[str, Any]], fields: Iterable[str]) -> Dict[str, Dict[str, Any]]:
+    """Keep only the given fields of each row of a metadata source, with its strings interned"""
+    fields = tuple(fields)
+    return {
+        intern_value(stock_id): {field: intern_value(row[field]) for field in fields if field in row}
+        for stock_id, row in rows.items() if isinstance(row, dict)
+    }
+
+
+class MetadataRecord(Mapping):
+    """One stock's metadata, held in slots instead of a dict.
+
+    Reads like the dict it replaces (``record['pe']``, ``record.get('pe')``,
+    ``dict(record)``, equality with dicts) and the JSON, orjson and msgpack
+    encoders serialize it as an object, so the same record is shared by the
+    metadata client, the cache and every payload built from them.
+    """
+
+    __slots__ = METADATA_FIELDS
+
+    def __init__(self, values: Mapping = None):
+        values = values or {}
+        for field in METADATA_FIELDS:
+            object.__setattr__(self, field, intern_value(values.get(field, _DEFAULTS[field])))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Metadata records are read-only, build a new one instead")
+
+    def __getitem__(self, field):
+        if field not in _DEFAULTS:
+            raise KeyError(field)
+        return getattr(self, field)
+
+    def __iter__(self):
+        return iter(METADATA_FIELDS)
+
+    def __len__(self):
+        return len(METADATA_FIELDS)
+
+    def __eq__(self, other):
+        if isinstance(other, MetadataRecord):
+            return self.values_tuple() == other.values_tuple()
+        return super().__eq__(other)
+
+    __hash__ = None
+
+    def __repr__(self):
+        return f'MetadataRecord({self.to_dict()!r})'
+
+    def values_tuple(self):
+        return tuple(getattr(self, field) for field in METADATA_FIELDS)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return dict(zip(METADATA_FIELDS, self.values_tuple()))
+
+
+# Shared by every stock that has no metadata yet
+EMPTY_METADATA = MetadataRecord()
+
+
+def plain(obj):
+    """Encoder fallback turning metadata records (or any other mapping) into dicts"""
+    if isinstance(obj, Mapping):
+        return dict(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def table_hash(table: Dict[str, Mapping]) -> str:
+    """Content hash of a metadata table, the same for equal content whatever the record type"""
+    return hashlib.sha1(
+        json.dumps(table, sort_keys=True, ensure_ascii=False, default=plain).encode('utf-8')
+    ).hexdigest()
@@ -0,0 +1,173 @@
+# api_client/services/metadata_search.py
+import logging
+import re
+from bisect import bisect_left
+from typing import Dict, Any, Iterable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_LIMIT = 20
+MAX_LIMIT = 200
+
+# Metadata fields returned for each match
+RESULT_FIELDS = ('name', 'Full_name', 'industry_num', 'industry_name', 'Exchange', 'exchange_name')
+
+# Arabic code points that have a Persian counterpart, and Arabic-Indic/Persian digits
+_CHAR_MAP = str.maketrans({
+    'ي': 'ی', 'ى': 'ی', 'ئ': 'ی', 'ك': 'ک', 'ة': 'ه', 'ۀ': 'ه',
+    'أ': 'ا', 'إ': 'ا', 'ٱ': 'ا', 'ؤ': 'و',
+    **{chr(0x0660 + i): str(i) for i in range(10)},
+    **{chr(0x06F0 + i): str(i) for i in range(10)},
+    # Zero-width non-joiner (نیم‌فاصله) separates words like a space
+    '‌': ' ',
+})
+# Harakat, superscript alef, tatweel and other marks that don't change the word
+_MARKS = re.compile('[ً-ٰٟـ‍‎‏]')
+_SPACES = re.compile(r'\s+')
+
+
+def normalize(text: Optional[str]) -> str:
+    """Fold Persian/Arabic spelling variants, digits, marks, case and spacing so lookups match what users type"""
+    if not text:
+        return ''
+    text = _MARKS.sub('', str(text).translate(_CHAR_MAP)).lower()
+    return _SPACES.sub(' ', text).strip()
+
+
+class SearchQueryError(ValueError):
+    """Raised when a metadata search can't be parsed"""
+
+
+class MetadataIndex:
+    """Secondary indexes over stock metadata, rebuilt whenever the metadata changes.
+
+    Names and full names are kept in sorted arrays of normalized keys (each
+    whole name plus every word in it), so a prefix lookup is a bisection and
+    a short scan. industry_num and Exchange get inverted indexes. Everything
+    is swapped in as one snapshot so searches never see a half-built index.
+    """
+
+    def __init__(self):
+        # (version, records, exact names, name keys, name ids, full name keys, full name ids, by industry, by exchange)
+        self._snapshot = (None, {}, {}, [], [], [], [], {}, {})
+
+    @property
+    def version(self):
+        return self._snapshot[0]
+
+    def rebuild(self, metadata: Dict[str, Dict[str, Any]], version=None):
+        # Matches are read from the metadata table itself, not from copies of it
+        records = metadata
+        exact = {}
+        name_keys, full_name_keys = [], []
+        by_industry, by_exchange = {}, {}
+        for stock_id, meta in metadata.items():
+            name = normalize(meta.get('name'))
+            if name:
+                exact.setdefault(name, []).append(stock_id)
+                name_keys.extend((key, stock_id) for key in _keys(name))
+            full_name = normalize(meta.get('Full_name'))
+            if full_name:
+                full_name_keys.extend((key, stock_id) for key in _keys(full_name))
+            by_industry.setdefault(str(meta.get('industry_num', '')), set()).add(stock_id)
+            by_exchange.setdefault(str(meta.get('Exchange', '')), set()).add(stock_id)
+
+        name_keys.sort()
+        full_name_keys.sort()
+        self._snapshot = (
+            version, records, exact,
+            [key for key, _ in name_keys], [stock_id for _, stock_id in name_keys],
+            [key for key, _ in full_name_keys], [stock_id for _, stock_id in full_name_keys],
+            by_industry, by_exchange,
+        )
+        logger.info(f"Metadata search indexes rebuilt for {len(metadata)} stocks (version {version})")
+
+    def search(self, q: Optional[str] = None, industry: Optional[str] = None, exchange: Optional[str] = None,
+               limit: int = DEFAULT_LIMIT) -> Dict[str, Any]:
+        """Stocks whose name or full name has a word starting with q, narrowed by industry and exchange.
+
+        Exact name matches come first, then name prefixes, then full-name prefixes.
+        """
+        try:
+            limit = max(1, min(int(limit), MAX_LIMIT))
+        except (TypeError, ValueError):
+            raise SearchQueryError(f"Invalid limit: {limit}")
+        (version, records, exact, name_keys, name_ids,
+         full_name_keys, full_name_ids, by_industry, by_exchange) = self._snapshot
+
+        allowed = None
+        if industry is not None:
+            allowed = by_industry.get(str(industry), set())
+        if exchange is not None:
+            exchange_ids = by_exchange.get(str(exchange), set())
+            allowed = exchange_ids if allowed is None else allowed & exchange_ids
+
+        prefix = normalize(q)
+        if prefix:
+            matches = _Matches(allowed, limit)
+            matches.extend(exact.get(prefix, ()))
+            matches.extend(_scan(name_keys, name_ids, prefix, matches))
+            matches.extend(_scan(full_name_keys, full_name_ids, prefix, matches))
+            ids = matches.ids
+        elif allowed is not None:
+            ids = sorted(allowed, key=lambda stock_id: normalize(records[stock_id]['name']))[:limit]
+        else:
+            raise SearchQueryError("One of q, industry or exchange is required")
+
+        return {
+            'version': version,
+            'count': len(ids),
+            'results': [_result(stock_id, records[stock_id]) for stock_id in ids]
+        }
+
+
+def _result(stock_id, meta) -> Dict[str, Any]:
+    return {'id': stock_id, **{field: meta.get(field, '') for field in RESULT_FIELDS}}
+
+
+class _Matches:
+    """Ordered, de-duplicated, filtered ids, up to a limit"""
+
+    def __init__(self, allowed, limit):
+        self.allowed = allowed
+        self.limit = limit
+        self.ids = []
+        self._seen = set()
+
+    @property
+    def full(self):
+        return len(self.ids) >= self.limit
+
+    def extend(self, stock_ids: Iterable[str]):
+        for stock_id in stock_ids:
+            if self.full:
+                return
+            if stock_id in self._seen or (self.allowed is not None and stock_id not in self.allowed):
+                continue
+            self._seen.add(stock_id)
+            self.ids.append(stock_id)
+
+
+def _keys(text: str) -> List[str]:
+    """The whole normalized text, and each word after the first, as prefix keys"""
+    words = text.split(' ')
+    return [text, *words[1:]]
+
+
+def _scan(keys: List[str], ids: List[str], prefix: str, matches: _Matches):
+    """Ids whose key starts with prefix, in key order, until the matches are full"""
+    i = bisect_left(keys, prefix)
+    while i < len(keys) and keys[i].startswith(prefix) and not matches.full:
+        yield ids[i]
+        i += 1
+
+
+# Global singleton instance
+_metadata_index = None
+
+def get_metadata_index():
+    """Get the singleton metadata search index"""
+    global _metadata_index
+    if _metadata_index is None:
+        _metadata_index = MetadataIndex()
+    return _metadata_index
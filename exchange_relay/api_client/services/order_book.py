@@ -0,0 +1,49 @@
+# api_client/services/order_book.py
+from typing import Dict, Any, Optional, Sequence
+
+# Derived series computed from the five best-limit levels on every cycle
+BOOK_METRIC_FIELDS = (
+    'spread', 'mid', 'imbalance', 'bid_depth', 'ask_depth',
+    'buy_queue', 'sell_queue', 'buy_queue_value', 'sell_queue_value',
+)
+
+# Closer levels count more towards the imbalance (1, 1/2, ... 1/5)
+LEVEL_WEIGHTS = tuple(1.0 / level for level in range(1, 6))
+
+
+def compute_book_metrics(bid_prices: Sequence[float], bid_volumes: Sequence[float],
+                         ask_prices: Sequence[float], ask_volumes: Sequence[float],
+                         tmax: Optional[float] = None, tmin: Optional[float] = None) -> Dict[str, Any]:
+    """Compute microstructure metrics from best-limit levels ordered from level 1 to 5.
+
+    A buy queue is a best bid sitting at the daily upper limit (tmax) and a sell
+    queue a best ask at the lower limit (tmin); queue values are in rials.
+    """
+    best_bid = bid_prices[0] if bid_prices else 0
+    best_ask = ask_prices[0] if ask_prices else 0
+    best_bid_volume = bid_volumes[0] if bid_volumes else 0
+    best_ask_volume = ask_volumes[0] if ask_volumes else 0
+
+    has_bid = best_bid > 0 and best_bid_volume > 0
+    has_ask = best_ask > 0 and best_ask_volume > 0
+
+    bid_depth = sum(bid_volumes)
+    ask_depth = sum(ask_volumes)
+    weighted_bid = sum(w * v for w, v in zip(LEVEL_WEIGHTS, bid_volumes))
+    weighted_ask = sum(w * v for w, v in zip(LEVEL_WEIGHTS, ask_volumes))
+    weighted_total = weighted_bid + weighted_ask
+
+    buy_queue = bool(has_bid and tmax and best_bid >= tmax)
+    sell_queue = bool(has_ask and tmin and best_ask <= tmin)
+
+    return {
+        'spread': best_ask - best_bid if has_bid and has_ask else None,
+        'mid': (best_ask + best_bid) / 2 if has_bid and has_ask else None,
+        'imbalance': (weighted_bid - weighted_ask) / weighted_total if weighted_total else None,
+        'bid_depth': bid_depth,
+        'ask_depth': ask_depth,
+        'buy_queue': buy_queue,
+        'sell_queue': sell_queue,
+        'buy_queue_value': best_bid * best_bid_volume if buy_queue else 0,
+        'sell_queue_value': best_ask * best_ask_volume if sell_queue else 0,
+    }
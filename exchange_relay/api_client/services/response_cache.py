@@ -0,0 +1,144 @@
+# api_client/services/response_cache.py
+import asyncio
+import gzip
+import hashlib
+import json
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, NamedTuple
+
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.http import http_date, parse_etags, parse_http_date_safe
+from rest_framework.utils.encoders import JSONEncoder
+
+try:
+    import brotli
+except ImportError:  # brotli is optional, responses are offered gzip-compressed only without it
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+
+class RenderedResponse(NamedTuple):
+    # What the body was rendered from, e.g. the cache generation
+    version: Any
+    etag: str
+    # Epoch seconds of the last render whose content differed from the one before
+    last_modified: float
+    # content-coding -> body
+    bodies: Dict[str, bytes]
+
+
+class ResponseCache:
+    """JSON responses rendered once per version and kept compressed.
+
+    Each key is rendered, serialized and compressed the first time it's asked
+    for at a new version; every other request is answered from the stored
+    bodies. The ETag is a hash of the content, so a new version with the same
+    content keeps its ETag and conditional requests keep getting 304s.
+    """
+
+    def __init__(self, gzip_level: int = 6, brotli_quality: int = 5):
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+        self._entries = {}
+        # key -> (loop, version, render task), so concurrent requests share one render
+        self._inflight = {}
+        self.renders = 0
+
+    async def get(self, key: str, version: Any, render: Callable[[], Awaitable[Any]]) -> RenderedResponse:
+        entry = self._entries.get(key)
+        if entry is not None and entry.version == version:
+            return entry
+        loop = asyncio.get_running_loop()
+        inflight = self._inflight.get(key)
+        if inflight is None or inflight[0] is not loop or inflight[1] != version:
+            inflight = self._inflight[key] = (loop, version, asyncio.ensure_future(self._render(key, version, render)))
+        # Shielded so a client that goes away doesn't cancel the render the others are waiting on
+        return await asyncio.shield(inflight[2])
+
+    async def _render(self, key, version, render) -> RenderedResponse:
+        try:
+            body = json.dumps(await render(), cls=JSONEncoder, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+            etag = f'"{hashlib.sha1(body).hexdigest()[:20]}"'
+            previous = self._entries.get(key)
+            last_modified = previous.last_modified if previous and previous.etag == etag else time.time()
+            bodies = {'identity': body, 'gzip': gzip.compress(body, self.gzip_level, mtime=0)}
+            if brotli is not None:
+                bodies['br'] = brotli.compress(body, quality=self.brotli_quality)
+            entry = self._entries[key] = RenderedResponse(version, etag, last_modified, bodies)
+            self.renders += 1
+            logger.info(f"Rendered {key} response (version {version}, {len(body)} bytes, gzip {len(bodies['gzip'])})")
+            return entry
+        finally:
+            if self._inflight.get(key, (None, None, None))[2] is asyncio.current_task():
+                del self._inflight[key]
+
+
+def _accepted_codings(header: str) -> Dict[str, float]:
+    """Parse Accept-Encoding into {coding: q}"""
+    codings = {}
+    for part in header.split(','):
+        coding, _, params = part.strip().partition(';')
+        if not coding:
+            continue
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        codings[coding.strip().lower()] = q
+    return codings
+
+
+def choose_coding(accept_encoding: str, available) -> str:
+    """Pick the smallest body the client accepts: brotli, then gzip, then identity"""
+    accepted = _accepted_codings(accept_encoding)
+    for coding in ('br', 'gzip'):
+        if coding in available and accepted.get(coding, accepted.get('*', 0)) > 0:
+            return coding
+    return 'identity'
+
+
+def is_not_modified(request, entry: RenderedResponse) -> bool:
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match:
+        etags = parse_etags(if_none_match)
+        # Weak comparison, as for GET; If-Modified-Since is ignored when If-None-Match is sent
+        return '*' in etags or entry.etag in (etag.removeprefix('W/') for etag in etags)
+    if_modified_since = parse_http_date_safe(request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+    return if_modified_since is not None and int(entry.last_modified) <= if_modified_since
+
+
+def cached_response(request, entry: RenderedResponse) -> HttpResponse:
+    """Answer a request from a rendered response, with a 304 when the client's copy is current"""
+    if is_not_modified(request, entry):
+        response = HttpResponseNotModified()
+    else:
+        coding = choose_coding(request.META.get('HTTP_ACCEPT_ENCODING', ''), entry.bodies)
+        response = HttpResponse(entry.bodies[coding], content_type='application/json')
+        if coding != 'identity':
+            response['Content-Encoding'] = coding
+    response['ETag'] = entry.etag
+    response['Last-Modified'] = http_date(entry.last_modified)
+    response['Vary'] = 'Accept-Encoding'
+    # Clients may keep the body but must revalidate, the data moves every ingestion cycle
+    response['Cache-Control'] = 'no-cache'
+    return response
+
+
+# Global singleton instance
+_response_cache = None
+
+def get_response_cache():
+    """Get the singleton rendered-response cache"""
+    global _response_cache
+    if _response_cache is None:
+        _response_cache = ResponseCache(
+            gzip_level=getattr(settings, 'RESPONSE_GZIP_LEVEL', 6),
+            brotli_quality=getattr(settings, 'RESPONSE_BROTLI_QUALITY', 5)
+        )
+    return _response_cache
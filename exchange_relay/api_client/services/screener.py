@@ -0,0 +1,170 @@
+# api_client/services/screener.py
+import logging
+import operator
+from typing import Dict, Any, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Keys that get a presorted index each cycle so top-N queries never sort the whole market
+SORT_KEYS = (
+    'tval', 'tvol', 'tno', 'pl', 'pchange', 'pchange_pct', 'ghodratpol', 'Buy_N_Ratio',
+    'buy_queue_value', 'sell_queue_value', 'imbalance',
+)
+
+OPERATORS = {
+    'gt': operator.gt,
+    'gte': operator.ge,
+    'lt': operator.lt,
+    'lte': operator.le,
+    'eq': operator.eq,
+    'ne': operator.ne,
+}
+
+DEFAULT_LIMIT = 20
+MAX_LIMIT = 500
+
+
+class ScreenerError(ValueError):
+    """Raised when a screener query can't be parsed"""
+
+
+def _parse_value(value):
+    """Parse a filter operand: '@field' references another field, otherwise a number or boolean"""
+    if isinstance(value, str):
+        if value.startswith('@'):
+            return None, value[1:]
+        if value.lower() in ('true', 'false'):
+            return value.lower() == 'true', None
+        try:
+            return float(value), None
+        except ValueError:
+            raise ScreenerError(f"Invalid filter value: {value}")
+    return value, None
+
+
+def compile_filter(spec):
+    """Compile a filter given as 'field:op:value' or {'field', 'op', 'value'} into a predicate"""
+    if isinstance(spec, str):
+        parts = spec.split(':', 2)
+        if len(parts) != 3:
+            raise ScreenerError(f"Filter must look like field:op:value, got {spec}")
+        field, op_name, raw_value = parts
+    elif isinstance(spec, dict):
+        field, op_name, raw_value = spec.get('field'), spec.get('op'), spec.get('value')
+    else:
+        raise ScreenerError(f"Unsupported filter: {spec}")
+
+    if not field:
+        raise ScreenerError("Filter is missing a field")
+    if op_name not in OPERATORS:
+        raise ScreenerError(f"Unknown operator {op_name}, expected one of {sorted(OPERATORS)}")
+
+    op = OPERATORS[op_name]
+    value, ref_field = _parse_value(raw_value)
+
+    def predicate(row):
+        left = row.get(field)
+        right = row.get(ref_field) if ref_field else value
+        if left is None or right is None:
+            return False
+        try:
+            return op(left, right)
+        except TypeError:
+            return False
+
+    return predicate
+
+
+def compile_filters(specs) -> List:
+    """Compile a list of filter specs, accepting a single spec as well"""
+    if not specs:
+        return []
+    if isinstance(specs, (str, dict)):
+        specs = [specs]
+    return [compile_filter(spec) for spec in specs]
+
+
+def parse_fields(fields) -> Optional[List[str]]:
+    """Accept a list of field names or a comma-separated string, None meaning every field"""
+    if not fields:
+        return None
+    if isinstance(fields, str):
+        fields = [field for field in fields.split(',') if field]
+    if not isinstance(fields, list) or not all(isinstance(field, str) and field for field in fields):
+        raise ScreenerError("fields must be a list of field names or a comma-separated string")
+    return fields or None
+
+
+class StockScreener:
+    def __init__(self):
+        # (generation, rows, sort indexes) swapped as a whole so queries see one consistent cycle
+        self._snapshot = (0, {}, {})
+
+    @property
+    def generation(self):
+        return self._snapshot[0]
+
+    def rebuild(self, latest: Dict[str, Dict[str, Any]], generation: int):
+        """Rebuild the sort indexes from the latest-values table, called once per ingestion cycle"""
+        rows = dict(latest)
+        indexes = {}
+        for key in SORT_KEYS:
+            ranked = [(row[key], stock_id) for stock_id, row in rows.items() if row.get(key) is not None]
+            ranked.sort(reverse=True)
+            indexes[key] = [stock_id for _, stock_id in ranked]
+        self._snapshot = (generation, rows, indexes)
+        logger.info(f"Screener indexes rebuilt for {len(rows)} stocks (generation {generation})")
+
+    def query(self, filters=None, sort: str = 'tval', order: str = 'desc',
+              limit: int = DEFAULT_LIMIT, fields: Optional[List[str]] = None) -> Dict[str, Any]:
+        """Run a screener query against the latest cycle"""
+        if order not in ('asc', 'desc'):
+            raise ScreenerError(f"Order must be 'asc' or 'desc', got {order}")
+        try:
+            limit = max(1, min(int(limit), MAX_LIMIT))
+        except (TypeError, ValueError):
+            raise ScreenerError(f"Invalid limit: {limit}")
+
+        predicates = compile_filters(filters)
+        fields = parse_fields(fields)
+        generation, rows, indexes = self._snapshot
+
+        if sort in indexes:
+            ordered = indexes[sort] if order == 'desc' else reversed(indexes[sort])
+        else:
+            # Unindexed keys still work, they just pay for a full sort
+            ranked = [stock_id for stock_id, row in rows.items() if row.get(sort) is not None]
+            try:
+                ranked.sort(key=lambda stock_id: rows[stock_id][sort], reverse=(order == 'desc'))
+            except TypeError:
+                raise ScreenerError(f"Field {sort} is not sortable")
+            ordered = ranked
+
+        results = []
+        for stock_id in ordered:
+            row = rows[stock_id]
+            if all(predicate(row) for predicate in predicates):
+                if fields:
+                    row = {field: row.get(field) for field in fields}
+                results.append({'id': stock_id, **row})
+                if len(results) >= limit:
+                    break
+
+        return {
+            'generation': generation,
+            'sort': sort,
+            'order': order,
+            'count': len(results),
+            'results': results
+        }
+
+
+# Global singleton instance
+_screener_instance = None
+
+def get_screener():
+    """Get the singleton screener instance"""
+    global _screener_instance
+    if _screener_instance is None:
+        _screener_instance = StockScreener()
+    return _screener_instance
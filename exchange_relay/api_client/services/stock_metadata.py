@@ -7,8 +7,16 @@ from datetime import datetime, timedelta, time
 import pytz
 from typing import Dict, Any, List, Optional
 
+from .metadata_records import MetadataRecord, compact_rows, table_hash
+
 logger = logging.getLogger(__name__)
 
+# The fields read from each source, the rest of each response isn't kept
+METADATA_SOURCE_FIELDS = ('name', 'Full_name', 'CGrValCot', 'industry_num', 'Exchange', 'valid', 'exchange_name', 'industry_name')
+DETAIL_SOURCE_FIELDS = ('pe', 'tmaxp', 'tmax', 'tminp', 'tmin', 'nav')
+STATIC_DETAIL_SOURCE_FIELDS = ('is_san', 'gpe')
+LIVE_IDS_SOURCE_FIELDS = ('name', 'Full_name', 'min_lot', 'max_lot')
+
 class StockMetadataClient:
     def __init__(self):
         self.metadata_url = "http://213.232.126.219:2624/dideban/livetseactiveids/"
@@ -22,6 +30,15 @@ class StockMetadataClient:
         self.detail_data = {}
         self.static_detail_data = {}  # Add this to store the static details
         self.live_ids_data = {}  # Add this to store the live IDs data
+        # Bumped whenever the content of the metadata or live IDs data changes, so rendered copies know when they're stale
+        self.data_version = 0
+        # Bumped whenever the content of any of the four sources of the simplified metadata changes
+        self.sources_version = 0
+        # The metadata table, {stock_id: MetadataRecord}, rebuilt only when a source changes and handed out by reference
+        self.simplified = {}
+        self.simplified_version = 0
+        self.simplified_hash = None
+        self._simplified_sources = None
         self.update_interval = timedelta(days=1)
         self.iran_timezone = pytz.timezone('Asia/Tehran')
     
@@ -38,7 +55,12 @@ class StockMetadataClient:
                     
                     if isinstance(live_ids_data, list) and len(live_ids_data) > 0:
                         # The API returns a list with a single object where keys are stock IDs
-                        self.live_ids_data = live_ids_data[0]
+                        live_ids_data = compact_rows(live_ids_data[0], LIVE_IDS_SOURCE_FIELDS)
+                        # Fetched every minute, but only a change in content makes the copies stale
+                        if live_ids_data != self.live_ids_data:
+                            self.live_ids_data = live_ids_data
+                            self.data_version += 1
+                            self.sources_version += 1
                         logger.info(f"Successfully fetched live IDs for {len(self.live_ids_data)} stocks")
                         return self.live_ids_data
                     else:
@@ -64,7 +86,10 @@ class StockMetadataClient:
                     if isinstance(static_details_data, dict) and "time" in static_details_data:
                         # Remove the time field and store the rest
                         static_details_data.pop("time", None)
-                        self.static_detail_data = static_details_data
+                        static_details_data = compact_rows(static_details_data, STATIC_DETAIL_SOURCE_FIELDS)
+                        if static_details_data != self.static_detail_data:
+                            self.static_detail_data = static_details_data
+                            self.sources_version += 1
                         logger.info("Successfully fetched static details for %d stocks", len(self.static_detail_data))
                     else:
                         logger.error("Invalid static details format received")
@@ -136,7 +161,11 @@ class StockMetadataClient:
                     metadata_list = response.json()
                     if metadata_list and isinstance(metadata_list, list) and len(metadata_list) > 0:
                         # First item in the list contains all stock metadata
-                        self.metadata = metadata_list[0]
+                        metadata = compact_rows(metadata_list[0], METADATA_SOURCE_FIELDS)
+                        if metadata != self.metadata:
+                            self.metadata = metadata
+                            self.data_version += 1
+                            self.sources_version += 1
                         # Also fetch the details data with PE, tmax, tmin, NAV
                         await self.fetch_stock_details()
                         # Also fetch static details with is_san and gpe
@@ -178,7 +207,10 @@ class StockMetadataClient:
                         for stock_id, stock_data in details_data.items():
                             if 'nav' in stock_data and stock_data['nav'] == '-':
                                 stock_data['nav'] = None
-                        self.detail_data = details_data
+                        details_data = compact_rows(details_data, DETAIL_SOURCE_FIELDS)
+                        if details_data != self.detail_data:
+                            self.detail_data = details_data
+                            self.sources_version += 1
                         logger.info("Successfully fetched details for %d stocks", len(self.detail_data))
                     else:
                         logger.error("Invalid details format received")
@@ -200,143 +232,82 @@ class StockMetadataClient:
         return None
     
     def get_simplified_metadata(self) -> Dict[str, Dict[str, Any]]:
-        """Get simplified metadata with only the needed fields, including PE, tmax, tmin, NAV, min_lot, max_lot"""
+        """Get simplified metadata with only the needed fields, including PE, tmax, tmin, NAV, min_lot, max_lot
+
+        The join of the four sources is only redone after the content of one
+        of them changed, and its result is kept as long as its content hash is
+        the same, so callers get the very same dict every cycle in between.
+        """
+        if self._simplified_sources == self.sources_version:
+            return self.simplified
+        self._simplified_sources = self.sources_version
+        simplified = self._build_simplified_metadata()
+        content_hash = table_hash(simplified)
+        if content_hash != self.simplified_hash:
+            self.simplified = simplified
+            self.simplified_hash = content_hash
+            self.simplified_version += 1
+            logger.info(f"Simplified metadata is now version {self.simplified_version} ({content_hash[:12]})")
+        return self.simplified
+
+    def _build_simplified_metadata(self) -> Dict[str, MetadataRecord]:
+        """Join metadata, details, static details and live IDs into one record per valid stock"""
         simplified = {}
         logger.info(f"Creating simplified metadata with {len(self.metadata)} stocks and {len(self.detail_data)} detail records")
         
         for stock_id, data in self.metadata.items():
             if data.get('valid') == '1':  # Only include valid stocks
-                stock_info = {
-                    'name': data.get('name', ''),
-                    'Full_name': data.get('Full_name', ''),
-                    'industry_num': data.get('industry_num', ''),
-                    'Exchange': data.get('Exchange', ''),
-                    'valid': data.get('valid', ''),
-                    'exchange_name': data.get('exchange_name', ''),
-                    'industry_name': data.get('industry_name', ''),
-                }
-                
-                # Add the additional details if available
-                detail = self.get_stock_detail(stock_id)
-                if detail:
-                    # Try different field names that might be in the API response
-                    pe_value = detail.get('pe', None)
-                    if pe_value == "nan" or pe_value == "inf" or pe_value == "-inf":
-                        pe_value = None
-                        
-                    tmax_value = detail.get('tmaxp', detail.get('tmax', None))
-                    tmin_value = detail.get('tminp', detail.get('tmin', None))
-                    nav_value = detail.get('nav', None)
-                    
-                    stock_info.update({
-                        'pe': pe_value,
-                        'tmax': tmax_value,
-                        'tmin': tmin_value, 
-                        'nav': nav_value
-                    })
-                else:
-                    stock_info.update({
-                        'pe': None,
-                        'tmax': None,
-                        'tmin': None,
-                        'nav': None
-                    })
-                
-                # Add static details if available
-                static_detail = self.get_static_stock_detail(stock_id)
-                if static_detail:
-                    stock_info.update({
-                        'is_san': static_detail.get('is_san', None),
-                        'gpe': static_detail.get('gpe', None)
-                    })
-                else:
-                    stock_info.update({
-                        'is_san': None,
-                        'gpe': None
-                    })
-                
-                # Add min_lot and max_lot from live IDs data
-                live_id_data = self.get_stock_live_id_data(stock_id)
-                if live_id_data:
-                    stock_info.update({
-                        'min_lot': live_id_data.get('min_lot', None),
-                        'max_lot': live_id_data.get('max_lot', None)
-                    })
-                else:
-                    stock_info.update({
-                        'min_lot': None,
-                        'max_lot': None
-                    })
-                
-                simplified[stock_id] = stock_info
+                simplified[stock_id] = self._build_record(stock_id, data)
                 
         logger.info(f"Created simplified metadata with {len(simplified)} valid stocks")
         return simplified
+
+    def _build_record(self, stock_id: str, data: Dict[str, Any]) -> MetadataRecord:
+        """One stock's metadata record from its row in each source"""
+        stock_info = {field: data.get(field, '') for field in METADATA_SOURCE_FIELDS}
+        
+        # Add the additional details if available
+        detail = self.get_stock_detail(stock_id)
+        if detail:
+            # Try different field names that might be in the API response
+            pe_value = detail.get('pe', None)
+            if pe_value == "nan" or pe_value == "inf" or pe_value == "-inf":
+                pe_value = None
+            stock_info.update({
+                'pe': pe_value,
+                'tmax': detail.get('tmaxp', detail.get('tmax', None)),
+                'tmin': detail.get('tminp', detail.get('tmin', None)),
+                'nav': detail.get('nav', None)
+            })
+        
+        # Add static details if available
+        static_detail = self.get_static_stock_detail(stock_id)
+        if static_detail:
+            stock_info.update({
+                'is_san': static_detail.get('is_san', None),
+                'gpe': static_detail.get('gpe', None)
+            })
+        
+        # Add min_lot and max_lot from live IDs data
+        live_id_data = self.get_stock_live_id_data(stock_id)
+        if live_id_data:
+            stock_info.update({
+                'min_lot': live_id_data.get('min_lot', None),
+                'max_lot': live_id_data.get('max_lot', None)
+            })
+        
+        # Fields missing from every source default to '' (text) or None (figures)
+        return MetadataRecord(stock_info)
     
     def get_stock_metadata(self, stock_id: str) -> Dict[str, Any]:
         """Get metadata for a specific stock, including PE, tmax, tmin, NAV, min_lot, max_lot"""
-        result = {}
-        
+        record = self.get_simplified_metadata().get(stock_id)
+        if record is not None:
+            return record
+        # Stocks that aren't valid aren't in the table
         if stock_id in self.metadata:
-            data = self.metadata[stock_id]
-            result = {
-                'name': data.get('name', ''),
-                'Full_name': data.get('Full_name', ''),
-                'industry_num': data.get('industry_num', ''),
-                'Exchange': data.get('Exchange', ''),
-                'valid': data.get('valid', ''),
-                'exchange_name': data.get('exchange_name', ''),
-                'industry_name': data.get('industry_name', '')
-            }
-            
-            # Add the additional details if available
-            detail = self.get_stock_detail(stock_id)
-            if detail:
-                pe_value = detail.get('pe', None)
-                if pe_value == "nan" or pe_value == "inf" or pe_value == "-inf":
-                    pe_value = None
-                    
-                result.update({
-                    'pe': pe_value,
-                    'tmax': detail.get('tmaxp', None),
-                    'tmin': detail.get('tminp', None),
-                    'nav': detail.get('nav', None)
-                })
-            else:
-                result.update({
-                    'pe': None,
-                    'tmax': None,
-                    'tmin': None,
-                    'nav': None
-                })
-                
-            # Add static details if available
-            static_detail = self.get_static_stock_detail(stock_id)
-            if static_detail:
-                result.update({
-                    'is_san': static_detail.get('is_san', None),
-                    'gpe': static_detail.get('gpe', None)
-                })
-            else:
-                result.update({
-                    'is_san': None,
-                    'gpe': None
-                })
-                
-            # Add min_lot and max_lot from live IDs data
-            live_id_data = self.get_stock_live_id_data(stock_id)
-            if live_id_data:
-                result.update({
-                    'min_lot': live_id_data.get('min_lot', None),
-                    'max_lot': live_id_data.get('max_lot', None)
-                })
-            else:
-                result.update({
-                    'min_lot': None,
-                    'max_lot': None
-                })
-                
-        return result
+            return self._build_record(stock_id, self.metadata[stock_id])
+        return {}
     
     def get_all_ids_and_names(self) -> Dict[str, Dict[str, str]]:
         """Get all stock IDs and names from the live IDs data"""
@@ -0,0 +1,102 @@
+# api_client/services/trade_tape.py
+import logging
+import threading
+from collections import deque
+from itertools import islice
+from typing import Dict, Any, Optional, List, Iterable
+
+logger = logging.getLogger(__name__)
+
+# Number of interval trade events kept in memory
+TAPE_SIZE = 20000
+
+
+class TradeTape:
+    """Bounded ring of synthetic trade events inferred by diffing cumulative snapshots"""
+
+    def __init__(self, size: int = TAPE_SIZE):
+        self.events = deque(maxlen=size)
+        self.seq = 0
+        # stock_id -> (tno, tvol, tval, pl, best_bid, best_ask) from the previous snapshot
+        self._last = {}
+        # The ring is appended from the fetcher thread and read from consumer threads
+        self._lock = threading.Lock()
+
+    def record(self, stock_id: str, time, tno: float, tvol: float, tval: float, pl: float,
+               best_bid: Optional[float] = None, best_ask: Optional[float] = None) -> Optional[Dict[str, Any]]:
+        """Diff a snapshot against the previous one and emit an event if trades happened in between"""
+        previous = self._last.get(stock_id)
+        self._last[stock_id] = (tno, tvol, tval, pl, best_bid, best_ask)
+
+        # The first snapshot is only a baseline, and falling totals mean a new session started
+        if previous is None or tno < previous[0]:
+            return None
+
+        count = tno - previous[0]
+        volume = tvol - previous[1]
+        value = tval - previous[2]
+        if count <= 0 or volume <= 0:
+            return None
+
+        vwap = value / volume
+        # Classify against the book that was standing before these trades happened
+        side = self._classify(vwap, pl, previous[3], previous[4], previous[5])
+
+        with self._lock:
+            self.seq += 1
+            event = {
+                'seq': self.seq,
+                'id': stock_id,
+                'time': time.isoformat(),
+                'count': count,
+                'volume': volume,
+                'value': value,
+                'vwap': vwap,
+                'last': pl,
+                'side': side,
+            }
+            self.events.append(event)
+        return event
+
+    @staticmethod
+    def _classify(vwap, last_price, previous_price, best_bid, best_ask):
+        """Estimate the aggressor side: quote rule first, then the tick rule"""
+        if best_ask and vwap >= best_ask:
+            return 'buy'
+        if best_bid and vwap <= best_bid:
+            return 'sell'
+        if best_bid and best_ask:
+            mid = (best_bid + best_ask) / 2
+            if vwap != mid:
+                return 'buy' if vwap > mid else 'sell'
+        if last_price != previous_price:
+            return 'buy' if last_price > previous_price else 'sell'
+        return 'unknown'
+
+    def since(self, seq: int, stock_ids: Optional[Iterable[str]] = None) -> Dict[str, Any]:
+        """Events after ``seq``, flagging a gap when older events were already evicted from the ring"""
+        stock_ids = set(stock_ids) if stock_ids else None
+        with self._lock:
+            last_seq = self.seq
+            first_seq = self.events[0]['seq'] if self.events else last_seq + 1
+            start = max(seq + 1 - first_seq, 0)
+            events: List[Dict[str, Any]] = list(islice(self.events, start, None))
+
+        if stock_ids is not None:
+            events = [event for event in events if event['id'] in stock_ids]
+        return {
+            'seq': last_seq,
+            'gap': seq + 1 < first_seq and seq < last_seq,
+            'events': events
+        }
+
+
+# Global singleton instance
+_trade_tape = None
+
+def get_trade_tape():
+    """Get the singleton trade tape instance"""
+    global _trade_tape
+    if _trade_tape is None:
+        _trade_tape = TradeTape()
+    return _trade_tape
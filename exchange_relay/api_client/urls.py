@@ -1,14 +1,22 @@
 from django.contrib import admin
 from django.urls import path, include
-from .views import DiagnosticView, DebugApiView, StockDataView, StockMetadataView, AllStocksSummaryView, StockIdsView
+from .views import DiagnosticView, DebugApiView, StockDataView, StockMetadataView, AllStocksSummaryView, StockIdsView, ScreenerView, StockBatchView, MetadataSearchView, ChangesView, ChangesStreamView, ExportView
 
 urlpatterns = [
     path('stocks/', StockDataView.as_view(), name='all-stocks'),
+    # Before stocks/<stock_code>/, which would otherwise match "summary" and "batch" as stock codes
+    path('stocks/summary/', AllStocksSummaryView.as_view(), name='all-stocks-summary'),
+    path('stocks/batch/', StockBatchView.as_view(), name='stocks-batch'),
     path('stocks/<str:stock_code>/', StockDataView.as_view(), name='stock-detail'),
     path('metadata/', StockMetadataView.as_view(), name='all-metadata'),
+    # Before metadata/<stock_id>/, which would otherwise match "search" as a stock id
+    path('metadata/search/', MetadataSearchView.as_view(), name='metadata-search'),
     path('metadata/<str:stock_id>/', StockMetadataView.as_view(), name='stock-metadata'),
     path('diagnostic/', DiagnosticView.as_view(), name='diagnostic'),
     path('debug/trigger-fetch/', DebugApiView.as_view(), name='debug-api'),
-    path('stocks/summary/', AllStocksSummaryView.as_view(), name='all-stocks-summary'),
     path('stock-ids/', StockIdsView.as_view(), name='stock-ids'),  # Add the new endpoint
+    path('screener/', ScreenerView.as_view(), name='screener'),
+    path('changes/', ChangesView.as_view(), name='changes'),
+    path('changes/stream/', ChangesStreamView.as_view(), name='changes-stream'),
+    path('export/', ExportView.as_view(), name='export'),
 ]
\ No newline at end of file
@@ -1,21 +1,36 @@
 # api_client/views.py
 from rest_framework.views import APIView
 from rest_framework.response import Response
+from rest_framework.utils.encoders import JSONEncoder
 from django.apps import apps
-import asyncio
-from django.http import JsonResponse  # Import jsonResponse
+from django.http import JsonResponse, HttpResponse, StreamingHttpResponse  # Import jsonResponse
 
 from api_client.services.stock_metadata import get_metadata_client
+from api_client.services.screener import get_screener, ScreenerError, DEFAULT_LIMIT
+from api_client.services.history import HISTORY_PARAMS, HistoryQueryError, parse_history_query, build_history
+from api_client.services.response_cache import get_response_cache, cached_response
+from api_client.services.batch import BatchQueryError, parse_batch_query, history_fields, build_batch
+from api_client.services.changes import ChangesQueryError, parse_since, parse_timeout, get_change_feed, sse_event
+from api_client.services.export import EXPORT_FORMATS, ExportQueryError, parse_export_query, stream_export
+from api_client.services.metadata_search import get_metadata_index, SearchQueryError, DEFAULT_LIMIT as DEFAULT_SEARCH_LIMIT
 
 
 from django.views import View
-from django.http import JsonResponse
-from django.apps import apps
+from django.conf import settings
+from django.utils.decorators import method_decorator
+from django.views.decorators.csrf import csrf_exempt
 import asyncio
+import json
 import traceback
 
+
+def _json_response(data, status=200):
+    """Render like DRF's JSONRenderer (its encoder, compact UTF-8) from the async views, which are plain Django views"""
+    return JsonResponse(data, status=status, safe=False, encoder=JSONEncoder,
+                        json_dumps_params={'ensure_ascii': False, 'separators': (',', ':')})
+
 class DebugApiView(View):
-    def get(self, request):
+    async def get(self, request):
         """View to manually trigger API fetch and see results"""
         try:
             # Import the API client
@@ -26,15 +41,21 @@ class DebugApiView(View):
             api_client = IranExchangeClient()
             cache = get_cache()
             
-            # Run the data fetch in the current thread (for debugging)
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
+            async def fetch_and_update():
+                data = await api_client.fetch_all_data()
+                if data:
+                    await cache.update_data(data)
+                return data
             
             try:
-                # Try to fetch data and update cache
-                data = loop.run_until_complete(api_client.fetch_all_data())
+                # Run the fetch on the fetcher thread's loop, like the scheduled ones,
+                # or on the request's loop when no fetcher thread was started
+                fetcher_loop = getattr(apps.get_app_config('api_client'), 'fetcher_loop', None)
+                if fetcher_loop is not None and fetcher_loop.is_running():
+                    data = await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(fetch_and_update(), fetcher_loop))
+                else:
+                    data = await fetch_and_update()
                 if data:
-                    loop.run_until_complete(cache.update_data(data))
                     result = {
                         'success': True,
                         'client_types': len(data.get('client_type', {})),
@@ -64,23 +85,31 @@ class DebugApiView(View):
             })
 
 
-class StockDataView(APIView):
+class StockDataView(View):
     """API view to get stock data from the cache"""
     
-    def get(self, request, stock_code=None):
+    async def get(self, request, stock_code=None):
         # Get the cache instance
         cache_instance = apps.get_app_config('api_client').cache_instance
         
-        # Use the event loop to run the async function
-        loop = asyncio.get_event_loop()
-        
-        if stock_code:
+        if stock_code and any(param in request.GET for param in HISTORY_PARAMS):
+            # History query: ?from=&to=&fields=&step=&agg=last|mean|max&limit=, answered in columns
+            try:
+                query = parse_history_query(request.GET, cache_instance.last_update)
+            except HistoryQueryError as e:
+                return _json_response({'error': str(e)}, status=400)
+            history = await cache_instance.get_stock_history(stock_code, query['fields'], query['start'], query['end'])
+            if history is None:
+                return _json_response({'error': f'Stock code {stock_code} not found'}, status=404)
+            times, columns = history
+            return _json_response(build_history(stock_code, times, columns, query['step'], query['agg'], query['limit']))
+        elif stock_code:
             # Get data for a specific stock
-            data = loop.run_until_complete(cache_instance.get_stock_data(stock_code))
-            return Response(data)
+            data = await cache_instance.get_stock_data(stock_code)
+            return _json_response(data)
         else:
-            # Get summary data for all stocks
-            all_data = loop.run_until_complete(cache_instance.get_all_data())
+            # Get summary data for all stocks; copied so the fetcher thread can add stocks meanwhile
+            all_data = dict(await cache_instance.get_all_data())
             # Create a summary to avoid huge payloads
             summary = {
                 code: {
@@ -89,22 +118,21 @@ class StockDataView(APIView):
                 } 
                 for code, data in all_data.items()
             }
-            return Response(summary)
+            return _json_response(summary)
 
 
 class DiagnosticView(View):
-    def get(self, request):
+    async def get(self, request):
         from api_client.services.cache_manager import get_cache
         cache_instance = get_cache()
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
         
         # Get a summary of the cache
-        all_data = loop.run_until_complete(cache_instance.get_all_data())
+        all_data = dict(await cache_instance.get_all_data())
         
         stats = {
             'total_stocks': len(all_data),
             'last_update': cache_instance.last_update.isoformat() if cache_instance.last_update else None,
+            'generation': cache_instance.generation,
             'sample_stocks': [],
         }
         
@@ -122,60 +150,224 @@ class DiagnosticView(View):
                 },
                 'last_price': data.get('pl', [-1])[-1] if data.get('pl') else None,
             })
-            
-
+        
+        return _json_response(stats)
     
 
-class StockMetadataView(APIView):
+class StockMetadataView(View):
     """API view to get stock metadata from the cache"""
     
-    def get(self, request, stock_id=None):
+    async def get(self, request, stock_id=None):
         # Get the cache instance
         cache_instance = apps.get_app_config('api_client').cache_instance
         
-        # Use the event loop to run the async function
-        loop = asyncio.get_event_loop()
-        
         if stock_id:
             # Get metadata for a specific stock
-            metadata = loop.run_until_complete(cache_instance.get_stock_metadata(stock_id))
-            return Response(metadata)
+            metadata = await cache_instance.get_stock_metadata(stock_id)
+            return _json_response(metadata)
         else:
-            # Get metadata for all stocks
-            all_metadata = loop.run_until_complete(cache_instance.get_all_metadata())
-            return Response(all_metadata)
+            # Get metadata for all stocks, rendered once per metadata change
+            entry = await get_response_cache().get(
+                'metadata', cache_instance.metadata_version, cache_instance.get_all_metadata
+            )
+            return cached_response(request, entry)
+
+
+class MetadataSearchView(View):
+    """Typeahead search over stock names and full names, filterable by industry and exchange
+
+    GET /api/metadata/search/?q=فولا&industry=27&exchange=1&limit=20
+    """
+
+    async def get(self, request):
+        try:
+            result = get_metadata_index().search(
+                q=request.GET.get('q'),
+                industry=request.GET.get('industry'),
+                exchange=request.GET.get('exchange'),
+                limit=request.GET.get('limit', DEFAULT_SEARCH_LIMIT)
+            )
+        except SearchQueryError as e:
+            return _json_response({'error': str(e)}, status=400)
+        return _json_response(result)
         
 # api_client/views.py - Add this view
 
-class AllStocksSummaryView(APIView):
+class AllStocksSummaryView(View):
     """API view to get a summary of all stocks"""
     
-    def get(self, request):
+    async def get(self, request):
         # Get the cache instance
         cache_instance = apps.get_app_config('api_client').cache_instance
         
-        # Use the event loop to run the async function
-        loop = asyncio.get_event_loop()
-        
-        # Get summary data for all stocks
-        summary = loop.run_until_complete(cache_instance.get_all_stocks_summary())
-        return Response(summary)
+        # Summary of all stocks as of the last commit, rendered and compressed once per generation
+        entry = await get_response_cache().get(
+            'summary', cache_instance.committed[0], cache_instance.get_committed_summary
+        )
+        return cached_response(request, entry)
     
     
 # Add this to api_client/views.py
 
 
-class StockIdsView(APIView):
+@method_decorator(csrf_exempt, name='dispatch')
+class StockBatchView(View):
+    """API view to get many stocks at once, all from the same committed cycle"""
+    
+    async def get(self, request):
+        # ?symbols=a,b,c&fields=pl,tvol&since=10:30
+        return await self._run_batch(request.GET)
+    
+    async def post(self, request):
+        # The JSON body accepts the same keys, with symbols and fields as lists
+        try:
+            body = json.loads(request.body or b'{}')
+        except ValueError:
+            return _json_response({'error': 'Invalid JSON body'}, status=400)
+        return await self._run_batch(body if isinstance(body, dict) else {})
+    
+    async def _run_batch(self, params):
+        cache_instance = apps.get_app_config('api_client').cache_instance
+        try:
+            query = parse_batch_query(params, getattr(settings, 'BATCH_MAX_SYMBOLS', 500), cache_instance.last_update)
+        except BatchQueryError as e:
+            return _json_response({'error': str(e)}, status=400)
+        # One lock acquisition for every symbol
+        generation, committed_at, rows, history = await cache_instance.get_committed_batch(
+            query['symbols'], history_fields(query['fields']), query['since']
+        )
+        return _json_response(build_batch(query['symbols'], query['fields'], generation, committed_at, rows, history))
+
+
+class ChangesView(View):
+    """Long-poll for the stocks that changed since a generation.
+    
+    GET ?since=<generation>&timeout=<seconds> answers as soon as a cycle newer
+    than ``since`` is committed, or with no changes when the timeout passes.
+    """
+    
+    async def get(self, request):
+        cache_instance = apps.get_app_config('api_client').cache_instance
+        max_timeout = getattr(settings, 'LONG_POLL_TIMEOUT', 30)
+        try:
+            since = parse_since(request.GET.get('since'))
+            timeout = parse_timeout(request.GET.get('timeout'), max_timeout)
+        except ChangesQueryError as e:
+            return _json_response({'error': str(e)}, status=400)
+        
+        # A generation ahead of ours comes from before a restart, it gets the full snapshot right away
+        if since is not None and since == cache_instance.generation:
+            # Sleeps on the commit notification, not a polling loop
+            await cache_instance.wait_for_update(since, timeout=timeout)
+        _, payload = await get_change_feed().changes_since(since)
+        return HttpResponse(payload, content_type='application/json')
+
+
+class ChangesStreamView(View):
+    """Server-Sent Events stream of the stocks that changed each cycle.
+    
+    Starts from ?since=<generation> or the Last-Event-ID a reconnecting browser
+    sends; without either the first event is the full snapshot.
+    """
+    
+    async def get(self, request):
+        try:
+            since = parse_since(request.GET.get('since', request.headers.get('Last-Event-ID')))
+        except ChangesQueryError as e:
+            return _json_response({'error': str(e)}, status=400)
+        response = StreamingHttpResponse(self._events(since), content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        # Keep reverse proxies from buffering the stream
+        response['X-Accel-Buffering'] = 'no'
+        return response
+    
+    async def _events(self, since):
+        cache_instance = apps.get_app_config('api_client').cache_instance
+        feed = get_change_feed()
+        heartbeat = getattr(settings, 'SSE_HEARTBEAT', 15)
+        
+        last = since
+        if last is None or last != cache_instance.generation:
+            last, payload = await feed.changes_since(since)
+            yield sse_event(last, payload)
+        while True:
+            generation = await cache_instance.wait_for_update(last, timeout=heartbeat)
+            if generation == last:
+                # Comment line so proxies and clients see the connection is alive
+                yield ': keepalive\n\n'
+                continue
+            last, payload = await feed.changes_since(last)
+            yield sse_event(last, payload)
+
+
+class ExportView(View):
+    """Streaming export of the session's samples, one row per stock and cycle.
+    
+    GET ?format=ndjson|csv|arrow&symbols=a,b&fields=pl,tvol&from=&to= streams
+    every symbol and field by default, in chunks of EXPORT_CHUNK_ROWS rows.
+    """
+    
+    async def get(self, request):
+        cache_instance = apps.get_app_config('api_client').cache_instance
+        try:
+            query = parse_export_query(request.GET, cache_instance.last_update)
+        except ExportQueryError as e:
+            return _json_response({'error': str(e)}, status=400)
+        content_type, extension = EXPORT_FORMATS[query['format']]
+        response = StreamingHttpResponse(
+            stream_export(cache_instance, query, getattr(settings, 'EXPORT_CHUNK_ROWS', 5000)),
+            content_type=content_type
+        )
+        response['Content-Disposition'] = f'attachment; filename="export-{cache_instance.generation}.{extension}"'
+        return response
+
+
+class StockIdsView(View):
     """API view to get stock IDs and names"""
     
-    def get(self, request):
+    async def get(self, request):
         # Get the metadata client
         metadata_client = get_metadata_client()
         
-        # Get all stock IDs and names
-        stock_ids_and_names = metadata_client.get_all_ids_and_names()
+        async def render():
+            # Get all stock IDs and names
+            stock_ids_and_names = metadata_client.get_all_ids_and_names()
+            return {
+                'count': len(stock_ids_and_names),
+                'data': stock_ids_and_names
+            }
         
-        return Response({
-            'count': len(stock_ids_and_names),
-            'data': stock_ids_and_names
-        })
\ No newline at end of file
+        # Rendered once per metadata or live IDs refresh
+        entry = await get_response_cache().get('stock-ids', metadata_client.data_version, render)
+        return cached_response(request, entry)
+
+class ScreenerView(APIView):
+    """API view to screen all stocks by filter predicates over the latest values"""
+    
+    def get(self, request):
+        # Filters come as repeated ?filter=field:op:value parameters
+        return self._run_query(
+            filters=request.query_params.getlist('filter'),
+            sort=request.query_params.get('sort', 'tval'),
+            order=request.query_params.get('order', 'desc'),
+            limit=request.query_params.get('limit', DEFAULT_LIMIT),
+            fields=request.query_params.get('fields')
+        )
+    
+    def post(self, request):
+        # The JSON body accepts the same keys, with filters as a list of strings or objects
+        # and fields as a list or a comma-separated string
+        body = request.data if isinstance(request.data, dict) else {}
+        return self._run_query(
+            filters=body.get('filters', []),
+            sort=body.get('sort', 'tval'),
+            order=body.get('order', 'desc'),
+            limit=body.get('limit', DEFAULT_LIMIT),
+            fields=body.get('fields')
+        )
+    
+    def _run_query(self, **query):
+        try:
+            return Response(get_screener().query(**query))
+        except ScreenerError as e:
+            return Response({'error': str(e)}, status=400)
@@ -0,0 +1,155 @@
+# Save this as benchmark_http.py in the exchange_relay directory
+# Load-tests the REST endpoints with concurrent HTTP clients and reports requests/s and
+# latency percentiles. By default the ASGI application is driven in-process with a
+# synthetic market, while a fetcher thread keeps ingesting cycles on its own event loop
+# the way the live server does; pass --url to load a running server instead.
+import os
+import sys
+import time
+import random
+import logging
+import asyncio
+import argparse
+import threading
+import django
+
+try:
+    import httpx
+except ImportError:
+    sys.exit("benchmark_http.py needs httpx: pip install httpx")
+
+# Set up Django environment
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'exchange_relay.settings')
+django.setup()
+
+# Import after Django setup
+from django.core.asgi import get_asgi_application
+from api_client.services.cache_manager import get_cache
+
+# Per-request and per-cycle log lines would dominate the measurements
+logging.disable(logging.INFO)
+
+ENDPOINTS = ('/api/stocks/summary/', '/api/stocks/', '/api/stocks/{stock}/', '/api/metadata/', '/api/diagnostic/')
+
+
+def make_cycle(stock_ids, state):
+    """Build one ingestion cycle shaped like IranExchangeClient.fetch_all_data()"""
+    trade, client_type, limits, metadata = {}, {}, {}, {}
+    for i, stock_id in enumerate(stock_ids):
+        stock = state.setdefault(stock_id, {'pl': float(random.randint(1000, 50000)), 'tvol': 0.0})
+        stock['pl'] += random.choice((-10, 0, 10))
+        stock['tvol'] += random.randint(0, 5000)
+        trade[stock_id] = {
+            'PDrCotVal': stock['pl'], 'PClosing': stock['pl'], 'PriceFirst': stock['pl'], 'PriceYesterday': stock['pl'],
+            'PriceMax': stock['pl'] + 50, 'PriceMin': stock['pl'] - 50, 'ZTotTran': 10,
+            'QTotTran5J': stock['tvol'], 'QTotCap': stock['tvol'] * stock['pl']
+        }
+        client_type[stock_id] = {
+            'Buy_I_Volume': stock['tvol'] * 0.6, 'Buy_N_Volume': stock['tvol'] * 0.4,
+            'Sell_I_Volume': stock['tvol'] * 0.5, 'Sell_N_Volume': stock['tvol'] * 0.5,
+            'Buy_CountI': 10, 'Buy_CountN': 2, 'Sell_CountI': 8, 'Sell_CountN': 3
+        }
+        limits[stock_id] = {
+            str(level): {'ZOrdMeDem': 3, 'QTitMeDem': 100 * level, 'PMeDem': stock['pl'] - level,
+                         'PMeOf': stock['pl'] + level, 'QTitMeOf': 120 * level, 'ZOrdMeOf': 2}
+            for level in range(1, 6)
+        }
+        metadata[stock_id] = {
+            'name': f'نماد{i}', 'Full_name': f'شرکت سرمایه گذاری نمونه {i}', 'industry_num': str(i % 40),
+            'Exchange': str(i % 3), 'valid': '1', 'exchange_name': 'بورس اوراق بهادار تهران',
+            'industry_name': f'محصولات شیمیایی {i % 40}', 'pe': 8.5, 'tmax': stock['pl'] * 1.05,
+            'tmin': stock['pl'] * 0.95, 'nav': None, 'is_san': 0, 'gpe': 3, 'min_lot': 1, 'max_lot': 100000
+        }
+    return {'client_type': client_type, 'trade_data': trade, 'limits_data': limits, 'metadata': metadata}
+
+
+def start_fetcher(stock_ids, interval, stop):
+    """Ingest synthetic cycles on a separate thread and event loop, like the app's data fetcher"""
+    def run():
+        loop = asyncio.new_event_loop()
+        state = {}
+        while not stop.is_set():
+            loop.run_until_complete(get_cache().update_data(make_cycle(stock_ids, state)))
+            stop.wait(interval)
+        loop.close()
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)] if values else 0.0
+
+
+async def load(client, path, concurrency, duration):
+    """Hammer one path from `concurrency` clients for `duration` seconds"""
+    latencies = []
+    errors = 0
+    deadline = time.perf_counter() + duration
+
+    async def worker():
+        nonlocal errors
+        while time.perf_counter() < deadline:
+            started = time.perf_counter()
+            try:
+                response = await client.get(path)
+                if response.status_code != 200:
+                    errors += 1
+            except httpx.HTTPError:
+                errors += 1
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return latencies, errors, time.perf_counter() - started
+
+
+async def run(args, stock_ids):
+    if args.url:
+        client = httpx.AsyncClient(base_url=args.url, timeout=30,
+                                   limits=httpx.Limits(max_connections=args.concurrency))
+    else:
+        client = httpx.AsyncClient(transport=httpx.ASGITransport(app=get_asgi_application()),
+                                   base_url='http://localhost', timeout=30)
+    async with client:
+        print(f"{'endpoint':<28} {'req/s':>8} {'p50 ms':>8} {'p99 ms':>8} {'errors':>7}")
+        for endpoint in args.endpoints:
+            path = endpoint.format(stock=args.stock or stock_ids[0])
+            latencies, errors, elapsed = await load(client, path, args.concurrency, args.duration)
+            print(f"{endpoint:<28} {len(latencies) / elapsed:>8.0f} {percentile(latencies, 0.5) * 1000:>8.1f} "
+                  f"{percentile(latencies, 0.99) * 1000:>8.1f} {errors:>7}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure REST requests/s and p99 latency under concurrent clients')
+    parser.add_argument('--url', help='base URL of a running server; the ASGI app is loaded in-process when omitted')
+    parser.add_argument('--stocks', type=int, default=700)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--duration', type=float, default=5, help='seconds per endpoint')
+    parser.add_argument('--ingest-interval', type=float, default=1,
+                        help='seconds between synthetic cycles ingested while loading (in-process only)')
+    parser.add_argument('--endpoints', nargs='+', default=list(ENDPOINTS))
+    parser.add_argument('--stock', help='stock code for /api/stocks/{stock}/ (needed with --url)')
+    args = parser.parse_args()
+
+    random.seed(42)
+    stock_ids = [str(10000000000000000 + i * 7919) for i in range(args.stocks)]
+    stop = threading.Event()
+    if not args.url:
+        # Two cycles up front so every stock has data before the first request
+        for _ in range(2):
+            asyncio.run(get_cache().update_data(make_cycle(stock_ids, {})))
+        start_fetcher(stock_ids, args.ingest_interval, stop)
+
+    print(f"{args.concurrency} concurrent clients, {args.duration}s per endpoint, "
+          f"{'server ' + args.url if args.url else f'in-process, {args.stocks} stocks'}")
+    try:
+        asyncio.run(run(args, stock_ids))
+    finally:
+        stop.set()
+
+
+if __name__ == "__main__":
+    main()
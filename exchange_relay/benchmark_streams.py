@@ -0,0 +1,222 @@
+# Save this as benchmark_streams.py in the exchange_relay directory
+# Measures the bytes each all-stocks client receives per minute in every protocol mode,
+# and the payload size and encode time of every wire encoding, using a synthetic
+# market instead of the upstream API.
+import os
+import sys
+import time
+import zlib
+import random
+import argparse
+import itertools
+from datetime import datetime
+import django
+
+# Set up Django environment
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'exchange_relay.settings')
+django.setup()
+
+# Import after Django setup
+from socket_api.services.broadcast import FullStream, DeltaStream, Snapshot
+from socket_api.services.encoding import ENCODINGS, DEFAULT_ENCODING, JsonCodec
+from socket_api.services.message_formatter import (
+    build_all_stocks_entries, build_all_stocks_message, format_stock_update, FragmentCache
+)
+
+INGESTION_INTERVAL = 60  # seconds between upstream fetches
+TICK = 5  # simulated seconds between producer wakeups
+
+
+def make_market(count):
+    """Build a summary shaped like ExchangeDataCache.get_all_stocks_summary()"""
+    summary = {}
+    for i in range(count):
+        price = float(random.randint(1000, 50000))
+        summary[str(10000000000000000 + i * 7919)] = {
+            'pf': price, 'pl': price, 'pc': price, 'tval': 0.0, 'py': price, 'pchange': 0.0,
+            'pmin': price, 'pmax': price, 'tvol': 0.0,
+            'qd1': 1000.0, 'pd1': price - 10, 'qo1': 1000.0, 'po1': price + 10,
+            'spread': 20.0, 'mid': price, 'imbalance': 0.0, 'bid_depth': 5000.0, 'ask_depth': 5000.0,
+            'buy_queue': False, 'sell_queue': False, 'buy_queue_value': 0, 'sell_queue_value': 0,
+            'metadata': {
+                'name': f'نماد{i}', 'Full_name': f'شرکت سرمایه گذاری نمونه {i}', 'CGrValCot': 'N1',
+                'industry_num': str(i % 40), 'Exchange': str(i % 3), 'valid': '1',
+                'exchange_name': 'بورس اوراق بهادار تهران', 'industry_name': f'محصولات شیمیایی {i % 40}',
+                'pe': round(random.uniform(3, 30), 2), 'tmax': price * 1.05, 'tmin': price * 0.95,
+                'nav': None, 'is_san': 0, 'gpe': 3, 'min_lot': 1, 'max_lot': 100000,
+            },
+        }
+    return summary
+
+
+def mutate(summary, change_rate):
+    """Advance the market by one ingestion cycle, changing a fraction of the stocks"""
+    result = {}
+    for stock_id, stock in summary.items():
+        if random.random() < change_rate:
+            stock = dict(stock)
+            traded = random.randint(1, 5000)
+            stock['pl'] = stock['pl'] + random.choice((-10, 0, 10))
+            stock['tvol'] = stock['tvol'] + traded
+            stock['tval'] = stock['tval'] + traded * stock['pl']
+            stock['pchange'] = stock['pl'] - stock['py']
+            stock['qd1'] = float(random.randint(100, 5000))
+            stock['qo1'] = float(random.randint(100, 5000))
+        result[stock_id] = stock
+    return result
+
+
+# Generations keep counting across simulations, since encoded entries are cached by version
+_generations = itertools.count(1)
+
+
+def make_snapshot(summary, previous_summary=None, previous_versions=None):
+    """Snapshot of a market, versioning the stocks that mutate() replaced since the previous summary"""
+    generation = next(_generations)
+    versions = dict(previous_versions or {})
+    for stock_id, stock in summary.items():
+        if (previous_summary or {}).get(stock_id) is not stock:
+            versions[stock_id] = generation
+    return Snapshot(generation, build_all_stocks_entries(summary), versions)
+
+
+def simulate(stream, summary, minutes, change_rate, encoding=DEFAULT_ENCODING):
+    """Drive one stream tick by tick and return the bytes a single client receives"""
+    clock = [0.0]
+    stream.clock = lambda: clock[0]
+    snapshot = make_snapshot(summary)
+    frame = stream.update(snapshot)
+    total = payload_size(frame.payload(encoding)) if frame else 0
+    for tick in range(1, int(minutes * 60 / TICK) + 1):
+        clock[0] = tick * TICK
+        if clock[0] % INGESTION_INTERVAL == 0:
+            summary, previous_summary = mutate(summary, change_rate), summary
+            snapshot = make_snapshot(summary, previous_summary, snapshot.versions)
+        frame = stream.update(snapshot)
+        total += payload_size(frame.payload(encoding)) if frame else 0
+    return total / minutes
+
+
+def payload_size(payload):
+    return len(payload.encode('utf-8') if isinstance(payload, str) else payload)
+
+
+class AsciiJsonCodec(JsonCodec):
+    """The JSON encoding used before encodings were negotiable, with Persian text escaped"""
+    name = 'json-ascii'
+
+    def dumps(self, obj):
+        import json
+        return json.dumps(obj)
+
+
+def deflate_sizes(payloads):
+    """Bytes on the wire with permessage-deflate, one compressor per connection (context takeover)"""
+    compressor = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+    sizes = []
+    for payload in payloads:
+        data = payload.encode('utf-8') if isinstance(payload, str) else payload
+        sizes.append(len(compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)) - 4)
+    return sizes
+
+
+def make_stock_data(stock):
+    """Build a cache entry shaped like ExchangeDataCache.data[stock_id] from a summary entry"""
+    stock_data = {field: [value] for field, value in stock.items() if field != 'metadata'}
+    stock_data['time'] = [datetime.now()]
+    stock_data['metadata'] = stock['metadata']
+    return stock_data
+
+
+def encode_timed(encode, message, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        payload = encode(message)
+    return payload, (time.perf_counter() - start) / repeat * 1000
+
+
+def compare_encodings(market, repeat):
+    """Print payload size, deflated size and encode time of each encoding for each frame type"""
+    delta_stream = DeltaStream(keyframe_interval=float('inf'))
+    snapshot = make_snapshot(market)
+    delta_stream.update(snapshot)
+    delta = delta_stream.update(make_snapshot(mutate(market, 0.3), market, snapshot.versions)).message
+    keyframe = delta_stream.join_frame().message
+
+    stock_ids = list(market)[:5]
+    stock_update = {
+        'type': 'stock_update',
+        'timestamp': 0.0,
+        'data': {stock_id: format_stock_update(make_stock_data(market[stock_id])) for stock_id in stock_ids}
+    }
+
+    encoders = [('json-ascii (before)', AsciiJsonCodec().dumps)]
+    encoders += [(name, encoding.encode) for name, encoding in ENCODINGS.items()]
+    # The per-stock stream only uses the codec, the columnar layout applies to all-stocks frames
+    codecs = [(name, encode) for name, encode in encoders if 'columnar' not in name]
+    messages = [
+        ('all-stocks keyframe', keyframe, encoders),
+        ('all-stocks delta 30%', delta, encoders),
+        (f'per-stock {len(stock_ids)} stocks', stock_update, codecs),
+    ]
+
+    print(f"{'frame':<22} {'encoding':<20} {'bytes':>10} {'deflated':>10} {'encode ms':>10}")
+    for label, message, frame_encoders in messages:
+        for name, encode in frame_encoders:
+            payload, elapsed = encode_timed(encode, message, repeat)
+            deflated = deflate_sizes([payload])[0]
+            print(f"{label:<22} {name:<20} {payload_size(payload):>10} {deflated:>10} {elapsed:>10.2f}")
+        print()
+
+
+def compare_fragment_cache(market, change_rate, cycles):
+    """Print the time to encode a full frame per cycle, from scratch and by joining cached fragments"""
+    print(f"full frame encode per cycle, {change_rate:.0%} of stocks changing")
+    print(f"{'encoding':<10} {'from scratch ms':>16} {'fragment cache ms':>18}")
+    for name in ('json', 'msgpack'):
+        if name not in ENCODINGS:
+            continue
+        encoding = ENCODINGS[name]
+        fragment_cache = FragmentCache()
+        summary = market
+        snapshot = make_snapshot(summary)
+        fragment_cache.encode_message(encoding.codec, build_all_stocks_message(snapshot.entries), snapshot.versions)
+        scratch = cached = 0.0
+        for _ in range(cycles):
+            summary, previous_summary = mutate(summary, change_rate), summary
+            snapshot = make_snapshot(summary, previous_summary, snapshot.versions)
+            message = build_all_stocks_message(snapshot.entries)
+            start = time.perf_counter()
+            expected = encoding.encode(message)
+            scratch += time.perf_counter() - start
+            start = time.perf_counter()
+            joined = fragment_cache.encode_message(encoding.codec, message, snapshot.versions)
+            cached += time.perf_counter() - start
+            assert payload_size(joined) == payload_size(expected)
+        print(f"{name:<10} {scratch / cycles * 1000:>16.2f} {cached / cycles * 1000:>18.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare bytes per client per minute across all-stocks protocol modes')
+    parser.add_argument('--stocks', type=int, default=700)
+    parser.add_argument('--minutes', type=int, default=10)
+    parser.add_argument('--keyframe-interval', type=float, default=300)
+    parser.add_argument('--repeat', type=int, default=20, help='encodes per measurement')
+    args = parser.parse_args()
+
+    random.seed(42)
+    market = make_market(args.stocks)
+    print(f"{args.stocks} stocks, {args.minutes} minutes, ingestion every {INGESTION_INTERVAL}s, keyframe every {args.keyframe_interval}s")
+    print(f"{'change rate':>12} {'full KB/min':>12} {'delta KB/min':>13} {'ratio':>6}")
+    for change_rate in (0.05, 0.3, 0.6, 0.9):
+        full = simulate(FullStream(), market, args.minutes, change_rate)
+        delta = simulate(DeltaStream(args.keyframe_interval), market, args.minutes, change_rate)
+        print(f"{change_rate:>12.0%} {full / 1024:>12.1f} {delta / 1024:>13.1f} {full / delta:>6.1f}x")
+
+    print()
+    compare_encodings(market, args.repeat)
+    compare_fragment_cache(market, 0.3, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
@@ -164,6 +164,44 @@ CHANNEL_LAYERS = {
     },
 }
 
+# Seconds between full keyframes on the all-stocks stream in delta mode
+ALL_STOCKS_KEYFRAME_INTERVAL = 300
+
+# Seconds a connection may stay behind before it's disconnected as a slow consumer.
+# Measured until consumer.send() returns; Daphne buffers frames in the transport
+# without backpressure, so this catches stalled sends rather than slow readers.
+SLOW_CONSUMER_MAX_LAG = 120
+# Cycles of alerts an alerts connection may have waiting before it's disconnected as a slow consumer
+ALERT_QUEUE_MAX_BATCHES = 100
+
+# Seconds the shared live-IDs feed serves its cached data before fetching from the upstream again
+LIVE_IDS_TTL = 60
+# Explicit refresh requests still reuse data younger than this many seconds
+LIVE_IDS_MIN_REFRESH = 5
+
+# Cadence tiers for the market streams: name -> minimum seconds between frames (0 = every cycle).
+# Connections sharing a tier share its frames, so slow dashboards cost one frame per interval.
+CADENCE_TIERS = {
+    'realtime': 0,
+    '5s': 5,
+    '30s': 30,
+}
+
+# Compression of the REST responses rendered once per generation (summary, metadata, stock IDs)
+RESPONSE_GZIP_LEVEL = 6
+RESPONSE_BROTLI_QUALITY = 5
+
+# Most symbols a single /api/stocks/batch/ request may ask for
+BATCH_MAX_SYMBOLS = 500
+
+# Longest a /api/changes/ long-poll waits for the next cycle, in seconds
+LONG_POLL_TIMEOUT = 30
+# Seconds between keepalive comments on an idle /api/changes/stream/ connection
+SSE_HEARTBEAT = 15
+
+# Rows per chunk of a streaming /api/export/ (the most it holds in memory at once)
+EXPORT_CHUNK_ROWS = 5000
+
 # Configure logging
 LOGGING = {
     'version': 1,
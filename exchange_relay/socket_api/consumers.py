@@ -1,12 +1,24 @@
 # socket_api/consumers.py
 import json
+import uuid
 import asyncio
 from channels.generic.websocket import AsyncWebsocketConsumer
 from django.apps import apps
+from django.conf import settings
 from api_client.services.cache_manager import get_cache
 import logging
 from datetime import datetime
-from api_client.services.stock_metadata import get_metadata_client
+from urllib.parse import parse_qs
+from api_client.services.screener import get_screener, ScreenerError
+from api_client.services.leaderboards import get_leaderboards
+from api_client.services.trade_tape import get_trade_tape
+from api_client.services.alerts import get_alert_engine, AlertRuleError
+from .services.broadcast import get_all_stocks_hub, get_symbol_hub, validate_cadence
+from .services.metadata_channel import validate_metadata_mode
+from .services.encoding import negotiate_encoding, DEFAULT_ENCODING
+from .services.stock_ids_feed import get_stock_ids_feed
+from .services.message_formatter import Projection
+from .services.outbox import SLOW_CONSUMER_CLOSE_CODE
 
 logger = logging.getLogger(__name__)
 
@@ -18,34 +30,52 @@ logger = logging.getLogger(__name__)
 class AllStocksDataConsumer(AsyncWebsocketConsumer):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.update_task = None
-        # Get the shared cache instance
-        self.cache_instance = get_cache()
+        # Frames are built once per cycle by the shared hub, not per connection
+        self.hub = get_all_stocks_hub()
+        self.encoding = DEFAULT_ENCODING
         
     async def connect(self):
         logger.info("Client connecting to AllStocksData WebSocket")
-        await self.accept()
+        # Data frames use the encoding negotiated here; control messages stay JSON text
+        encoding_error = None
+        try:
+            self.encoding, subprotocol = negotiate_encoding(self.scope)
+        except ValueError as e:
+            encoding_error, subprotocol = e, None
+        await self.accept(subprotocol)
         logger.info("Client connected successfully to AllStocksData")
         await self.send(text_data=json.dumps({
             'type': 'connection_status',
             'status': 'connected',
-            'message': 'Connected to all stocks data service'
+            'message': 'Connected to all stocks data service',
+            'encoding': self.encoding.name
         }))
+        if encoding_error:
+            await self.send(text_data=json.dumps({
+                'type': 'error',
+                'message': str(encoding_error)
+            }))
         
-        # Start sending updates immediately
-        self.update_task = asyncio.create_task(self.send_all_stocks_updates())
+        # Start receiving updates immediately, in the mode requested with ?mode=full|delta,
+        # optionally narrowed with ?fields=pl,pchange&symbols=..., slowed with ?cadence=5s, and with
+        # ?metadata=separate sent metadata once and then on change instead of in every frame
+        query = parse_qs(self.scope.get('query_string', b'').decode())
+        try:
+            projection = Projection(query['fields'][0] if 'fields' in query else None,
+                                    query['symbols'][0] if 'symbols' in query else None,
+                                    query.get('metadata', ['inline'])[0])
+            await self.hub.subscribe(self, query.get('mode', ['full'])[0], self.encoding, projection,
+                                     query.get('cadence', ['realtime'])[0])
+        except ValueError as e:
+            await self.send(text_data=json.dumps({
+                'type': 'error',
+                'message': str(e)
+            }))
+            await self.hub.subscribe(self, encoding=self.encoding)
     
     async def disconnect(self, close_code):
         logger.info(f"Client disconnected from AllStocksData with code: {close_code}")
-        # Cancel the update task if it's running
-        if self.update_task:
-            self.update_task.cancel()
-            try:
-                await self.update_task
-            except asyncio.CancelledError:
-                logger.info("Update task cancelled successfully")
-            except Exception as e:
-                logger.error(f"Error cancelling update task: {e}")
+        self.hub.unsubscribe(self)
             
     async def receive(self, text_data):
         """Handle incoming messages, but since this is a broadcast channel, we just acknowledge"""
@@ -53,168 +83,46 @@ class AllStocksDataConsumer(AsyncWebsocketConsumer):
         try:
             data = json.loads(text_data)
             
-            # For now, just echo back any messages
-            await self.send(text_data=json.dumps({
-                'type': 'echo',
-                'data': data
-            }))
+            if data.get('type') == 'subscribe':
+                # Switch protocol mode, projection, cadence and metadata mode; delta mode starts with a fresh keyframe
+                mode = data.get('mode', 'full')
+                if mode not in self.hub.stream_factories:
+                    raise ValueError(f"Unknown mode {mode}, expected one of {list(self.hub.stream_factories)}")
+                projection = Projection(data.get('fields'), data.get('symbols'), data.get('metadata', 'inline'))
+                cadence = validate_cadence(data.get('cadence', 'realtime'))
+                await self.send(text_data=json.dumps({
+                    'type': 'subscription_update',
+                    'status': 'success',
+                    'mode': mode,
+                    'fields': projection.key[0],
+                    'symbols': projection.key[1],
+                    'metadata': projection.key[2],
+                    'cadence': cadence
+                }))
+                await self.hub.subscribe(self, mode, self.encoding, projection, cadence)
+            else:
+                # Echo back any other messages
+                await self.send(text_data=json.dumps({
+                    'type': 'echo',
+                    'data': data
+                }))
                 
         except json.JSONDecodeError:
             await self.send(text_data=json.dumps({
                 'type': 'error',
                 'message': 'Invalid JSON format'
             }))
+        except ValueError as e:
+            await self.send(text_data=json.dumps({
+                'type': 'error',
+                'message': str(e)
+            }))
         except Exception as e:
             await self.send(text_data=json.dumps({
                 'type': 'error',
                 'message': f'Error processing request: {str(e)}'
             }))
     
-    async def send_all_stocks_updates(self):
-        """Background task to send updates for all stocks to the client"""
-        try:
-            # Make sure we're using the same event loop as the consumer
-            loop = asyncio.get_event_loop()
-            
-            while True:
-                try:
-                    # Get optimized summary data for all stocks
-                    # Use the same event loop for all async operations
-                    stock_updates = await self.cache_instance.get_all_stocks_summary()
-                    
-                    if not stock_updates:
-                        logger.info("No data in cache yet, waiting for initial data load...")
-                        await asyncio.sleep(5)  # Wait longer for initial data
-                        continue
-                    
-                    # Process stocks in smaller batches to avoid timeout issues
-                    batch_size = 100
-                    stock_ids = list(stock_updates.keys())
-                    enhanced_updates = {}
-                    
-                    # Process stocks in batches
-                    for i in range(0, len(stock_ids), batch_size):
-                        batch_ids = stock_ids[i:i+batch_size]
-                        
-                        for stock_id in batch_ids:
-                            stock_data = stock_updates[stock_id]
-                            # Skip processing if the connection is closed
-                            if not self.is_connected:
-                                return
-                                
-                            # Start with the basic data
-                            enhanced_data = stock_data.copy()
-                            
-                            try:
-                                # Get the complete stock data to access additional fields
-                                full_stock_data = await self.cache_instance.get_stock_data(stock_id)
-                                
-                                # Add order book data (best bid/ask)
-                                if full_stock_data:
-                                    # Add best bid (demand)
-                                    if full_stock_data.get('qd1') and full_stock_data['qd1']:
-                                        enhanced_data['qd1'] = full_stock_data['qd1'][-1] if len(full_stock_data['qd1']) > 0 else None
-                                    if full_stock_data.get('pd1') and full_stock_data['pd1']:
-                                        enhanced_data['pd1'] = full_stock_data['pd1'][-1] if len(full_stock_data['pd1']) > 0 else None
-                                        
-                                    # Add best ask (offer)
-                                    if full_stock_data.get('qo1') and full_stock_data['qo1']:
-                                        enhanced_data['qo1'] = full_stock_data['qo1'][-1] if len(full_stock_data['qo1']) > 0 else None
-                                    if full_stock_data.get('po1') and full_stock_data['po1']:
-                                        enhanced_data['po1'] = full_stock_data['po1'][-1] if len(full_stock_data['po1']) > 0 else None
-                                    
-                                    # Add volume and trade volume data
-                                    if full_stock_data.get('tvol') and full_stock_data['tvol']:
-                                        enhanced_data['tvol'] = full_stock_data['tvol'][-1] if len(full_stock_data['tvol']) > 0 else None
-                                        
-                                    # Some APIs use 'vol' instead of 'tvol', check for both
-                                    if full_stock_data.get('vol') and full_stock_data['vol']:
-                                        enhanced_data['vol'] = full_stock_data['vol'][-1] if len(full_stock_data['vol']) > 0 else None
-                                    # If 'vol' isn't explicitly available, use tvol as a fallback for vol
-                                    elif 'tvol' in enhanced_data and enhanced_data['tvol'] is not None:
-                                        enhanced_data['vol'] = enhanced_data['tvol']
-                                
-                                # Make sure the metadata includes all the new fields
-                                metadata = enhanced_data.get('metadata', {})
-                                
-                                # Explicitly add them at the top level too for easy access
-                                # enhanced_data['pe'] = metadata.get('pe', '-')
-                                # enhanced_data['tmax'] = metadata.get('tmax', '-')
-                                # enhanced_data['tmin'] = metadata.get('tmin', '-')
-                                # enhanced_data['nav'] = metadata.get('nav', '-')
-                                # CHANGED: Using null instead of "-" for missing values
-                                enhanced_data['pe'] = metadata.get('pe', None)
-                                enhanced_data['tmax'] = metadata.get('tmax', None)
-                                enhanced_data['tmin'] = metadata.get('tmin', None)
-                                enhanced_data['nav'] = metadata.get('nav', None)
-                                # Add the new fields
-                                enhanced_data['is_san'] = metadata.get('is_san', None)
-                                enhanced_data['gpe'] = metadata.get('gpe', None)
-                                # Add min_lot and max_lot fields
-                                enhanced_data['min_lot'] = metadata.get('min_lot', None)
-                                enhanced_data['max_lot'] = metadata.get('max_lot', None)
-                            except Exception as e:
-                                logger.error(f"Error processing stock {stock_id}: {e}")
-                                # Continue with basic data if there's an error
-                            
-                            # Store the enhanced data
-                            enhanced_updates[stock_id] = enhanced_data
-                            
-                        # Add a small delay between batches to avoid blocking the event loop
-                        await asyncio.sleep(0.01)
-                    
-                    # Only send if we have updates and we're still connected
-                    if enhanced_updates and self.is_connected:
-                        logger.info(f"Sending updates for {len(enhanced_updates)} stocks on AllStocksData channel")
-                        
-                        try:
-                            await self.send(text_data=json.dumps({
-                                'type': 'all_stocks_update',
-                                'timestamp': datetime.now().isoformat(),
-                                'count': len(enhanced_updates),
-                                'data': enhanced_updates
-                            }))
-                        except Exception as send_error:
-                            logger.error(f"Error sending updates: {send_error}")
-                            # If we fail to send, the connection might be closed
-                            if not self.is_connected:
-                                return
-                    elif self.is_connected:
-                        logger.info("No updates to send on AllStocksData channel")
-                    else:
-                        return  # Exit if we're no longer connected
-                    
-                    # Wait before sending the next update (5 seconds)
-                    await asyncio.sleep(5)
-                    
-                except Exception as loop_error:
-                    logger.error(f"Error in update loop: {loop_error}")
-                    import traceback
-                    logger.error(traceback.format_exc())
-                    # Continue running even after an error, with a small delay
-                    await asyncio.sleep(5)
-                
-        except asyncio.CancelledError:
-            # Task was cancelled, clean up
-            logger.info("AllStocksData update task cancelled")
-            raise  # Re-raise to properly handle cancellation
-            
-        except Exception as e:
-            # Log any errors
-            logger.error(f"Error in send_all_stocks_updates: {e}")
-            import traceback
-            logger.error(traceback.format_exc())
-            
-            # Try to notify the client if we're still connected
-            if self.is_connected:
-                try:
-                    await self.send(text_data=json.dumps({
-                        'type': 'error',
-                        'message': f'Update service encountered an error: {str(e)}'
-                    }))
-                except:
-                    pass
-    
     @property
     def is_connected(self):
         """Check if the WebSocket is still connected"""
@@ -224,26 +132,39 @@ class AllStocksDataConsumer(AsyncWebsocketConsumer):
 class ExchangeDataConsumer(AsyncWebsocketConsumer):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.subscribed_stocks = set()
-        self.update_task = None
-        # Get the shared cache instance
-        self.cache_instance = get_cache()
+        # Updates are formatted once per symbol by the shared hub, not per connection
+        self.hub = get_symbol_hub()
+        self.encoding = DEFAULT_ENCODING
+        
+    @property
+    def subscribed_stocks(self):
+        return self.hub.symbols_for(self)
         
     async def connect(self):
         print("Client connecting to WebSocket")
-        await self.accept()
+        # Updates use the codec of the negotiated encoding (the columnar layout only applies to all-stocks frames)
+        encoding_error = None
+        try:
+            self.encoding, subprotocol = negotiate_encoding(self.scope)
+        except ValueError as e:
+            encoding_error, subprotocol = e, None
+        await self.accept(subprotocol)
         print("Client connected successfully")
         await self.send(text_data=json.dumps({
             'type': 'connection_status',
             'status': 'connected',
-            'message': 'Connected to exchange data service'
+            'message': 'Connected to exchange data service',
+            'encoding': self.encoding.name
         }))
+        if encoding_error:
+            await self.send(text_data=json.dumps({
+                'type': 'error',
+                'message': str(encoding_error)
+            }))
     
     async def disconnect(self, close_code):
         print(f"Client disconnected with code: {close_code}")
-        # Cancel the update task if it's running
-        if self.update_task:
-            self.update_task.cancel()
+        self.hub.unsubscribe(self)
             
     async def receive(self, text_data):
         print(f"Received message: {text_data}")
@@ -255,19 +176,26 @@ class ExchangeDataConsumer(AsyncWebsocketConsumer):
                 stocks = data.get('stocks', [])
                 if not isinstance(stocks, list):
                     stocks = [stocks]  # Convert single item to list
-                
-                # Update our subscription set
-                self.subscribed_stocks.update(stocks)
+                # Optional cadence tier, e.g. "5s", and metadata mode, "separate" to get metadata
+                # once and then on change instead of in every update; both kept from earlier subscribes
+                cadence = data.get('cadence')
+                if cadence is not None:
+                    validate_cadence(cadence)
+                metadata = data.get('metadata')
+                if metadata is not None:
+                    validate_metadata_mode(metadata)
+                separate = metadata == 'separate' or (metadata is None and self in self.hub.separate_metadata)
                 
                 await self.send(text_data=json.dumps({
                     'type': 'subscription_update',
                     'status': 'success',
-                    'subscribed_stocks': list(self.subscribed_stocks)
+                    'subscribed_stocks': list(self.subscribed_stocks | set(stocks)),
+                    'cadence': cadence or self.hub.cadences.get(self, 'realtime'),
+                    'metadata': 'separate' if separate else 'inline'
                 }))
                 
-                # Start sending updates if not already started
-                if not self.update_task or self.update_task.done():
-                    self.update_task = asyncio.create_task(self.send_stock_updates())
+                # Join the symbol groups; the new stocks (and their metadata, when separate) are sent right away
+                await self.hub.subscribe(self, stocks, self.encoding, cadence, metadata)
             
             elif data.get('type') == 'unsubscribe':
                 # Handle unsubscription request
@@ -275,23 +203,155 @@ class ExchangeDataConsumer(AsyncWebsocketConsumer):
                 if not isinstance(stocks, list):
                     stocks = [stocks]
                 
-                # Remove from our subscription set
-                for stock in stocks:
-                    self.subscribed_stocks.discard(stock)
+                # Leave the symbol groups
+                self.hub.unsubscribe(self, stocks)
                 
                 await self.send(text_data=json.dumps({
                     'type': 'subscription_update',
                     'status': 'success',
                     'subscribed_stocks': list(self.subscribed_stocks)
                 }))
+            
+            else:
+                # Echo back unknown message types
+                await self.send(text_data=json.dumps({
+                    'type': 'echo',
+                    'data': data
+                }))
+                
+        except json.JSONDecodeError:
+            await self.send(text_data=json.dumps({
+                'type': 'error',
+                'message': 'Invalid JSON format'
+            }))
+        except Exception as e:
+            await self.send(text_data=json.dumps({
+                'type': 'error',
+                'message': f'Error processing request: {str(e)}'
+            }))
+            
+
+class StockIdsConsumer(AsyncWebsocketConsumer):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # One feed fetches and encodes the IDs for every connection
+        self.feed = get_stock_ids_feed()
+        
+    async def connect(self):
+        logger.info("Client connecting to StockIds WebSocket")
+        await self.accept()
+        logger.info("Client connected successfully to StockIds")
+        await self.send(text_data=json.dumps({
+            'type': 'connection_status',
+            'status': 'connected',
+            'message': 'Connected to stock IDs service'
+        }))
+        
+        # Receive the cached IDs right away, and every change after that
+        await self.feed.subscribe(self)
+    
+    async def disconnect(self, close_code):
+        logger.info(f"Client disconnected from StockIds with code: {close_code}")
+        self.feed.unsubscribe(self)
+            
+    async def receive(self, text_data):
+        """Handle incoming messages, but since this is a broadcast channel, we just acknowledge"""
+        logger.info(f"Received message on StockIds: {text_data}")
+        try:
+            data = json.loads(text_data)
+            
+            # Handle a refresh request; data younger than the refresh interval is served as is
+            if data.get('type') == 'refresh':
+                await self.feed.refresh(max_age=getattr(settings, 'LIVE_IDS_MIN_REFRESH', 5))
+                await self.send(text_data=json.dumps({
+                    'type': 'refresh_status',
+                    'status': 'success',
+                    'message': 'Stock IDs refreshed successfully',
+                    'hash': self.feed.snapshot.content_hash if self.feed.snapshot else None
+                }))
+            else:
+                # For other messages, just echo back
+                await self.send(text_data=json.dumps({
+                    'type': 'echo',
+                    'data': data
+                }))
                 
-                # If no more subscriptions, cancel the update task
-                if not self.subscribed_stocks and self.update_task:
+        except json.JSONDecodeError:
+            await self.send(text_data=json.dumps({
+                'type': 'error',
+                'message': 'Invalid JSON format'
+            }))
+        except Exception as e:
+            await self.send(text_data=json.dumps({
+                'type': 'error',
+                'message': f'Error processing request: {str(e)}'
+            }))
+
+
+class ScreenerConsumer(AsyncWebsocketConsumer):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.update_task = None
+        self.query = None
+        # Get the shared cache and screener instances
+        self.cache_instance = get_cache()
+        self.screener = get_screener()
+        
+    async def connect(self):
+        logger.info("Client connecting to Screener WebSocket")
+        await self.accept()
+        await self.send(text_data=json.dumps({
+            'type': 'connection_status',
+            'status': 'connected',
+            'message': 'Connected to screener service'
+        }))
+    
+    async def disconnect(self, close_code):
+        logger.info(f"Client disconnected from Screener with code: {close_code}")
+        if self.update_task:
+            self.update_task.cancel()
+            
+    async def receive(self, text_data):
+        """Handle subscribe/unsubscribe requests carrying a screener query"""
+        try:
+            data = json.loads(text_data)
+            
+            if data.get('type') == 'subscribe':
+                query = {
+                    'filters': data.get('filters', []),
+                    'sort': data.get('sort', 'tval'),
+                    'order': data.get('order', 'desc'),
+                    'limit': data.get('limit', 20),
+                    'fields': data.get('fields')
+                }
+                # Validate the query up front so errors reach the client immediately
+                result = self.screener.query(**query)
+                self.query = query
+                
+                await self.send(text_data=json.dumps({
+                    'type': 'subscription_update',
+                    'status': 'success',
+                    'query': query
+                }))
+                await self.send_result(result)
+                
+                # Restart the update task so it picks up the new query
+                if self.update_task:
+                    self.update_task.cancel()
+                self.update_task = asyncio.create_task(self.send_screener_updates(result))
+            
+            elif data.get('type') == 'unsubscribe':
+                self.query = None
+                if self.update_task:
                     self.update_task.cancel()
                     self.update_task = None
+                await self.send(text_data=json.dumps({
+                    'type': 'subscription_update',
+                    'status': 'success',
+                    'query': None
+                }))
             
             else:
-                # Echo back unknown message types
                 await self.send(text_data=json.dumps({
                     'type': 'echo',
                     'data': data
@@ -302,103 +362,44 @@ class ExchangeDataConsumer(AsyncWebsocketConsumer):
                 'type': 'error',
                 'message': 'Invalid JSON format'
             }))
+        except ScreenerError as e:
+            await self.send(text_data=json.dumps({
+                'type': 'error',
+                'message': f'Invalid screener query: {str(e)}'
+            }))
         except Exception as e:
             await self.send(text_data=json.dumps({
                 'type': 'error',
                 'message': f'Error processing request: {str(e)}'
             }))
     
-    async def send_stock_updates(self):
-        """Background task to send stock updates to the client"""
+    async def send_result(self, result):
+        await self.send(text_data=json.dumps({
+            'type': 'screener_update',
+            'timestamp': datetime.now().isoformat(),
+            **result
+        }))
+    
+    async def send_screener_updates(self, last_result):
+        """Background task that re-runs the query each cycle and pushes only when the result set changes"""
         try:
+            generation = last_result['generation']
             while True:
-                if not self.subscribed_stocks:
-                    # No stocks to update, sleep briefly and check again
-                    await asyncio.sleep(1)
-                    continue
-                try:
-                    # Check if we have any data at all in the cache
-                    all_data = await self.cache_instance.get_all_data()
-                    if not all_data:
-                        print("No data in cache yet, waiting for initial data load...")
-                        await asyncio.sleep(2)  # Wait longer for initial data
-                        continue
-                    
-                    # Debug print to check if data is available
-                    missing_stocks = []
-                    for stock_code in self.subscribed_stocks:
-                        stock_data = await self.cache_instance.get_stock_data(stock_code)
-                        if not stock_data or not stock_data.get('time'):
-                            missing_stocks.append(stock_code)
-                    
-                    if missing_stocks:
-                        print(f"Missing data for stocks: {missing_stocks}")
-                    
-                    # Gather updates for all subscribed stocks
-                    updates = {}
-                    for stock_code in self.subscribed_stocks:
-                        # Get the latest data for this stock
-                        stock_data = await self.cache_instance.get_stock_data(stock_code)
-                        
-                        if stock_data and stock_data.get('time') and stock_data['time']:
-                            # Create a summary with the most important fields
-                            updates[stock_code] = {
-                                'timestamp': stock_data['time'][-1].isoformat() if stock_data.get('time') and stock_data['time'] else None,
-                                'price': {
-                                    'last': stock_data['pl'][-1] if stock_data.get('pl') and stock_data['pl'] else None,
-                                    'closing': stock_data['pc'][-1] if stock_data.get('pc') and stock_data['pc'] else None,
-                                    'min': stock_data['pmin'][-1] if stock_data.get('pmin') and stock_data['pmin'] else None,
-                                    'max': stock_data['pmax'][-1] if stock_data.get('pmax') and stock_data['pmax'] else None,
-                                    'yesterday': stock_data['py'][-1] if stock_data.get('py') and stock_data['py'] else None,
-                                    'open': stock_data['pf'][-1] if stock_data.get('pf') and stock_data['pf'] else None
-                                },
-                                'volume': stock_data['tvol'][-1] if stock_data.get('tvol') and stock_data['tvol'] else None,
-                                'value': stock_data['tval'][-1] if stock_data.get('tval') and stock_data['tval'] else None,
-                                'transactions': stock_data['tno'][-1] if stock_data.get('tno') and stock_data['tno'] else None,
-                                'client_type': {
-                                    'buy_legal': stock_data['Buy_I_Volume'][-1] if stock_data.get('Buy_I_Volume') and stock_data['Buy_I_Volume'] else None,
-                                    'buy_natural': stock_data['Buy_N_Volume'][-1] if stock_data.get('Buy_N_Volume') and stock_data['Buy_N_Volume'] else None,
-                                    'sell_legal': stock_data['Sell_I_Volume'][-1] if stock_data.get('Sell_I_Volume') and stock_data['Sell_I_Volume'] else None,
-                                    'sell_natural': stock_data['Sell_N_Volume'][-1] if stock_data.get('Sell_N_Volume') and stock_data['Sell_N_Volume'] else None
-                                },
-                                # Include metadata
-                                'metadata': stock_data.get('metadata', {})
-                            }
-                    
-                    # Only send if we have updates
-                    if updates:
-                        print(f"Sending updates for {len(updates)} stocks")
-                        await self.send(text_data=json.dumps({
-                            'type': 'stock_update',
-                            'timestamp': asyncio.get_event_loop().time(),
-                            'data': updates
-                        }))
-                    else:
-                        print("No updates to send")
-                except Exception as inner_error:
-                    # Log the error but continue the loop
-                    print(f"Error processing updates: {inner_error}")
-                    import traceback
-                    traceback.print_exc()
-                    # Notify the client about the error
-                    await self.send(text_data=json.dumps({
-                        'type': 'error',
-                        'message': f'Error processing updates: {str(inner_error)}'
-                    }))
-                        
-                    # Wait before sending the next update (2 seconds)
-                await asyncio.sleep(2)
+                generation = await self.cache_instance.wait_for_update(generation)
+                result = self.screener.query(**self.query)
                 
+                if result['results'] != last_result['results']:
+                    last_result = result
+                    await self.send_result(result)
+                    
         except asyncio.CancelledError:
-            # Task was cancelled, clean up
-            print("Update task cancelled")
+            logger.info("Screener update task cancelled")
+            raise
             
         except Exception as e:
-            # Log any errors
-            print(f"Error in send_stock_updates: {e}")
+            logger.error(f"Error in send_screener_updates: {e}")
             import traceback
-            traceback.print_exc()
-            # Try to notify the client
+            logger.error(traceback.format_exc())
             try:
                 await self.send(text_data=json.dumps({
                     'type': 'error',
@@ -406,59 +407,168 @@ class ExchangeDataConsumer(AsyncWebsocketConsumer):
                 }))
             except:
                 pass
+
+
+class LeaderboardConsumer(AsyncWebsocketConsumer):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.update_task = None
+        self.boards = None  # None means every board
+        # Get the shared cache and leaderboard instances
+        self.cache_instance = get_cache()
+        self.leaderboards = get_leaderboards()
+        
+    async def connect(self):
+        logger.info("Client connecting to Leaderboards WebSocket")
+        await self.accept()
+        await self.send(text_data=json.dumps({
+            'type': 'connection_status',
+            'status': 'connected',
+            'message': 'Connected to leaderboards service'
+        }))
+        await self.send_snapshot()
+        
+        # Start streaming rank changes immediately
+        self.update_task = asyncio.create_task(self.send_leaderboard_updates())
+    
+    async def disconnect(self, close_code):
+        logger.info(f"Client disconnected from Leaderboards with code: {close_code}")
+        if self.update_task:
+            self.update_task.cancel()
             
+    async def receive(self, text_data):
+        """Handle board selection, e.g. {"type": "subscribe", "boards": ["gainers", "losers"]}"""
+        try:
+            data = json.loads(text_data)
             
+            if data.get('type') == 'subscribe':
+                boards = data.get('boards')
+                if boards is not None and not isinstance(boards, list):
+                    boards = [boards]
+                self.boards = boards
+                await self.send(text_data=json.dumps({
+                    'type': 'subscription_update',
+                    'status': 'success',
+                    'boards': boards if boards is not None else list(self.leaderboards.boards)
+                }))
+                await self.send_snapshot()
+            else:
+                await self.send(text_data=json.dumps({
+                    'type': 'echo',
+                    'data': data
+                }))
+                
+        except json.JSONDecodeError:
+            await self.send(text_data=json.dumps({
+                'type': 'error',
+                'message': 'Invalid JSON format'
+            }))
+        except Exception as e:
+            await self.send(text_data=json.dumps({
+                'type': 'error',
+                'message': f'Error processing request: {str(e)}'
+            }))
+    
+    async def send_snapshot(self):
+        await self.send(text_data=json.dumps({
+            'type': 'leaderboard_snapshot',
+            'generation': self.leaderboards.last_changes[0],
+            'timestamp': datetime.now().isoformat(),
+            'data': self.leaderboards.snapshot(self.boards)
+        }))
+    
+    async def send_leaderboard_updates(self):
+        """Background task that streams only the boards that changed in each cycle"""
+        try:
+            generation = self.leaderboards.last_changes[0]
+            while True:
+                next_generation = await self.cache_instance.wait_for_update(generation)
+                changes_generation, changes = self.leaderboards.last_changes
+                
+                if changes_generation != next_generation or next_generation > generation + 1:
+                    # We missed a cycle, so the diffs alone would leave the client inconsistent
+                    await self.send_snapshot()
+                else:
+                    boards = {
+                        name: diff for name, diff in changes.items()
+                        if self.boards is None or name in self.boards
+                    }
+                    if boards:
+                        await self.send(text_data=json.dumps({
+                            'type': 'leaderboard_update',
+                            'generation': changes_generation,
+                            'timestamp': datetime.now().isoformat(),
+                            'data': boards
+                        }))
+                generation = next_generation
+                    
+        except asyncio.CancelledError:
+            logger.info("Leaderboard update task cancelled")
+            raise
+            
+        except Exception as e:
+            logger.error(f"Error in send_leaderboard_updates: {e}")
+            import traceback
+            logger.error(traceback.format_exc())
+            try:
+                await self.send(text_data=json.dumps({
+                    'type': 'error',
+                    'message': f'Update service encountered an error: {str(e)}'
+                }))
+            except:
+                pass
 
-class StockIdsConsumer(AsyncWebsocketConsumer):
+
+class TradeTapeConsumer(AsyncWebsocketConsumer):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.update_task = None
-        # Get the shared cache instance
+        self.symbols = None  # None means every symbol
+        self.last_seq = None
+        # Get the shared cache and trade tape instances
         self.cache_instance = get_cache()
-        # Get the metadata client
-        self.metadata_client = get_metadata_client()
+        self.trade_tape = get_trade_tape()
         
     async def connect(self):
-        logger.info("Client connecting to StockIds WebSocket")
+        logger.info("Client connecting to TradeTape WebSocket")
         await self.accept()
-        logger.info("Client connected successfully to StockIds")
         await self.send(text_data=json.dumps({
             'type': 'connection_status',
             'status': 'connected',
-            'message': 'Connected to stock IDs service'
+            'message': 'Connected to trade tape service'
         }))
         
-        # Start sending updates immediately
-        self.update_task = asyncio.create_task(self.send_stock_ids_updates())
+        # Stream from the current end of the tape unless the client asks for a backlog
+        self.last_seq = self.trade_tape.seq
+        self.update_task = asyncio.create_task(self.send_trade_updates())
     
     async def disconnect(self, close_code):
-        logger.info(f"Client disconnected from StockIds with code: {close_code}")
-        # Cancel the update task if it's running
+        logger.info(f"Client disconnected from TradeTape with code: {close_code}")
         if self.update_task:
             self.update_task.cancel()
-            try:
-                await self.update_task
-            except asyncio.CancelledError:
-                logger.info("Update task cancelled successfully")
-            except Exception as e:
-                logger.error(f"Error cancelling update task: {e}")
             
     async def receive(self, text_data):
-        """Handle incoming messages, but since this is a broadcast channel, we just acknowledge"""
-        logger.info(f"Received message on StockIds: {text_data}")
+        """Handle {"type": "subscribe", "stocks": [...], "since": <seq>}"""
         try:
             data = json.loads(text_data)
             
-            # Handle a refresh request
-            if data.get('type') == 'refresh':
-                await self.metadata_client.fetch_live_ids()
+            if data.get('type') == 'subscribe':
+                stocks = data.get('stocks')
+                if stocks is not None and not isinstance(stocks, list):
+                    stocks = [stocks]
+                self.symbols = set(stocks) if stocks else None
+                
                 await self.send(text_data=json.dumps({
-                    'type': 'refresh_status',
+                    'type': 'subscription_update',
                     'status': 'success',
-                    'message': 'Stock IDs refreshed successfully'
+                    'subscribed_stocks': list(self.symbols) if self.symbols else None
                 }))
+                
+                # Replay the backlog the client missed, as far as the ring still holds it
+                if data.get('since') is not None:
+                    self.last_seq = int(data['since'])
+                    await self.send_trades()
             else:
-                # For other messages, just echo back
                 await self.send(text_data=json.dumps({
                     'type': 'echo',
                     'data': data
@@ -475,110 +585,158 @@ class StockIdsConsumer(AsyncWebsocketConsumer):
                 'message': f'Error processing request: {str(e)}'
             }))
     
-    async def send_stock_ids_updates(self):
-        """Background task to send stock IDs and names to the client"""
+    async def send_trades(self):
+        tape = self.trade_tape.since(self.last_seq, self.symbols)
+        self.last_seq = tape['seq']
+        if tape['events'] or tape['gap']:
+            await self.send(text_data=json.dumps({
+                'type': 'trades',
+                'seq': tape['seq'],
+                'gap': tape['gap'],
+                'count': len(tape['events']),
+                'data': tape['events']
+            }))
+    
+    async def send_trade_updates(self):
+        """Background task that streams the events recorded by each cycle"""
         try:
-            # To track changes between updates
-            last_data_hash = None
-            initial_send = True  # Flag to force sending data on first run
-            
+            generation = self.cache_instance.generation
             while True:
-                try:
-                    # Ensure we have metadata loaded - force a fresh fetch to test
-                    if not self.metadata_client.live_ids_data or initial_send:
-                        logger.info("Fetching fresh live IDs data...")
-                        await self.metadata_client.fetch_live_ids()
-                        logger.info(f"Fetch completed, got {len(self.metadata_client.live_ids_data) if self.metadata_client.live_ids_data else 0} stock IDs")
-                    
-                    # Get the stock IDs and names
-                    stock_ids_and_names = self.metadata_client.get_all_ids_and_names()
+                generation = await self.cache_instance.wait_for_update(generation)
+                await self.send_trades()
                     
-                    if not stock_ids_and_names:
-                        logger.info("No stock IDs data available yet, waiting...")
-                        await asyncio.sleep(5)  # Wait before retrying
-                        continue
-                    
-                    # Force send on the first successful fetch
-                    if initial_send:
-                        logger.info(f"Initial data available, sending {len(stock_ids_and_names)} stock IDs")
-                        
-                        # Only send if we're still connected
-                        if self.is_connected:
-                            try:
-                                await self.send(text_data=json.dumps({
-                                    'type': 'stock_ids_update',
-                                    'timestamp': datetime.now().isoformat(),
-                                    'count': len(stock_ids_and_names),
-                                    'data': stock_ids_and_names
-                                }))
-                                logger.info("Initial stock IDs update sent successfully")
-                                initial_send = False  # Reset the flag after successful send
-                            except Exception as send_error:
-                                logger.error(f"Error sending initial stock IDs update: {send_error}")
-                                if not self.is_connected:
-                                    return
-                        else:
-                            return  # Exit if we're no longer connected
-                    else:
-                        # For subsequent updates, only send if there are changes
-                        current_data_str = json.dumps(stock_ids_and_names, sort_keys=True)
-                        current_data_hash = hash(current_data_str)
-                        
-                        if current_data_hash != last_data_hash:
-                            last_data_hash = current_data_hash
-                            
-                            logger.info(f"Detected changes in stock IDs, sending update with {len(stock_ids_and_names)} stocks")
-                            
-                            # Only send if we're still connected
-                            if self.is_connected:
-                                try:
-                                    await self.send(text_data=json.dumps({
-                                        'type': 'stock_ids_update',
-                                        'timestamp': datetime.now().isoformat(),
-                                        'count': len(stock_ids_and_names),
-                                        'data': stock_ids_and_names
-                                    }))
-                                    logger.info("Stock IDs update sent successfully")
-                                except Exception as send_error:
-                                    logger.error(f"Error sending stock IDs update: {send_error}")
-                                    if not self.is_connected:
-                                        return
-                            else:
-                                return  # Exit if we're no longer connected
-                        else:
-                            logger.info("No changes in stock IDs data, skipping update")
-                    
-                    # Wait before checking for updates again
-                    await asyncio.sleep(60)
-                    
-                except Exception as loop_error:
-                    logger.error(f"Error in stock IDs update loop: {loop_error}")
-                    import traceback
-                    logger.error(traceback.format_exc())
-                    # Continue running even after an error, with a small delay
-                    await asyncio.sleep(5)
-                
         except asyncio.CancelledError:
-            # Task was cancelled, clean up
-            logger.info("StockIds update task cancelled")
-            raise  # Re-raise to properly handle cancellation
+            logger.info("Trade tape update task cancelled")
+            raise
             
         except Exception as e:
-            # Log any errors
-            logger.error(f"Error in send_stock_ids_updates: {e}")
+            logger.error(f"Error in send_trade_updates: {e}")
             import traceback
             logger.error(traceback.format_exc())
+            try:
+                await self.send(text_data=json.dumps({
+                    'type': 'error',
+                    'message': f'Update service encountered an error: {str(e)}'
+                }))
+            except:
+                pass
+
+
+class AlertsConsumer(AsyncWebsocketConsumer):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.update_task = None
+        self.owner_id = uuid.uuid4().hex
+        self.alert_queue = None
+        # Get the shared alert engine
+        self.alert_engine = get_alert_engine()
+        
+    async def connect(self):
+        logger.info("Client connecting to Alerts WebSocket")
+        await self.accept()
+        
+        # The engine runs in the fetcher thread, so alerts are handed over to this loop thread-safely
+        loop = asyncio.get_running_loop()
+        self.alert_queue = asyncio.Queue(maxsize=getattr(settings, 'ALERT_QUEUE_MAX_BATCHES', 100))
+        self.alert_engine.register_owner(
+            self.owner_id,
+            lambda notes: loop.call_soon_threadsafe(self._queue_alerts, notes)
+        )
+        
+        await self.send(text_data=json.dumps({
+            'type': 'connection_status',
+            'status': 'connected',
+            'message': 'Connected to alerts service'
+        }))
+        self.update_task = asyncio.create_task(self.send_alerts())
+    
+    async def disconnect(self, close_code):
+        logger.info(f"Client disconnected from Alerts with code: {close_code}")
+        # Rules live only as long as the connection that owns them
+        self.alert_engine.remove_owner(self.owner_id)
+        if self.update_task:
+            self.update_task.cancel()
             
-            # Try to notify the client if we're still connected
-            if self.is_connected:
-                try:
-                    await self.send(text_data=json.dumps({
-                        'type': 'error',
-                        'message': f'Update service encountered an error: {str(e)}'
-                    }))
-                except:
-                    pass
-    @property
-    def is_connected(self):
-        """Check if the WebSocket is still connected"""
-        return hasattr(self, 'scope') and self.scope is not None and 'client' in self.scope
\ No newline at end of file
+    async def receive(self, text_data):
+        """Handle add_rule, remove_rule and list_rules requests"""
+        try:
+            data = json.loads(text_data)
+            
+            if data.get('type') == 'add_rule':
+                rule = self.alert_engine.add_rule(self.owner_id, data.get('rule') or {})
+                await self.send(text_data=json.dumps({
+                    'type': 'rule_added',
+                    'status': 'success',
+                    'rule': rule
+                }))
+            
+            elif data.get('type') == 'remove_rule':
+                removed = self.alert_engine.remove_rule(self.owner_id, data.get('id'))
+                await self.send(text_data=json.dumps({
+                    'type': 'rule_removed',
+                    'status': 'success' if removed else 'not_found',
+                    'id': data.get('id')
+                }))
+            
+            elif data.get('type') == 'list_rules':
+                await self.send(text_data=json.dumps({
+                    'type': 'rules',
+                    'data': self.alert_engine.list_rules(self.owner_id)
+                }))
+            
+            else:
+                await self.send(text_data=json.dumps({
+                    'type': 'echo',
+                    'data': data
+                }))
+                
+        except json.JSONDecodeError:
+            await self.send(text_data=json.dumps({
+                'type': 'error',
+                'message': 'Invalid JSON format'
+            }))
+        except AlertRuleError as e:
+            await self.send(text_data=json.dumps({
+                'type': 'error',
+                'message': f'Invalid alert rule: {str(e)}'
+            }))
+        except Exception as e:
+            await self.send(text_data=json.dumps({
+                'type': 'error',
+                'message': f'Error processing request: {str(e)}'
+            }))
+    
+    def _queue_alerts(self, notes):
+        """Queue a cycle's alerts, closing a connection too slow to take them like a slow outbox"""
+        if self.alert_queue is None:
+            return
+        try:
+            self.alert_queue.put_nowait(notes)
+        except asyncio.QueueFull:
+            # Alerts can't be conflated, dropping some would silently lose them
+            logger.warning(f"Closing slow alerts connection: {self.alert_queue.qsize()} alert batches waiting")
+            self.alert_queue = None
+            self.alert_engine.remove_owner(self.owner_id)
+            if self.update_task:
+                self.update_task.cancel()
+            asyncio.create_task(self.close(code=SLOW_CONSUMER_CLOSE_CODE))
+    
+    async def send_alerts(self):
+        """Background task that forwards alerts fired for this connection's rules"""
+        try:
+            while True:
+                notes = await self.alert_queue.get()
+                await self.send(text_data=json.dumps({
+                    'type': 'alerts',
+                    'count': len(notes),
+                    'data': notes
+                }))
+                    
+        except asyncio.CancelledError:
+            logger.info("Alerts task cancelled")
+            raise
+            
+        except Exception as e:
+            logger.error(f"Error in send_alerts: {e}")
+            import traceback
+            logger.error(traceback.format_exc())
@@ -5,5 +5,9 @@ websocket_urlpatterns = [
     re_path(r'ws/exchange/$', consumers.ExchangeDataConsumer.as_asgi()),
     re_path(r'ws/exchange/all-stocks/$', consumers.AllStocksDataConsumer.as_asgi()),
     re_path(r'ws/exchange/stock-ids/$', consumers.StockIdsConsumer.as_asgi()),  # Add the new consumer
+    re_path(r'ws/exchange/screener/$', consumers.ScreenerConsumer.as_asgi()),
+    re_path(r'ws/exchange/leaderboards/$', consumers.LeaderboardConsumer.as_asgi()),
+    re_path(r'ws/exchange/trades/$', consumers.TradeTapeConsumer.as_asgi()),
+    re_path(r'ws/exchange/alerts/$', consumers.AlertsConsumer.as_asgi()),
         
 ]
\ No newline at end of file
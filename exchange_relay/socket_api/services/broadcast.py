@@ -0,0 +1,623 @@
+# socket_api/services/broadcast.py
+import asyncio
+import logging
+import time
+from collections import defaultdict
+from typing import Awaitable, Callable, Dict, Iterable, NamedTuple, Optional
+
+from django.conf import settings
+
+from api_client.services.cache_manager import get_cache
+from .encoding import Encoding, DEFAULT_ENCODING
+from .outbox import Outbox
+from .metadata_channel import get_metadata_channel, validate_metadata_mode
+from .message_formatter import (
+    build_all_stocks_message, diff_entries, format_all_stocks_entry, format_stock_update, get_fragment_cache,
+    without_metadata, FragmentCache, Projection, IDENTITY_KEY
+)
+
+logger = logging.getLogger(__name__)
+
+
+def cadence_tiers() -> Dict[str, float]:
+    """Cadence tiers clients can ask for: name -> minimum seconds between frames, 0 meaning every cycle"""
+    return getattr(settings, 'CADENCE_TIERS', {'realtime': 0, '5s': 5, '30s': 30})
+
+
+def validate_cadence(cadence: str) -> str:
+    if cadence not in cadence_tiers():
+        raise ValueError(f"Unknown cadence {cadence}, expected one of {list(cadence_tiers())}")
+    return cadence
+
+
+class Snapshot(NamedTuple):
+    """Entries produced by a hub source, with the version of each entry.
+
+    fragments is the cache holding the encoded entries, the shared one when None.
+    """
+    generation: int
+    entries: Dict[str, Dict]
+    versions: Dict[str, int]
+    fragments: Optional[FragmentCache] = None
+
+
+class Frame:
+    """A message built once per cycle and encoded at most once per wire encoding.
+
+    Frames whose data is a whole snapshot carry it, and are assembled from its
+    fragment cache so only the entries that changed get re-encoded.
+    """
+
+    def __init__(self, message: Dict, snapshot: Optional[Snapshot] = None):
+        self.message = message
+        self.snapshot = snapshot
+        self._payloads = {}
+
+    def payload(self, encoding: Encoding):
+        payload = self._payloads.get(encoding.name)
+        if payload is None:
+            if self.snapshot is not None and not encoding.columnar:
+                fragments = self.snapshot.fragments or get_fragment_cache()
+                payload = fragments.encode_message(encoding.codec, self.message, self.snapshot.versions)
+            else:
+                payload = encoding.encode(self.message)
+            self._payloads[encoding.name] = payload
+        return payload
+
+
+class FullStream:
+    """Protocol mode that sends the whole market after every committed cycle"""
+
+    def __init__(self):
+        self.subscribers = set()
+        self.generation = None
+        self.frame = None
+
+    def update(self, snapshot: Snapshot) -> Optional[Frame]:
+        if snapshot.generation == self.generation:
+            return None
+        self.generation = snapshot.generation
+        self.frame = Frame(build_all_stocks_message(snapshot.entries), snapshot)
+        return self.frame
+
+    def join_frame(self) -> Optional[Frame]:
+        return self.frame
+
+    def resync_frame(self) -> Optional[Frame]:
+        """Frame to send instead when a subscriber skipped frames: every frame is the full state"""
+        return self.frame
+
+
+class DeltaStream:
+    """Protocol mode that sends a keyframe on join and every keyframe_interval seconds,
+    and in between only the stocks and fields that changed since the previous frame.
+
+    Every frame carries a sequence number and deltas name the frame they apply to,
+    so a client that sees base_seq != its last seq knows it missed a frame and can
+    reconnect (or wait for the next keyframe).
+    """
+
+    def __init__(self, keyframe_interval: float):
+        self.subscribers = set()
+        self.keyframe_interval = keyframe_interval
+        self.generation = None
+        self.snapshot = None
+        self.seq = 0
+        self.last_keyframe_at = None
+        self._keyframe = (None, None)
+        self.clock = time.monotonic
+
+    def update(self, snapshot: Snapshot) -> Optional[Frame]:
+        now = self.clock()
+        keyframe_due = self.last_keyframe_at is None or now - self.last_keyframe_at >= self.keyframe_interval
+        if snapshot.generation == self.generation and not keyframe_due:
+            return None
+
+        self.generation = snapshot.generation
+        previous_entries = self.snapshot.entries if self.snapshot else {}
+        self.snapshot = snapshot
+        self.seq += 1
+
+        if keyframe_due:
+            self.last_keyframe_at = now
+            return self.join_frame()
+
+        changed, removed = diff_entries(previous_entries, snapshot.entries)
+        return Frame(build_all_stocks_message(
+            changed, 'all_stocks_delta', seq=self.seq, base_seq=self.seq - 1, removed=removed
+        ))
+
+    def join_frame(self) -> Optional[Frame]:
+        if self.generation is None:
+            return None
+        # Joiners within the same frame share one encoded keyframe
+        if self._keyframe[0] != self.seq:
+            self._keyframe = (self.seq, Frame(build_all_stocks_message(
+                self.snapshot.entries, 'all_stocks_keyframe', seq=self.seq
+            ), self.snapshot))
+        return self._keyframe[1]
+
+    def resync_frame(self) -> Optional[Frame]:
+        """Frame to send instead when a subscriber skipped frames: deltas don't chain, so a keyframe"""
+        return self.join_frame()
+
+
+class BroadcastHub:
+    """Builds each frame once per protocol mode and projection, and fans the same encoded payload
+    out to every subscriber.
+
+    The cache lives in this process, so an in-process hub is used rather than a
+    channel-layer group: the frame never has to leave the process to reach the
+    consumers, and one producer task runs only while someone is subscribed.
+
+    The producer sleeps until the cache commits a cycle, waking at most every
+    idle_interval seconds on its own so time-based frames such as keyframes go out.
+    A frame is encoded once for each wire encoding its subscribers negotiated, and
+    handed to each subscriber's outbox so one slow client never holds up the rest.
+
+    Subscribers asking for the same fields and symbols share one Projection and
+    so one stream per mode; a narrow projection makes frames smaller and cheaper.
+    Each stream also belongs to a cadence tier and builds at most one frame per
+    tier interval, so low-rate subscribers cost next to nothing. Subscribers whose
+    projection keeps metadata separate get it from the metadata channel instead.
+    """
+
+    def __init__(self, name: str, source: Callable[[], Awaitable[Optional[Snapshot]]], idle_interval: float,
+                 stream_factories: Dict[str, Callable[[], object]]):
+        self.name = name
+        self.source = source
+        self.idle_interval = idle_interval
+        self.cache_instance = get_cache()
+        self.stream_factories = stream_factories
+        # (mode, projection key, cadence) -> stream, and projection key -> shared projection
+        self.streams = {}
+        self.projections = {}
+        self.modes = {}
+        self.stream_keys = {}
+        self.encodings = {}
+        self.outboxes = {}
+        self.snapshot = None
+        # projection key -> the current snapshot projected
+        self._projected = {}
+        self.metadata_channel = get_metadata_channel()
+        self.task = None
+        self.clock = time.monotonic
+
+    async def subscribe(self, consumer, mode: str = 'full', encoding: Encoding = DEFAULT_ENCODING,
+                        projection: Optional[Projection] = None, cadence: str = 'realtime'):
+        if mode not in self.stream_factories:
+            raise ValueError(f"Unknown mode {mode}, expected one of {list(self.stream_factories)}")
+        validate_cadence(cadence)
+        self.unsubscribe(consumer)
+
+        projection = self.projections.setdefault(projection.key, projection) if projection else None
+        key = (mode, projection.key if projection else IDENTITY_KEY, cadence)
+        stream = self.streams.get(key)
+        if stream is None:
+            stream = self.streams[key] = self.stream_factories[mode]()
+            stream.projection = projection
+            stream.interval = cadence_tiers()[cadence]
+            stream.last_frame_at = None
+            if self.snapshot is not None:
+                stream.update(self._project(stream.projection))
+                stream.last_frame_at = self.clock()
+        stream.subscribers.add(consumer)
+        self.modes[consumer] = mode
+        self.stream_keys[consumer] = key
+        self.encodings[consumer] = encoding
+        self.outboxes[consumer] = new_outbox(consumer, self.unsubscribe)
+        if projection is not None and projection.separate_metadata:
+            # The metadata snapshot goes out ahead of the first frame
+            await self.metadata_channel.refresh()
+            self.metadata_channel.subscribe(consumer, self.outboxes[consumer], encoding, lambda: projection.symbols)
+
+        # New subscribers get the current state right away instead of waiting for the next cycle
+        frame = stream.join_frame()
+        if frame is not None:
+            self._send(consumer, frame)
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._run())
+        logger.info(f"{self.name} hub has {len(self.modes)} subscribers")
+
+    def unsubscribe(self, consumer):
+        self.modes.pop(consumer, None)
+        key = self.stream_keys.pop(consumer, None)
+        self.encodings.pop(consumer, None)
+        self.metadata_channel.unsubscribe(consumer)
+        outbox = self.outboxes.pop(consumer, None)
+        if outbox:
+            outbox.close()
+        if key is None:
+            return
+        stream = self.streams[key]
+        stream.subscribers.discard(consumer)
+        if not stream.subscribers:
+            del self.streams[key]
+            # Forget the projection once no stream in any mode uses it
+            if not any(stream_key[1] == key[1] for stream_key in self.streams):
+                self.projections.pop(key[1], None)
+                self._projected.pop(key[1], None)
+        if not self.modes and self.task:
+            # Nobody is listening, stop producing
+            self.task.cancel()
+            self.task = None
+        logger.info(f"{self.name} hub has {len(self.modes)} subscribers")
+
+    def broadcast(self, subscribers, frame: Frame):
+        for consumer in list(subscribers):
+            self._send(consumer, frame)
+
+    def _send(self, consumer, frame: Frame):
+        outbox = self.outboxes.get(consumer)
+        if outbox is None:
+            return
+        encoding = self.encodings.get(consumer, DEFAULT_ENCODING)
+        stream = self.streams[self.stream_keys[consumer]]
+        outbox.put(
+            self.modes[consumer],
+            lambda: encoding.send_kwargs(frame.payload(encoding)),
+            conflate=lambda: self._resync_payload(stream, encoding)
+        )
+
+    @staticmethod
+    def _resync_payload(stream, encoding: Encoding):
+        frame = stream.resync_frame()
+        return lambda: encoding.send_kwargs(frame.payload(encoding))
+
+    def connection_stats(self):
+        """Per-connection outbox counters"""
+        return [
+            {
+                **outbox.stats(),
+                'mode': self.modes.get(consumer),
+                'cadence': self.stream_keys[consumer][2],
+                'encoding': self.encodings[consumer].name,
+                'fields': self.stream_keys[consumer][1][0],
+                'symbols': len(self.stream_keys[consumer][1][1] or ()) or None,
+                'metadata': self.stream_keys[consumer][1][2]
+            }
+            for consumer, outbox in list(self.outboxes.items())
+        ]
+
+    def _project(self, projection: Optional[Projection]) -> Snapshot:
+        """The current snapshot as seen through a projection, computed once per cycle per projection"""
+        if projection is None or projection.is_identity:
+            return self.snapshot
+        projected = self._projected.get(projection.key)
+        if projected is None or projected.generation != self.snapshot.generation:
+            entries = projection.apply(self.snapshot.entries, self.snapshot.versions)
+            projected = self._projected[projection.key] = Snapshot(
+                self.snapshot.generation, entries, self.snapshot.versions, projection.fragment_cache
+            )
+        return projected
+
+    def _is_due(self, stream, now) -> bool:
+        return not stream.interval or stream.last_frame_at is None or now - stream.last_frame_at >= stream.interval
+
+    def _next_wakeup(self, now) -> float:
+        """Seconds until the producer has to run again without a commit: the idle interval,
+        or sooner when a slower tier has a change waiting for its interval to pass"""
+        timeout = self.idle_interval
+        for stream in self.streams.values():
+            if stream.interval and stream.last_frame_at is not None and stream.generation != self.snapshot.generation:
+                timeout = min(timeout, max(stream.interval - (now - stream.last_frame_at), 0))
+        return timeout
+
+    async def _run(self):
+        """Producer task: one frame per mode, projection and cadence tier per interval, whatever the number
+        of subscribers"""
+        try:
+            generation = 0
+            while self.modes:
+                try:
+                    generation = self.cache_instance.generation
+                    snapshot = await self.source()
+                    if snapshot is not None:
+                        self.snapshot = snapshot
+                    if self.metadata_channel.subscribers:
+                        # Metadata changes go out ahead of the frames of the same cycle
+                        await self.metadata_channel.refresh()
+                        self.metadata_channel.publish()
+                    timeout = self.idle_interval
+                    if self.snapshot is not None:
+                        now = self.clock()
+                        for stream in list(self.streams.values()):
+                            if not self._is_due(stream, now):
+                                continue
+                            frame = stream.update(self._project(stream.projection))
+                            if frame is not None:
+                                stream.last_frame_at = now
+                                self.broadcast(stream.subscribers, frame)
+                        timeout = self._next_wakeup(now)
+                    else:
+                        logger.info(f"No data for {self.name} yet, waiting for initial data load...")
+                except Exception as e:
+                    logger.error(f"Error in {self.name} producer: {e}")
+                    import traceback
+                    logger.error(traceback.format_exc())
+                    timeout = self.idle_interval
+                await self.cache_instance.wait_for_update(generation, timeout=timeout)
+        except asyncio.CancelledError:
+            logger.info(f"{self.name} producer cancelled")
+            raise
+
+
+class AllStocksSource:
+    """Formats the all-stocks entries, only when the cache committed a new cycle.
+
+    Entries of instruments whose version didn't move are carried over as the
+    same objects, so they are neither re-formatted nor re-encoded.
+    """
+
+    def __init__(self):
+        self.cache_instance = get_cache()
+        self.generation = None
+        # stock_id -> (version, entry)
+        self.entries = {}
+
+    async def __call__(self) -> Optional[Snapshot]:
+        generation = self.cache_instance.generation
+        if generation == self.generation:
+            return None
+        # Read the versions first: an entry may then be newer than its version, never older
+        versions = dict(self.cache_instance.versions)
+        summary = await self.cache_instance.get_all_stocks_summary()
+        if not summary:
+            return None
+        self.generation = generation
+
+        entries = {}
+        formatted = 0
+        for stock_id, stock_summary in summary.items():
+            version = versions.get(stock_id)
+            previous = self.entries.get(stock_id)
+            if previous is None or version is None or previous[0] != version:
+                previous = self.entries[stock_id] = (version, format_all_stocks_entry(stock_summary))
+                formatted += 1
+            entries[stock_id] = previous[1]
+        for stock_id in [stock_id for stock_id in self.entries if stock_id not in summary]:
+            del self.entries[stock_id]
+
+        logger.info(f"Formatted {formatted} of {len(summary)} all-stocks entries (generation {generation})")
+        return Snapshot(generation, entries, versions)
+
+
+class SymbolHub:
+    """Per-symbol subscription groups for the exchange stream.
+
+    Each subscribed symbol's update is formatted once per cycle and encoded once
+    per codec in use, then shared by every connection watching it; each
+    connection receives all of its symbols batched into a single frame, through
+    its own outbox. Connections are grouped by cadence tier, and a tier is sent
+    at most once per its interval. Connections that keep metadata separate get
+    updates without it, and their symbols' metadata from the metadata channel.
+    """
+
+    def __init__(self):
+        self.cache_instance = get_cache()
+        # symbol -> connections, and connection -> symbols
+        self.groups = defaultdict(set)
+        self.subscriptions = {}
+        self.encodings = {}
+        self.outboxes = {}
+        self.cadences = {}
+        # Connections that get metadata on the metadata channel
+        self.separate_metadata = set()
+        # cadence -> (time, generation) of the last frames sent to that tier
+        self.tier_sent = {}
+        # symbol -> (generation, update, {(codec name, without metadata): encoded update})
+        self.fragments = {}
+        # connection -> symbols of its join frame not sent yet
+        self.joining = {}
+        self.metadata_channel = get_metadata_channel()
+        self.task = None
+        self.clock = time.monotonic
+
+    async def subscribe(self, consumer, symbols: Iterable[str], encoding: Encoding = DEFAULT_ENCODING,
+                        cadence: Optional[str] = None, metadata: Optional[str] = None):
+        if cadence is not None:
+            self.cadences[consumer] = validate_cadence(cadence)
+        self.cadences.setdefault(consumer, 'realtime')
+        if metadata is not None:
+            validate_metadata_mode(metadata)
+            if metadata == 'separate':
+                self.separate_metadata.add(consumer)
+            else:
+                self.separate_metadata.discard(consumer)
+                self.metadata_channel.unsubscribe(consumer)
+        current = self.subscriptions.setdefault(consumer, set())
+        self.encodings[consumer] = encoding
+        if consumer not in self.outboxes:
+            self.outboxes[consumer] = new_outbox(consumer, self.unsubscribe)
+        new_symbols = set(symbols) - current
+        current.update(new_symbols)
+        for symbol in new_symbols:
+            self.groups[symbol].add(consumer)
+
+        if consumer in self.separate_metadata:
+            # A snapshot covering the whole subscription goes out ahead of the new symbols
+            await self.metadata_channel.refresh()
+            self.metadata_channel.subscribe(consumer, self.outboxes[consumer], encoding, lambda: self.symbols_for(consumer))
+
+        # Send the newly added symbols right away instead of waiting for the next cycle
+        await self._refresh(new_symbols)
+        self._join(consumer, new_symbols)
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._run())
+
+    def unsubscribe(self, consumer, symbols: Optional[Iterable[str]] = None):
+        """Leave the given symbols, or without symbols drop the connection altogether.
+
+        The connection's cadence, encoding, metadata mode and outbox are kept
+        until it disconnects, even when it has no symbols left.
+        """
+        current = self.subscriptions.get(consumer, set())
+        removed = set(current) if symbols is None else current.intersection(symbols)
+        current.difference_update(removed)
+        for symbol in removed:
+            group = self.groups.get(symbol)
+            if group is not None:
+                group.discard(consumer)
+                if not group:
+                    del self.groups[symbol]
+                    self.fragments.pop(symbol, None)
+        if symbols is None:
+            self.subscriptions.pop(consumer, None)
+            self.joining.pop(consumer, None)
+            self.encodings.pop(consumer, None)
+            self.cadences.pop(consumer, None)
+            self.separate_metadata.discard(consumer)
+            self.metadata_channel.unsubscribe(consumer)
+            outbox = self.outboxes.pop(consumer, None)
+            if outbox:
+                outbox.close()
+        if not self.groups and self.task:
+            self.task.cancel()
+            self.task = None
+
+    def symbols_for(self, consumer):
+        return self.subscriptions.get(consumer, set())
+
+    async def _refresh(self, symbols):
+        """Format the given symbols, skipping those already formatted this cycle"""
+        generation = self.cache_instance.generation
+        stale = [symbol for symbol in symbols if self.fragments.get(symbol, (None,))[0] != generation]
+        if stale:
+            stocks = await self.cache_instance.get_stocks_data(stale)
+            for symbol, stock_data in stocks.items():
+                if stock_data.get('time'):
+                    self.fragments[symbol] = (generation, format_stock_update(stock_data), {})
+        missing = [symbol for symbol in symbols if symbol not in self.fragments]
+        if missing:
+            logger.info(f"Missing data for stocks: {missing}")
+
+    def _encoded(self, symbol, codec, separate_metadata=False):
+        _, update, payloads = self.fragments[symbol]
+        payload = payloads.get((codec.name, separate_metadata))
+        if payload is None:
+            payload = payloads[(codec.name, separate_metadata)] = codec.pair(
+                symbol, without_metadata(update) if separate_metadata else update
+            )
+        return payload
+
+    def _send(self, consumer, key, symbols=None):
+        """Queue a frame with the given symbols, or all of the connection's symbols when they're not given.
+
+        The frame is assembled when the outbox sends it, from the latest fragments.
+        """
+        outbox = self.outboxes.get(consumer)
+        if outbox is not None:
+            outbox.put(key, lambda: self._payload(consumer, self.symbols_for(consumer) if symbols is None else symbols))
+
+    def _join(self, consumer, symbols):
+        """Queue the first frame of newly added symbols, merged into a join frame that wasn't sent yet"""
+        outbox = self.outboxes.get(consumer)
+        if outbox is not None:
+            self.joining.setdefault(consumer, set()).update(symbols)
+            outbox.put('join', lambda: self._payload(consumer, self.joining.pop(consumer, set()) & self.symbols_for(consumer)))
+
+    def _payload(self, consumer, symbols):
+        codec = self.encodings.get(consumer, DEFAULT_ENCODING).codec
+        head = {'type': 'stock_update', 'timestamp': asyncio.get_running_loop().time()}
+        separate_metadata = consumer in self.separate_metadata
+        payload = codec.join(head, 'data', [
+            self._encoded(symbol, codec, separate_metadata) for symbol in symbols if symbol in self.fragments
+        ])
+        return {'bytes_data' if codec.binary else 'text_data': payload}
+
+    def connection_stats(self):
+        """Per-connection outbox counters"""
+        return [
+            {
+                **outbox.stats(),
+                'symbols': len(self.symbols_for(consumer)),
+                'cadence': self.cadences.get(consumer),
+                'encoding': self.encodings[consumer].name,
+                'metadata': 'separate' if consumer in self.separate_metadata else 'inline'
+            }
+            for consumer, outbox in list(self.outboxes.items())
+        ]
+
+    def _due_tiers(self, now, generation):
+        """Tiers in use that haven't seen this generation and whose interval has passed"""
+        tiers = cadence_tiers()
+        due = set()
+        for cadence in set(self.cadences.values()):
+            sent_at, sent_generation = self.tier_sent.get(cadence, (None, None))
+            if sent_generation != generation and (not tiers[cadence] or sent_at is None or now - sent_at >= tiers[cadence]):
+                due.add(cadence)
+        return due
+
+    def _next_due(self, now, generation) -> Optional[float]:
+        """Seconds until a slower tier with a change waiting may be sent, None to just wait for the next commit"""
+        tiers = cadence_tiers()
+        timeout = None
+        for cadence in set(self.cadences.values()):
+            sent_at, sent_generation = self.tier_sent.get(cadence, (None, None))
+            if tiers[cadence] and sent_at is not None and sent_generation != generation:
+                remaining = max(tiers[cadence] - (now - sent_at), 0)
+                timeout = remaining if timeout is None else min(timeout, remaining)
+        return timeout
+
+    async def _run(self):
+        """Producer task: format every watched symbol once per cycle and batch per connection, per cadence tier"""
+        try:
+            generation = self.cache_instance.generation
+            while self.groups:
+                generation = await self.cache_instance.wait_for_update(
+                    generation, timeout=self._next_due(self.clock(), generation)
+                )
+                try:
+                    now = self.clock()
+                    due = self._due_tiers(now, generation)
+                    if not due:
+                        continue
+                    await self._refresh(list(self.groups))
+                    if self.metadata_channel.subscribers:
+                        await self.metadata_channel.refresh()
+                        self.metadata_channel.publish()
+                    logger.info(f"Sending updates for {len(self.groups)} stocks to tiers {sorted(due)}")
+                    for consumer, cadence in list(self.cadences.items()):
+                        if cadence in due and self.subscriptions.get(consumer):
+                            self._send(consumer, 'update')
+                    for cadence in due:
+                        self.tier_sent[cadence] = (now, generation)
+                except Exception as e:
+                    logger.error(f"Error in exchange producer: {e}")
+                    import traceback
+                    logger.error(traceback.format_exc())
+        except asyncio.CancelledError:
+            logger.info("Exchange producer cancelled")
+            raise
+
+
+def new_outbox(consumer, on_close):
+    return Outbox(
+        consumer,
+        max_lag=getattr(settings, 'SLOW_CONSUMER_MAX_LAG', 120),
+        on_close=on_close
+    )
+
+
+# Global singleton instances
+_all_stocks_hub = None
+_symbol_hub = None
+
+def get_all_stocks_hub():
+    """Get the singleton all-stocks broadcast hub"""
+    global _all_stocks_hub
+    if _all_stocks_hub is None:
+        keyframe_interval = getattr(settings, 'ALL_STOCKS_KEYFRAME_INTERVAL', 300)
+        _all_stocks_hub = BroadcastHub('all-stocks', AllStocksSource(), keyframe_interval, {
+            'full': FullStream,
+            'delta': lambda: DeltaStream(keyframe_interval),
+        })
+    return _all_stocks_hub
+
+
+def get_symbol_hub():
+    """Get the singleton per-symbol hub for the exchange stream"""
+    global _symbol_hub
+    if _symbol_hub is None:
+        _symbol_hub = SymbolHub()
+    return _symbol_hub
@@ -0,0 +1,157 @@
+# socket_api/services/encoding.py
+import json
+from typing import Dict, Any, Iterable, List, Optional, Tuple
+from urllib.parse import parse_qs
+
+from api_client.services.metadata_records import MetadataRecord, plain
+
+try:
+    import msgpack
+except ImportError:  # msgpack is optional, the binary encodings are unavailable without it
+    msgpack = None
+
+try:
+    import orjson
+except ImportError:  # orjson is optional, the stdlib encoder is used without it
+    orjson = None
+
+
+class JsonCodec:
+    name = 'json'
+    binary = False
+
+    def dumps(self, obj: Any) -> str:
+        # Persian names are sent as UTF-8 instead of \uXXXX escapes, which are three times larger
+        if orjson is not None:
+            try:
+                return orjson.dumps(obj, default=plain, option=orjson.OPT_NON_STR_KEYS).decode('utf-8')
+            except TypeError:
+                # e.g. integers wider than 64 bits, which the stdlib encoder handles
+                pass
+        return json.dumps(obj, ensure_ascii=False, default=plain)
+
+    def pair(self, key: str, value: Any) -> str:
+        """Encode one key/value member of a mapping, to be joined later"""
+        return f'{self.dumps(key)}:{self.dumps(value)}'
+
+    def join(self, head: Dict[str, Any], field: str, pairs: List[str]) -> str:
+        """Encode {**head, field: {...}} from members that are already encoded"""
+        prefix = self.dumps(head)[:-1] + (',' if head else '')
+        return f'{prefix}{self.dumps(field)}:{{{",".join(pairs)}}}}}'
+
+
+class MsgpackCodec:
+    name = 'msgpack'
+    binary = True
+
+    def dumps(self, obj: Any) -> bytes:
+        return msgpack.packb(obj, use_bin_type=True, default=plain)
+
+    def pair(self, key: str, value: Any) -> bytes:
+        """Encode one key/value member of a map, to be joined later"""
+        return self.dumps(key) + self.dumps(value)
+
+    def join(self, head: Dict[str, Any], field: str, pairs: List[bytes]) -> bytes:
+        """Encode {**head, field: {...}} from members that are already encoded"""
+        packer = msgpack.Packer(use_bin_type=True, default=plain)
+        parts = [packer.pack_map_header(len(head) + 1)]
+        for key, value in head.items():
+            parts.append(packer.pack(key))
+            parts.append(packer.pack(value))
+        parts.append(packer.pack(field))
+        parts.append(packer.pack_map_header(len(pairs)))
+        parts.extend(pairs)
+        return b''.join(parts)
+
+
+def flatten_entry(entry: Dict[str, Any]) -> Dict[str, Any]:
+    """Flatten nested dicts and metadata records one level deep into 'outer.inner' fields"""
+    flat = {}
+    for field, value in entry.items():
+        if isinstance(value, (dict, MetadataRecord)):
+            for inner, inner_value in value.items():
+                flat[f'{field}.{inner}'] = inner_value
+        else:
+            flat[field] = value
+    return flat
+
+
+def to_columnar(data: Dict[str, Dict[str, Any]]) -> Dict[str, Any]:
+    """Turn {stock_id: entry} into a field dictionary plus column blocks.
+
+    Field names are sent once per frame in 'fields'. Entries that carry the same
+    set of fields (every entry of a full frame, most entries of a delta) share a
+    block [field indexes, ids, columns], where columns[i] holds the values of
+    fields[field_indexes[i]] in the order of ids.
+    """
+    fields = {}
+    blocks = {}
+    for stock_id, entry in data.items():
+        flat = flatten_entry(entry)
+        key = tuple(fields.setdefault(field, len(fields)) for field in flat)
+        block = blocks.get(key)
+        if block is None:
+            block = blocks[key] = ([], [[] for _ in key])
+        block[0].append(stock_id)
+        for column, value in zip(block[1], flat.values()):
+            column.append(value)
+    return {
+        'fields': list(fields),
+        'blocks': [[list(key), ids, columns] for key, (ids, columns) in blocks.items()]
+    }
+
+
+class Encoding:
+    """A wire encoding: a codec, optionally with the columnar layout for frames carrying a data mapping"""
+
+    def __init__(self, name: str, codec, columnar: bool = False):
+        self.name = name
+        self.codec = codec
+        self.columnar = columnar
+
+    @property
+    def binary(self) -> bool:
+        return self.codec.binary
+
+    def encode(self, message: Dict[str, Any]):
+        if self.columnar and isinstance(message.get('data'), dict):
+            message = {**message, 'layout': 'columnar', 'data': to_columnar(message['data'])}
+        return self.codec.dumps(message)
+
+    def send_kwargs(self, payload) -> Dict[str, Any]:
+        """Keyword arguments for consumer.send(), binary encodings go out as binary frames"""
+        return {'bytes_data': payload} if self.binary else {'text_data': payload}
+
+
+ENCODINGS = {
+    'json': Encoding('json', JsonCodec()),
+    'columnar': Encoding('columnar', JsonCodec(), columnar=True),
+}
+if msgpack is not None:
+    ENCODINGS['msgpack'] = Encoding('msgpack', MsgpackCodec())
+    ENCODINGS['columnar-msgpack'] = Encoding('columnar-msgpack', MsgpackCodec(), columnar=True)
+
+DEFAULT_ENCODING = ENCODINGS['json']
+
+
+def get_encoding(name: str) -> Encoding:
+    if name not in ENCODINGS:
+        raise ValueError(f"Unknown encoding {name}, expected one of {list(ENCODINGS)}")
+    return ENCODINGS[name]
+
+
+def negotiate_encoding(scope: Dict[str, Any]) -> Tuple[Encoding, Optional[str]]:
+    """Pick the wire encoding for a connection.
+
+    Clients ask with ?encoding=<name> or by offering the encoding name as a
+    WebSocket subprotocol. Returns the encoding and the subprotocol to accept,
+    if one was offered. Raises ValueError for an unknown ?encoding=.
+    """
+    query = parse_qs(scope.get('query_string', b'').decode())
+    if 'encoding' in query:
+        return get_encoding(query['encoding'][0]), None
+    offered: Iterable[str] = scope.get('subprotocols') or ()
+    for subprotocol in offered:
+        if subprotocol in ENCODINGS:
+            return ENCODINGS[subprotocol], subprotocol
+    return DEFAULT_ENCODING, None
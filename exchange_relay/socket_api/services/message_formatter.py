@@ -0,0 +1,242 @@
+# socket_api/services/message_formatter.py
+from collections import defaultdict
+from datetime import datetime
+from typing import Dict, Any, Iterable, List, Optional, Tuple
+
+from api_client.services.order_book import BOOK_METRIC_FIELDS
+
+# Metadata fields also exposed at the top level of each all-stocks entry for easy access
+TOP_LEVEL_METADATA_FIELDS = ('pe', 'tmax', 'tmin', 'nav', 'is_san', 'gpe', 'min_lot', 'max_lot')
+
+# How a stream carries instrument metadata: inside every market frame, or on its own channel
+METADATA_MODES = ('inline', 'separate')
+
+# Entry fields left out of market frames when metadata goes on its own channel
+INLINE_METADATA_FIELDS = frozenset(('metadata', *TOP_LEVEL_METADATA_FIELDS))
+
+# Most fields a projection may ask for
+MAX_PROJECTION_FIELDS = 100
+
+_MISSING = object()
+
+
+class ProjectionError(ValueError):
+    """Raised when a requested field projection or symbol filter is invalid"""
+
+
+def format_all_stocks_entry(stock_summary: Dict[str, Any]) -> Dict[str, Any]:
+    """Build the all-stocks entry for one stock from its cache summary"""
+    entry = dict(stock_summary)
+
+    # Some clients read 'vol' instead of 'tvol'
+    if entry.get('tvol') is not None:
+        entry['vol'] = entry['tvol']
+
+    # Using null instead of "-" for missing values
+    metadata = entry.get('metadata') or {}
+    for field in TOP_LEVEL_METADATA_FIELDS:
+        entry[field] = metadata.get(field, None)
+    return entry
+
+
+def build_all_stocks_entries(summary: Dict[str, Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+    """Build the all-stocks entries for every stock in get_all_stocks_summary()"""
+    return {stock_id: format_all_stocks_entry(stock_summary) for stock_id, stock_summary in summary.items()}
+
+
+def build_all_stocks_message(entries: Dict[str, Dict[str, Any]], message_type: str = 'all_stocks_update',
+                             **extra) -> Dict[str, Any]:
+    """Build an all-stocks message carrying full entries"""
+    return {
+        'type': message_type,
+        **extra,
+        'timestamp': datetime.now().isoformat(),
+        'count': len(entries),
+        'data': entries
+    }
+
+
+class FragmentCache:
+    """Encoded all-stocks entries keyed by instrument version.
+
+    A full frame is the same few hundred entries every cycle with only the
+    changed instruments differing, so each "stock_id": entry member is encoded
+    once per version and frames are assembled by joining the cached fragments.
+    """
+
+    def __init__(self):
+        # codec name -> {stock_id: (version, encoded member)}
+        self._fragments = defaultdict(dict)
+
+    def fragments(self, codec, entries: Dict[str, Dict[str, Any]], versions: Dict[str, int]) -> List[Any]:
+        cache = self._fragments[codec.name]
+        fragments = []
+        for stock_id, entry in entries.items():
+            version = versions.get(stock_id)
+            cached = cache.get(stock_id)
+            if cached is None or version is None or cached[0] != version:
+                cached = cache[stock_id] = (version, codec.pair(stock_id, entry))
+            fragments.append(cached[1])
+
+        # Forget instruments that left the market
+        if len(cache) > len(entries):
+            for stock_id in [stock_id for stock_id in cache if stock_id not in entries]:
+                del cache[stock_id]
+        return fragments
+
+    def encode_message(self, codec, message: Dict[str, Any], versions: Dict[str, int]):
+        """Encode a message whose 'data' maps every stock to its entry, reusing the cached entries"""
+        head = {key: value for key, value in message.items() if key != 'data'}
+        return codec.join(head, 'data', self.fragments(codec, message['data'], versions))
+
+
+# Key of the projection that sends every field of every stock, metadata included
+IDENTITY_KEY = (None, None, 'inline')
+
+
+class Projection:
+    """The fields and symbols a client asked for, compiled once and shared by every connection asking the same.
+
+    Fields name top-level entry fields, 'metadata' for the whole metadata block,
+    or 'metadata.<field>' for single metadata fields. With metadata='separate'
+    entries carry market fields only, the metadata going out on the metadata
+    channel instead. Projected entries are cached by instrument version, and
+    the projection keeps its own fragment cache since its encoded entries
+    differ from the full ones.
+    """
+
+    def __init__(self, fields: Optional[Iterable[str]] = None, symbols: Optional[Iterable[str]] = None,
+                 metadata: str = 'inline'):
+        fields = _validate_names(fields, 'fields', MAX_PROJECTION_FIELDS)
+        symbols = _validate_names(symbols, 'symbols')
+        if metadata not in METADATA_MODES:
+            raise ProjectionError(f"Unknown metadata mode {metadata}, expected one of {list(METADATA_MODES)}")
+        self.key = (fields, symbols, metadata)
+        self.separate_metadata = metadata == 'separate'
+        self.symbols = set(symbols) if symbols is not None else None
+        self.fields = None
+        self.metadata_fields = None
+        if fields is not None:
+            self.fields = [field for field in fields if not field.startswith('metadata.')]
+            if 'metadata' not in self.fields:
+                metadata_fields = [field[len('metadata.'):] for field in fields if field.startswith('metadata.')]
+                self.metadata_fields = metadata_fields or None
+        self.fragment_cache = FragmentCache()
+        # stock_id -> (version, projected entry)
+        self._entries = {}
+
+    @property
+    def is_identity(self) -> bool:
+        return self.key == IDENTITY_KEY
+
+    def project(self, entry: Dict[str, Any]) -> Dict[str, Any]:
+        if self.fields is None:
+            if self.separate_metadata:
+                return {field: value for field, value in entry.items() if field not in INLINE_METADATA_FIELDS}
+            return entry
+        projected = {field: entry[field] for field in self.fields if field in entry}
+        if self.separate_metadata:
+            for field in INLINE_METADATA_FIELDS.intersection(projected):
+                del projected[field]
+        elif self.metadata_fields:
+            metadata = entry.get('metadata') or {}
+            projected['metadata'] = {field: metadata[field] for field in self.metadata_fields if field in metadata}
+        return projected
+
+    def apply(self, entries: Dict[str, Dict[str, Any]], versions: Dict[str, int]) -> Dict[str, Dict[str, Any]]:
+        """Project every entry, reusing the projected entries of instruments whose version didn't move"""
+        projected = {}
+        for stock_id, entry in entries.items():
+            if self.symbols is not None and stock_id not in self.symbols:
+                continue
+            version = versions.get(stock_id)
+            cached = self._entries.get(stock_id)
+            if cached is None or version is None or cached[0] != version:
+                cached = self._entries[stock_id] = (version, self.project(entry))
+            projected[stock_id] = cached[1]
+        if len(self._entries) > len(projected):
+            for stock_id in [stock_id for stock_id in self._entries if stock_id not in projected]:
+                del self._entries[stock_id]
+        return projected
+
+
+def _validate_names(names, label, limit=None) -> Optional[Tuple[str, ...]]:
+    """Normalize a list (or comma-separated string) of names into a sorted tuple, None meaning all"""
+    if names is None:
+        return None
+    if isinstance(names, str):
+        names = [name for name in names.split(',') if name]
+    if not isinstance(names, (list, tuple, set)) or not all(isinstance(name, str) and name for name in names):
+        raise ProjectionError(f"{label} must be a list of names")
+    if not names:
+        raise ProjectionError(f"{label} must not be empty")
+    if limit is not None and len(names) > limit:
+        raise ProjectionError(f"At most {limit} {label}")
+    return tuple(sorted(set(names)))
+
+
+def diff_entries(previous: Dict[str, Dict[str, Any]],
+                 current: Dict[str, Dict[str, Any]]) -> Tuple[Dict[str, Dict[str, Any]], List[str]]:
+    """Return the changed fields of each changed stock, and the stocks that disappeared.
+
+    Nested values such as 'metadata' are compared and sent as a whole.
+    """
+    changed = {}
+    for stock_id, entry in current.items():
+        old_entry = previous.get(stock_id)
+        if old_entry is None:
+            changed[stock_id] = entry
+        elif old_entry is not entry:
+            fields = {field: value for field, value in entry.items() if old_entry.get(field, _MISSING) != value}
+            if fields:
+                changed[stock_id] = fields
+    removed = [stock_id for stock_id in previous if stock_id not in current]
+    return changed, removed
+
+
+def _last(stock_data, field):
+    return stock_data[field][-1] if stock_data.get(field) else None
+
+
+def format_stock_update(stock_data: Dict[str, Any]) -> Dict[str, Any]:
+    """Build the per-stock update sent on the exchange stream from the stock's cached series"""
+    return {
+        'timestamp': stock_data['time'][-1].isoformat() if stock_data.get('time') else None,
+        'price': {
+            'last': _last(stock_data, 'pl'),
+            'closing': _last(stock_data, 'pc'),
+            'min': _last(stock_data, 'pmin'),
+            'max': _last(stock_data, 'pmax'),
+            'yesterday': _last(stock_data, 'py'),
+            'open': _last(stock_data, 'pf')
+        },
+        'volume': _last(stock_data, 'tvol'),
+        'value': _last(stock_data, 'tval'),
+        'transactions': _last(stock_data, 'tno'),
+        'client_type': {
+            'buy_legal': _last(stock_data, 'Buy_I_Volume'),
+            'buy_natural': _last(stock_data, 'Buy_N_Volume'),
+            'sell_legal': _last(stock_data, 'Sell_I_Volume'),
+            'sell_natural': _last(stock_data, 'Sell_N_Volume')
+        },
+        # Order book metrics (spread, imbalance, queues)
+        'order_book': {field: _last(stock_data, field) for field in BOOK_METRIC_FIELDS},
+        # Include metadata
+        'metadata': stock_data.get('metadata', {})
+    }
+
+
+def without_metadata(update: Dict[str, Any]) -> Dict[str, Any]:
+    """A stock update for a connection that gets metadata on the metadata channel"""
+    return {field: value for field, value in update.items() if field != 'metadata'}
+
+
+# Global singleton instance
+_fragment_cache = None
+
+def get_fragment_cache():
+    """Get the singleton all-stocks fragment cache"""
+    global _fragment_cache
+    if _fragment_cache is None:
+        _fragment_cache = FragmentCache()
+    return _fragment_cache
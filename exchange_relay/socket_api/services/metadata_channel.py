@@ -0,0 +1,134 @@
+# socket_api/services/metadata_channel.py
+import logging
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any, Callable, Dict, Optional, Set
+
+from api_client.services.cache_manager import get_cache
+from .encoding import Encoding
+from .message_formatter import METADATA_MODES
+
+logger = logging.getLogger(__name__)
+
+
+def validate_metadata_mode(mode: str) -> str:
+    if mode not in METADATA_MODES:
+        raise ValueError(f"Unknown metadata mode {mode}, expected one of {list(METADATA_MODES)}")
+    return mode
+
+
+class MetadataChannel:
+    """Instrument metadata for connections whose market frames carry instrument IDs only.
+
+    A connection gets a metadata_snapshot of its instruments when it subscribes,
+    and after that a metadata_delta only when the metadata version moves, with
+    the records that changed since the version it was last sent. Messages are
+    built when the connection's outbox sends them, so a delta that waited behind
+    a slow socket still starts from what the client actually has.
+
+    The tables of recent versions are kept to diff against; they are shared
+    with the cache, not copied. A client whose version was forgotten gets a new
+    snapshot. Encoded messages are shared by connections asking the same.
+    """
+
+    def __init__(self, max_versions: int = 4):
+        self.cache_instance = get_cache()
+        self.max_versions = max_versions
+        self.version = None
+        # version -> metadata table
+        self._tables = OrderedDict()
+        # consumer -> (outbox, encoding, symbols getter)
+        self.subscribers = {}
+        # consumer -> last version sent, None before the snapshot
+        self.sent = {}
+        self._queued = set()
+        # (base version, version, symbols, encoding name) -> send kwargs, for the current version
+        self._payloads = {}
+        self.messages_built = 0
+
+    async def refresh(self):
+        """Pick up the cache's current metadata table"""
+        version, table = await self.cache_instance.get_metadata_table()
+        if version == self.version:
+            return
+        self.version = version
+        self._tables[version] = table
+        while len(self._tables) > self.max_versions:
+            self._tables.popitem(last=False)
+        self._payloads = {}
+        logger.info(f"Metadata channel at version {version} for {len(self.subscribers)} connections")
+
+    def subscribe(self, consumer, outbox, encoding: Encoding, symbols: Callable[[], Optional[Set[str]]]):
+        """Queue a snapshot of the consumer's instruments, deltas follow on publish()"""
+        self.subscribers[consumer] = (outbox, encoding, symbols)
+        self.sent[consumer] = None
+        self._queue(consumer)
+
+    def unsubscribe(self, consumer):
+        self.subscribers.pop(consumer, None)
+        self.sent.pop(consumer, None)
+        self._queued.discard(consumer)
+
+    def publish(self):
+        """Queue a delta for every connection that is behind the current version and watches any instrument"""
+        for consumer, (_, _, symbols) in list(self.subscribers.items()):
+            if self.sent.get(consumer) != self.version and symbols() != set():
+                self._queue(consumer)
+
+    def _queue(self, consumer):
+        if consumer in self._queued:
+            return
+        self._queued.add(consumer)
+        self.subscribers[consumer][0].put('metadata', lambda: self._payload(consumer))
+
+    def _payload(self, consumer) -> Dict[str, Any]:
+        self._queued.discard(consumer)
+        _, encoding, symbols = self.subscribers[consumer]
+        symbols = symbols()
+        base = self.sent.get(consumer)
+        if base not in self._tables:
+            base = None
+        key = (base, self.version, tuple(sorted(symbols)) if symbols is not None else None, encoding.name)
+        payload = self._payloads.get(key)
+        if payload is None:
+            payload = self._payloads[key] = encoding.send_kwargs(encoding.encode(self._message(base, symbols)))
+            self.messages_built += 1
+        self.sent[consumer] = self.version
+        return payload
+
+    def _message(self, base: Optional[int], symbols: Optional[Set[str]]) -> Dict[str, Any]:
+        table = self._tables.get(self.version, {})
+        if symbols is not None:
+            table = {stock_id: table[stock_id] for stock_id in symbols if stock_id in table}
+        if base is None:
+            return {
+                'type': 'metadata_snapshot',
+                'version': self.version,
+                'timestamp': datetime.now().isoformat(),
+                'count': len(table),
+                'data': table
+            }
+        previous = self._tables[base]
+        if symbols is not None:
+            previous = {stock_id: previous[stock_id] for stock_id in symbols if stock_id in previous}
+        changed = {stock_id: record for stock_id, record in table.items() if previous.get(stock_id) != record}
+        return {
+            'type': 'metadata_delta',
+            'version': self.version,
+            'base_version': base,
+            'timestamp': datetime.now().isoformat(),
+            'count': len(changed),
+            'data': changed,
+            'removed': [stock_id for stock_id in previous if stock_id not in table]
+        }
+
+
+# Global singleton instance
+_metadata_channel = None
+
+def get_metadata_channel():
+    """Get the singleton metadata channel"""
+    global _metadata_channel
+    if _metadata_channel is None:
+        _metadata_channel = MetadataChannel()
+    return _metadata_channel
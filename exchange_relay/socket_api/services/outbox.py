@@ -0,0 +1,137 @@
+# socket_api/services/outbox.py
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# Close code sent to connections dropped for falling too far behind
+SLOW_CONSUMER_CLOSE_CODE = 4008
+
+
+class Outbox:
+    """Outbound queue of one connection, with "latest state wins" conflation.
+
+    Frames are queued under a key. A frame replaces an unsent frame with the same
+    key instead of queueing behind it, so a slow client skips stale states rather
+    than letting them pile up in memory; a connection holds at most one frame per
+    key (update, join, metadata). A dedicated task does the sending, so a slow
+    socket only holds up its own connection.
+
+    Lag is how long the oldest undelivered state has been waiting for
+    consumer.send() to return. A connection whose lag passes max_lag is closed.
+    Daphne doesn't apply backpressure there: send() returns once the frame is
+    handed to the server, which buffers it in the transport. So under Daphne the
+    lag only catches a stalled send, not a client that reads slowly, and that
+    client's backlog grows in the server's buffer instead of here.
+    """
+
+    def __init__(self, consumer, max_lag: float, on_close: Optional[Callable[[Any], None]] = None):
+        self.consumer = consumer
+        self.max_lag = max_lag
+        self.on_close = on_close
+        # key -> (payload factory, time the oldest state it replaced was queued)
+        self.pending = OrderedDict()
+        self.sending_since = None
+        self.sent = 0
+        self.dropped = 0
+        self.bytes_sent = 0
+        self.peak_lag = 0.0
+        self.closed = False
+        self.clock = time.monotonic
+        self._wakeup = asyncio.Event()
+        self.task = asyncio.create_task(self._run())
+
+    def put(self, key: str, payload: Callable[[], Dict[str, Any]],
+            conflate: Optional[Callable[[], Callable[[], Dict[str, Any]]]] = None):
+        """Queue a frame as a factory of consumer.send() keyword arguments.
+
+        When an unsent frame with the same key is replaced and ``conflate`` is
+        given, the frame queued is conflate() instead, e.g. a keyframe for a
+        stream whose frames are deltas and can't be skipped.
+        """
+        if self.closed:
+            return
+        now = self.clock()
+        queued_at = now
+        if key in self.pending:
+            _, queued_at = self.pending.pop(key)
+            self.dropped += 1
+            if conflate is not None:
+                payload = conflate()
+        self.pending[key] = (payload, queued_at)
+        self._wakeup.set()
+        self.check_lag(now)
+
+    @property
+    def lag(self) -> float:
+        return self._lag(self.clock())
+
+    def _lag(self, now) -> float:
+        waiting = [queued_at for _, queued_at in self.pending.values()]
+        if self.sending_since is not None:
+            waiting.append(self.sending_since)
+        return now - min(waiting) if waiting else 0.0
+
+    def check_lag(self, now=None):
+        lag = self._lag(self.clock() if now is None else now)
+        self.peak_lag = max(self.peak_lag, lag)
+        if lag > self.max_lag and not self.closed:
+            logger.warning(f"Closing slow connection {self.client}: {lag:.1f}s behind, {self.dropped} frames dropped")
+            self.close()
+            asyncio.create_task(self._disconnect())
+
+    def close(self):
+        self.closed = True
+        self.pending.clear()
+        if self.task:
+            self.task.cancel()
+            self.task = None
+
+    async def _disconnect(self):
+        if self.on_close:
+            self.on_close(self.consumer)
+        try:
+            await self.consumer.close(code=SLOW_CONSUMER_CLOSE_CODE)
+        except Exception as e:
+            logger.error(f"Error closing slow connection {self.client}: {e}")
+
+    async def _run(self):
+        try:
+            while True:
+                await self._wakeup.wait()
+                self._wakeup.clear()
+                while self.pending:
+                    _, (payload, queued_at) = self.pending.popitem(last=False)
+                    self.sending_since = queued_at
+                    kwargs = payload()
+                    await self.consumer.send(**kwargs)
+                    self.sending_since = None
+                    self.sent += 1
+                    data = kwargs.get('text_data') or kwargs.get('bytes_data') or ''
+                    self.bytes_sent += len(data.encode('utf-8') if isinstance(data, str) else data)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Error sending to {self.client}, closing its outbox: {e}")
+            self.close()
+            if self.on_close:
+                self.on_close(self.consumer)
+
+    @property
+    def client(self) -> str:
+        client = (getattr(self.consumer, 'scope', None) or {}).get('client')
+        return f'{client[0]}:{client[1]}' if client else 'unknown'
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'client': self.client,
+            'queued': len(self.pending),
+            'sent': self.sent,
+            'dropped': self.dropped,
+            'bytes_sent': self.bytes_sent,
+            'lag': round(self.lag, 3),
+            'peak_lag': round(self.peak_lag, 3),
+        }
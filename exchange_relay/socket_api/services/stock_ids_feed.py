@@ -0,0 +1,160 @@
+# socket_api/services/stock_ids_feed.py
+import asyncio
+import hashlib
+import json
+import logging
+import time
+from datetime import datetime
+from typing import Any, Dict, NamedTuple, Optional
+
+from django.conf import settings
+
+from api_client.services.stock_metadata import get_metadata_client
+from .encoding import DEFAULT_ENCODING
+from .outbox import Outbox
+
+logger = logging.getLogger(__name__)
+
+
+class StockIdsSnapshot(NamedTuple):
+    content_hash: str
+    count: int
+    # The stock_ids_update message, encoded once for every connection
+    payload: str
+
+
+class StockIdsFeed:
+    """One live-IDs feed shared by every stock-IDs connection.
+
+    Upstream fetches are single-flight: concurrent callers wait on the fetch
+    already in progress, and nobody fetches again until the data is ttl seconds
+    old. The message is encoded and hashed once per change, and new connections
+    get the cached snapshot straight away without touching the upstream.
+    """
+
+    def __init__(self, ttl: float, retry_interval: float = 5):
+        self.metadata_client = get_metadata_client()
+        self.ttl = ttl
+        self.retry_interval = retry_interval
+        self.snapshot: Optional[StockIdsSnapshot] = None
+        self.fetched_at = None
+        self.fetches = 0
+        self._inflight = None
+        self.outboxes = {}
+        self.task = None
+        self.clock = time.monotonic
+
+    def is_fresh(self, max_age: Optional[float] = None) -> bool:
+        max_age = self.ttl if max_age is None else max_age
+        return self.fetched_at is not None and self.clock() - self.fetched_at < max_age
+
+    async def refresh(self, max_age: Optional[float] = None) -> Optional[StockIdsSnapshot]:
+        """Fetch from the upstream unless the data is younger than max_age (the ttl by default)"""
+        if self.is_fresh(max_age):
+            return self.snapshot
+        if self._inflight is None:
+            self._inflight = asyncio.ensure_future(self._fetch())
+        # Shielded so a caller that disconnects doesn't cancel the fetch the others are waiting on
+        return await asyncio.shield(self._inflight)
+
+    async def _fetch(self) -> Optional[StockIdsSnapshot]:
+        try:
+            logger.info("Fetching fresh live IDs data...")
+            self.fetches += 1
+            await self.metadata_client.fetch_live_ids()
+            self._rebuild()
+            # Without any data yet the next caller should try again rather than wait out the ttl
+            if self.snapshot is not None:
+                self.fetched_at = self.clock()
+            return self.snapshot
+        finally:
+            self._inflight = None
+
+    def _rebuild(self) -> bool:
+        """Re-encode the message if the IDs changed; returns whether they did"""
+        stock_ids_and_names = self.metadata_client.get_all_ids_and_names()
+        if not stock_ids_and_names:
+            return False
+        content = json.dumps(stock_ids_and_names, sort_keys=True).encode('utf-8')
+        content_hash = hashlib.sha1(content).hexdigest()
+        if self.snapshot and self.snapshot.content_hash == content_hash:
+            logger.info("No changes in stock IDs data")
+            return False
+
+        payload = DEFAULT_ENCODING.codec.dumps({
+            'type': 'stock_ids_update',
+            'timestamp': datetime.now().isoformat(),
+            'count': len(stock_ids_and_names),
+            'hash': content_hash,
+            'data': stock_ids_and_names
+        })
+        self.snapshot = StockIdsSnapshot(content_hash, len(stock_ids_and_names), payload)
+        logger.info(f"Detected changes in stock IDs, encoded update with {len(stock_ids_and_names)} stocks")
+        self.broadcast()
+        return True
+
+    async def subscribe(self, consumer):
+        self.outboxes[consumer] = Outbox(
+            consumer,
+            max_lag=getattr(settings, 'SLOW_CONSUMER_MAX_LAG', 120),
+            on_close=self.unsubscribe
+        )
+        # New connections get the cached snapshot without an upstream call
+        if self.snapshot is not None:
+            self._send(consumer)
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._run())
+
+    def unsubscribe(self, consumer):
+        outbox = self.outboxes.pop(consumer, None)
+        if outbox:
+            outbox.close()
+        if not self.outboxes and self.task:
+            self.task.cancel()
+            self.task = None
+
+    def broadcast(self):
+        for consumer in list(self.outboxes):
+            self._send(consumer)
+
+    def _send(self, consumer):
+        outbox = self.outboxes.get(consumer)
+        if outbox is not None:
+            snapshot = self.snapshot
+            outbox.put('stock_ids', lambda: {'text_data': snapshot.payload})
+
+    async def _run(self):
+        """Refresh once per ttl while anyone is connected; changes are pushed by _rebuild"""
+        try:
+            while self.outboxes:
+                try:
+                    await self.refresh()
+                except Exception as e:
+                    logger.error(f"Error in stock IDs feed: {e}")
+                if self.snapshot is None:
+                    logger.info("No stock IDs data available yet, waiting...")
+                    await asyncio.sleep(self.retry_interval)
+                else:
+                    await asyncio.sleep(max(self.ttl - (self.clock() - self.fetched_at), 0))
+        except asyncio.CancelledError:
+            logger.info("Stock IDs feed cancelled")
+            raise
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'hash': self.snapshot.content_hash if self.snapshot else None,
+            'count': self.snapshot.count if self.snapshot else 0,
+            'fetches': self.fetches,
+            'connections': [outbox.stats() for outbox in list(self.outboxes.values())]
+        }
+
+
+# Global singleton instance
+_stock_ids_feed = None
+
+def get_stock_ids_feed():
+    """Get the singleton live-IDs feed"""
+    global _stock_ids_feed
+    if _stock_ids_feed is None:
+        _stock_ids_feed = StockIdsFeed(getattr(settings, 'LIVE_IDS_TTL', 60))
+    return _stock_ids_feed
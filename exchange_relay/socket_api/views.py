@@ -1,5 +1,11 @@
+from django.http import JsonResponse
 from django.shortcuts import render
+from django.views import View
 from django.views.generic import TemplateView
+from rest_framework.utils.encoders import JSONEncoder
+
+from .services.broadcast import get_all_stocks_hub, get_symbol_hub
+from .services.stock_ids_feed import get_stock_ids_feed
 
 class WebSocketTestView(TemplateView):
     template_name = 'socket_api/test.html'
@@ -13,4 +19,18 @@ class AllStocksDebugView(TemplateView):
     
 
 class StockIdsDebugView(TemplateView):
-    template_name = 'socket_api/stock_ids_debug.html'
\ No newline at end of file
+    template_name = 'socket_api/stock_ids_debug.html'
+
+
+class ConnectionStatsView(View):
+    """Per-connection outbox counters (queued, sent, dropped, lag) of the market streams.
+    
+    Async so the counters are read on the event loop that mutates the hubs,
+    not from a worker thread while a connection is added or removed.
+    """
+    async def get(self, request):
+        return JsonResponse({
+            'all_stocks': get_all_stocks_hub().connection_stats(),
+            'exchange': get_symbol_hub().connection_stats(),
+            'stock_ids': get_stock_ids_feed().stats()
+        }, encoder=JSONEncoder, json_dumps_params={'ensure_ascii': False})